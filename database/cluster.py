@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# PostgreSQL primitives for running several bot instances at once
+
+from database.error import DatabaseError
+from database.internal import DatabaseInternal, ReturnType
+
+import logging
+import psycopg2
+import threading
+
+logger = logging.getLogger(__name__)
+
+QUERY_CREATE_TABLE_UPDATE_QUEUE = (
+    'CREATE TABLE update_queue ('
+        'id BIGSERIAL PRIMARY KEY, '
+        'chat_id BIGINT NOT NULL, '
+        'payload TEXT NOT NULL, '
+        'locked_by VARCHAR (64), '
+        'locked_at TIMESTAMP'
+    ')'
+)
+
+QUERY_CREATE_INDEX_UPDATE_QUEUE_CHAT = (
+    'CREATE INDEX IF NOT EXISTS update_queue_chat_id_idx ON update_queue (chat_id, id)'
+)
+
+# An update is claimed only when it is the oldest one of its chat still in the
+# queue: rows are deleted after processing, so a later update of the same chat
+# waits until the previous one is done on any instance.
+QUERY_CLAIM_UPDATE = (
+    'UPDATE update_queue SET locked_by = %s, locked_at = NOW() '
+    'WHERE id = ('
+        'SELECT id FROM update_queue q '
+        'WHERE q.locked_by IS NULL '
+            'AND NOT EXISTS ('
+                'SELECT 1 FROM update_queue p WHERE p.chat_id = q.chat_id AND p.id < q.id'
+            ') '
+        'ORDER BY q.id LIMIT 1 '
+        'FOR UPDATE SKIP LOCKED'
+    ') '
+    'RETURNING id, chat_id, payload'
+)
+
+QUERY_RELEASE_STALE_UPDATES = (
+    'UPDATE update_queue SET locked_by = NULL, locked_at = NULL '
+    'WHERE locked_by IS NOT NULL AND locked_at < NOW() - %s * INTERVAL \'1 second\''
+)
+
+class WorkQueue(DatabaseInternal):
+    def __init__(self, url: str):
+        super().__init__(url)
+
+    def init_table(self) -> DatabaseError:
+        status, exists = self.table_exists(name = 'update_queue', primary = True)
+        if status != DatabaseError.Ok:
+            return status
+        if not exists:
+            status = self.run(QUERY_CREATE_TABLE_UPDATE_QUEUE, [], ReturnType.NONE, need_commit = True)
+            if status != DatabaseError.Ok:
+                return status
+        return self.run(QUERY_CREATE_INDEX_UPDATE_QUEUE_CHAT, [], ReturnType.NONE, need_commit = True)
+
+    def push(self, chat_id: int, payload: str) -> DatabaseError:
+        return self.insert(
+            table = 'update_queue',
+            data = {
+                'chat_id': chat_id,
+                'payload': payload
+            }
+        )
+
+    def claim(self, worker_id: str) -> (DatabaseError, dict):
+        status, rows = self.run(QUERY_CLAIM_UPDATE, [worker_id], ReturnType.ALL_ROWS, need_commit = True)
+        if status != DatabaseError.Ok or len(rows) == 0:
+            return status, {}
+
+        return status, {
+            'id': rows[0][0],
+            'chat_id': rows[0][1],
+            'payload': rows[0][2]
+        }
+
+    def done(self, item_id: int) -> DatabaseError:
+        return self.run('DELETE FROM update_queue WHERE id = %s', [item_id], ReturnType.NONE, need_commit = True)
+
+    def release_stale(self, timeout: int) -> DatabaseError:
+        return self.run(QUERY_RELEASE_STALE_UPDATES, [timeout], ReturnType.NONE, need_commit = True)
+
+# Session-level advisory lock on a dedicated connection: the lock is released by
+# PostgreSQL as soon as the connection of the leader dies.
+class LeaderElection(threading.Thread):
+    def __init__(self, url: str, lock_id: int, on_elected, on_lost, on_tick = None, interval: float = 5.0):
+        super().__init__(name = 'leader-election', daemon = True)
+        self.url = url
+        self.lock_id = lock_id
+        self.interval = interval
+        self.is_leader = False
+        self._on_elected = on_elected
+        self._on_lost = on_lost
+        self._on_tick = on_tick
+        self._con = None
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+    def _close(self) -> None:
+        if self._con is not None:
+            try:
+                self._con.close()
+            except Exception:
+                pass
+        self._con = None
+
+    def _step(self) -> None:
+        if self._con is None:
+            self._con = psycopg2.connect(self.url)
+            self._con.autocommit = True
+
+        cur = self._con.cursor()
+        if self.is_leader:
+            cur.execute('SELECT 1')
+        else:
+            cur.execute('SELECT pg_try_advisory_lock(%s)', [self.lock_id])
+            if cur.fetchone()[0]:
+                logger.info('Elected as leader')
+                self.is_leader = True
+                self._on_elected()
+        cur.close()
+
+        if self.is_leader and self._on_tick is not None:
+            self._on_tick()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._step()
+            except Exception as error:
+                logger.critical('Leader election error. Cause: %s', error)
+                self._close()
+                if self.is_leader:
+                    self.is_leader = False
+                    self._on_lost()
+            self._stop_event.wait(self.interval)
+
+        self._close()
@@ -7,4 +7,6 @@ class DatabaseError(IntEnum):
     InvalidData = 1
     RecordExists = 2
     InternalError = 3
-    RecordUsed = 4
\ No newline at end of file
+    RecordUsed = 4
+    # the deadline of the update has expired, see DatabaseInternal.run
+    Timeout = 5
\ No newline at end of file
@@ -3,10 +3,19 @@
 # All actions with DB are here
 
 from database.error import DatabaseError
+from database.records import make_records
 
 from enum import Enum
+import contextlib
+import json
 import logging
+import math
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import select
+import threading
+import time
 from psycopg2.extensions import cursor
 
 logger = logging.getLogger(__name__)
@@ -21,6 +30,8 @@ def _make_select_part_with_as(fields: dict) -> str:
 
     return select_part
 
+# values are always passed as arguments, dates and timestamps have no literal
+# form of their own
 def _make_where_part(wheres: dict) -> (str, list):
     where_part = ''
     where_args = []
@@ -30,34 +41,18 @@ def _make_where_part(wheres: dict) -> (str, list):
             where_part += ' and '
         if value is None:
             where_part += '{} is NULL'.format(field)
+        elif isinstance(value, dict) and value['sign'] == 'BETWEEN':
+            where_part += '{} BETWEEN %s AND %s'.format(field)
+            where_args.extend(value['value'])
         elif isinstance(value, dict):
-            where_part += '{} {} '.format(field, value['sign'])
-            if isinstance(value['value'], str):
-                where_part += '%s'
-                where_args.extend([value['value']])
-            else:
-                where_part += str(value['value'])
+            where_part += '{} {} %s'.format(field, value['sign'])
+            where_args.append(value['value'])
         elif isinstance(value, list):
-            where_part += '{} in ('.format(field)
-            where_value_part = ''
-            where_value_args = []
-            for val in value:
-                if len(where_value_part) != 0:
-                    where_value_part += ','
-                if isinstance(val, str):
-                    where_value_part += '%s'
-                    where_value_args.extend([val])
-                else:
-                    where_value_part += str(val)
-            where_part += where_value_part + ')'
-            where_args.extend(where_value_args)
+            where_part += '{} in ({})'.format(field, ','.join(['%s'] * len(value)))
+            where_args.extend(value)
         else:
-            where_part += '{} = '.format(field)
-            if isinstance(value, str):
-                where_part += '%s'
-                where_args.extend([value])
-            else:
-                where_part += str(value)
+            where_part += '{} = %s'.format(field)
+            where_args.append(value)
 
     return where_part, where_args
 
@@ -80,22 +75,153 @@ def _make_set_part(data: dict) -> (str, list):
 
     return set_part, set_args
 
+# rows read by scan nodes of EXPLAIN ANALYZE output, including filtered out ones
+def _count_scanned_rows(plan: dict) -> int:
+    scanned = 0
+    if 'Scan' in plan.get('Node Type', ''):
+        rows = plan.get('Actual Rows', 0) + plan.get('Rows Removed by Filter', 0) + plan.get('Rows Removed by Index Recheck', 0)
+        scanned += rows * plan.get('Actual Loops', 1)
+    for sub_plan in plan.get('Plans', []):
+        scanned += _count_scanned_rows(sub_plan)
+    return scanned
+
+# Deadline of the update handled by the current thread. Queries get the rest of
+# it as statement_timeout and lock_timeout, run raises DeadlineExceeded when
+# it is over.
+_deadline = threading.local()
+
+class DeadlineExceeded(Exception):
+    pass
+
+def set_deadline(seconds: float) -> None:
+    _deadline.expires_at = time.monotonic() + seconds
+
+def clear_deadline() -> None:
+    _deadline.expires_at = None
+
+# seconds left, None when there is no deadline
+def get_deadline_remaining() -> float:
+    expires_at = getattr(_deadline, 'expires_at', None)
+    return None if expires_at is None else expires_at - time.monotonic()
+
+# for work which must not stop halfway after a write has been committed
+@contextlib.contextmanager
+def without_deadline():
+    expires_at = getattr(_deadline, 'expires_at', None)
+    _deadline.expires_at = None
+    try:
+        yield
+    finally:
+        _deadline.expires_at = expires_at
+
+# row_type: database.records class for big results, dicts are built otherwise
+def _make_rows(column_names: list, all_rows: list, row_type = None) -> list:
+    if row_type is not None:
+        return make_records(row_type, column_names, all_rows)
+
+    result = []
+    for row in all_rows:
+        if len(row) == len(column_names):
+            data = {}
+            for i in range(len(row)):
+                data[column_names[i]] = None if row[i] is None else row[i]
+            result.append(data)
+    return result
+
 class ReturnType(Enum):
     NONE = 0
     ONE_ROW = 1
     ALL_ROWS = 2
 
+# 0 when the replica has replayed everything it received
+QUERY_REPLICA_LAG = (
+    'SELECT CASE '
+        'WHEN NOT pg_is_in_recovery() THEN 0 '
+        'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0) '
+    'END'
+)
+
+# seconds for the replica lag probe to connect and to answer
+LAG_PROBE_TIMEOUT = 2
+
 class DatabaseInternal:
-    def __init__(self, url: str):
+    def __init__(self, url: str, read_url: str = None, max_replica_lag: float = 10.0, lag_check_interval: float = 5.0):
         self.url = url
-
-    def run(self, query_format: str, query_args: list, ret: ReturnType, need_commit: bool):
+        self.read_url = read_url
+        self.max_replica_lag = max_replica_lag
+        self.lag_check_interval = lag_check_interval
+        self.replica_lag = None
+        self._lag_checked_at = None
+        # held while a probe is running
+        self._lag_lock = threading.Lock()
+        self._listeners = dict()
+        self._listen_thread = None
+
+    # runs in its own thread, a replica which does not answer never holds requests
+    def _check_replica_lag(self) -> None:
+        lag = None
+        con = None
+        try:
+            con = psycopg2.connect(self.read_url, connect_timeout = LAG_PROBE_TIMEOUT,
+                                   options = '-c statement_timeout={}'.format(LAG_PROBE_TIMEOUT * 1000))
+            cur = con.cursor()
+            cur.execute(QUERY_REPLICA_LAG)
+            lag = float(cur.fetchone()[0])
+            cur.close()
+        except Exception as error:
+            logger.warning('Cannot check replica lag. Cause: %s', error)
+        finally:
+            if con is not None:
+                con.close()
+            self.replica_lag = lag
+            self._lag_lock.release()
+
+        if lag is None or lag > self.max_replica_lag:
+            logger.warning('Replica is not available or lags behind (%s s), reading from primary', lag)
+
+    # reads go to primary until the first probe has answered
+    def _get_read_url(self) -> str:
+        if self.read_url is None:
+            return self.url
+
+        now = time.monotonic()
+        if (self._lag_checked_at is None or now - self._lag_checked_at >= self.lag_check_interval) and self._lag_lock.acquire(blocking = False):
+            self._lag_checked_at = now
+            threading.Thread(target = self._check_replica_lag, name = 'replica-lag', daemon = True).start()
+
+        if self.replica_lag is None or self.replica_lag > self.max_replica_lag:
+            return self.url
+        return self.read_url
+
+    # Writes always go to primary. Reads which must see the caller's own latest
+    # write have to be done with primary = True
+    def run(self, query_format: str, query_args: list, ret: ReturnType, need_commit: bool, primary: bool = True):
+        remaining = get_deadline_remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded()
+
+        url = self.url if primary or need_commit else self._get_read_url()
+        result = self._run(url, query_format, query_args, ret, need_commit)
+        status = result if ret == ReturnType.NONE else result[0]
+        if status == DatabaseError.Timeout:
+            raise DeadlineExceeded()
+        return result
+
+    def _run(self, url: str, query_format: str, query_args: list, ret: ReturnType, need_commit: bool):
         result = []
         status = DatabaseError.Ok
         con = None
         try:
-            con = psycopg2.connect(self.url)
+            remaining = get_deadline_remaining()
+            if remaining is None:
+                con = psycopg2.connect(url)
+            else:
+                con = psycopg2.connect(url, connect_timeout = max(1, math.ceil(remaining)))
             cur = con.cursor()
+            if remaining is not None:
+                timeout = max(1, int(get_deadline_remaining() * 1000))
+                cur.execute('SET LOCAL statement_timeout = {0}; SET LOCAL lock_timeout = {0}'.format(timeout))
 
             logger.info('query_format = "%s"\nquery_args="%s"', query_format, ','.join(map(str, query_args)))
             cur.execute(query_format, query_args)
@@ -111,9 +237,15 @@ class DatabaseInternal:
                 con.commit()
 
             cur.close()
+        except (psycopg2.errors.QueryCanceled, psycopg2.errors.LockNotAvailable) as error:
+            logger.warning('Query cancelled by the deadline. Cause: %s', error)
+            status = DatabaseError.Timeout
         except Exception as error:
             logger.critical('Database error. Cause: %s', error)
             status = DatabaseError.InternalError
+            remaining = get_deadline_remaining()
+            if remaining is not None and remaining <= 0:
+                status = DatabaseError.Timeout
         finally:
             if con is not None:
                 con.close()
@@ -122,8 +254,107 @@ class DatabaseInternal:
             else:
                 return status, result
 
+    # Runs the query with a named (server-side) cursor and calls on_row for
+    # every row, so only itersize rows are in memory whatever the result size
+    def stream(self, query_format: str, query_args: list, on_row, itersize: int = 1000, primary: bool = False) -> DatabaseError:
+        url = self.url if primary else self._get_read_url()
+        status = DatabaseError.Ok
+        con = None
+        try:
+            con = psycopg2.connect(url)
+            con.set_session(readonly = True)
+            cur = con.cursor(name = 'stream_{}'.format(threading.get_ident()))
+            cur.itersize = itersize
+
+            logger.info('query_format = "%s"\nquery_args="%s"', query_format, ','.join(map(str, query_args)))
+            cur.execute(query_format, query_args)
+            for row in cur:
+                on_row(row)
+
+            cur.close()
+        except Exception as error:
+            logger.critical('Database error. Cause: %s', error)
+            status = DatabaseError.InternalError
+        finally:
+            if con is not None:
+                con.close()
+        return status
 
-    def select(self, get_fields, table: str, wheres: dict = {}, joins: list = []) -> (DatabaseError, list):
+    # One multi-row INSERT per page_size rows in one transaction, for batched
+    # writers; rows are tuples in the order of columns
+    def insert_many(self, table: str, columns: list, rows: list, page_size: int = 1000) -> DatabaseError:
+        status = DatabaseError.Ok
+        con = None
+        try:
+            con = psycopg2.connect(self.url)
+            cur = con.cursor()
+            logger.info('insert_many into %s: %s rows', table, len(rows))
+            psycopg2.extras.execute_values(cur, 'INSERT INTO {} ({}) VALUES %s'.format(table, ', '.join(columns)), rows, page_size = page_size)
+            con.commit()
+            cur.close()
+        except Exception as error:
+            logger.critical('Database error. Cause: %s', error)
+            status = DatabaseError.InternalError
+        finally:
+            if con is not None:
+                con.close()
+        return status
+
+
+    def explain(self, query_format: str, query_args: list, primary: bool = False) -> (DatabaseError, int):
+        status, row = self.run('EXPLAIN (ANALYZE, FORMAT JSON) ' + query_format, query_args, ReturnType.ONE_ROW, need_commit = False, primary = primary)
+        if status != DatabaseError.Ok or len(row) == 0:
+            return status, 0
+
+        plan = json.loads(row[0]) if isinstance(row[0], str) else row[0]
+        return DatabaseError.Ok, _count_scanned_rows(plan[0]['Plan'])
+
+    # callback(payload) is called from the listener thread for every
+    # notification of the channel and with None after every (re)connect, when
+    # notifications could have been missed. New channels are listened to
+    # after the next reconnect, so register them all at once.
+    def listen(self, channel: str, callback) -> None:
+        self._listeners.setdefault(channel, []).append(callback)
+        if self._listen_thread is None:
+            self._listen_thread = threading.Thread(target = self._listen_loop, name = 'db-listener', daemon = True)
+            self._listen_thread.start()
+
+    def _dispatch(self, channel: str, payload: str) -> None:
+        for callback in self._listeners.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as error:
+                logger.critical('Listener of %s failed. Cause: %s', channel, error)
+
+    def _listen_loop(self) -> None:
+        while True:
+            con = None
+            try:
+                con = psycopg2.connect(self.url)
+                con.autocommit = True
+                cur = con.cursor()
+                channels = list(self._listeners.keys())
+                for channel in channels:
+                    cur.execute('LISTEN {}'.format(channel))
+                for channel in channels:
+                    self._dispatch(channel, None)
+
+                while True:
+                    if select.select([con], [], [], 5) == ([], [], []):
+                        continue
+                    con.poll()
+                    while len(con.notifies) != 0:
+                        notify = con.notifies.pop(0)
+                        self._dispatch(notify.channel, notify.payload)
+            except Exception as error:
+                logger.critical('Database listener error. Cause: %s', error)
+            finally:
+                if con is not None:
+                    con.close()
+            time.sleep(1)
+
+    def select(self, get_fields, table: str, wheres: dict = {}, joins: list = [], primary: bool = False, stats: dict = None,
+               order_by: str = None, limit: int = None, row_type = None) -> (DatabaseError, list):
         fields = ', '.join(get_fields) if isinstance(get_fields, list) else _make_select_part_with_as(get_fields)
 
         query_format = 'SELECT {} FROM {}'.format(fields, table)
@@ -138,24 +369,30 @@ class DatabaseInternal:
             query_format += ' WHERE ' + query_part_format
             query_args.extend(query_part_args)
 
-        status, all_rows = self.run(query_format, query_args, ReturnType.ALL_ROWS, need_commit = False)
+        if order_by is not None:
+            query_format += ' ORDER BY ' + order_by
+        if limit is not None:
+            query_format += ' LIMIT ' + str(limit)
+
+        # stats: rows scanned/returned by the query, costs one more execution
+        if stats is not None:
+            status, scanned = self.explain(query_format, query_args, primary = primary)
+            if status != DatabaseError.Ok:
+                return status, []
+            stats['rows_scanned'] = scanned
+
+        status, all_rows = self.run(query_format, query_args, ReturnType.ALL_ROWS, need_commit = False, primary = primary)
+        if stats is not None and status == DatabaseError.Ok:
+            stats['rows_returned'] = len(all_rows)
 
         if status != DatabaseError.Ok or len(all_rows) == 0:
             return status, []
 
-        result = []
         column_names = get_fields if isinstance(get_fields, list) else list(get_fields.values())
-        for row in all_rows:
-            if len(row) == len(column_names):
-                data = {}
-                for i in range(len(row)):
-                    data[column_names[i]] = None if row[i] is None else row[i]
-                result.append(data)
-
-        return DatabaseError.Ok, result
+        return DatabaseError.Ok, _make_rows(column_names, all_rows, row_type)
 
-    def table_exists(self, name: str) -> (DatabaseError, bool):
-        status, row = self.run("SELECT to_regclass('{}')".format(name), [], ReturnType.ONE_ROW, need_commit = False)
+    def table_exists(self, name: str, primary: bool = False) -> (DatabaseError, bool):
+        status, row = self.run("SELECT to_regclass('{}')".format(name), [], ReturnType.ONE_ROW, need_commit = False, primary = primary)
 
         if status != DatabaseError.Ok:
             return status, False
@@ -164,8 +401,8 @@ class DatabaseInternal:
             return DatabaseError.Ok, False
         return DatabaseError.Ok, row[0] == name
 
-    def record_exists(self, table: str, wheres: dict) -> (DatabaseError, bool):
-        status, db_record_info = self.select(['1'], table, wheres)
+    def record_exists(self, table: str, wheres: dict, primary: bool = False) -> (DatabaseError, bool):
+        status, db_record_info = self.select(['1'], table, wheres, primary = primary)
 
         if status != DatabaseError.Ok or len(db_record_info) == 0:
             return status, False
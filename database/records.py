@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Typed rows for big results of DatabaseInternal.select (row_type = ...). A row
+# takes a fixed __slots__ object instead of a dict and reads like the dict it
+# replaces: row['field'], row.get('field'), 'field' in row, dict(row).
+# A field equal to None is treated as missing, the way dicts built by
+# DatabaseManager leave out the buyer of an opened deal.
+
+class Record:
+    __slots__ = ()
+    fields = ()
+
+    # __init__(self, <fields>) of every subclass is generated: plain
+    # assignments are several times faster than a setattr loop
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        body = ''.join('\n    self.{0} = {0}'.format(name) for name in cls.fields)
+        namespace = dict()
+        exec('def __init__(self, {}):{}'.format(', '.join(cls.fields), body), namespace)
+        cls.__init__ = namespace['__init__']
+
+    def __getitem__(self, name: str):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name: str, value) -> None:
+        setattr(self, name, value)
+
+    def __contains__(self, name: str) -> bool:
+        return getattr(self, name, None) is not None
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def get(self, name: str, default = None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def keys(self) -> list:
+        return [name for name in self.fields if getattr(self, name) is not None]
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.keys()}
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name) for name in self.fields)
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.fields))
+
+class User(Record):
+    __slots__ = fields = ('id', 'nick', 'fullname')
+
+class Place(Record):
+    __slots__ = fields = ('id', 'name')
+
+class Session(Record):
+    __slots__ = fields = ('id', 'admin', 'place_id', 'weekday', 'time', 'info_prefix')
+
+class SellRecord(Record):
+    __slots__ = fields = ('id', 'user_id', 'session_id', 'trade_in_date', 'price')
+
+# opened or closed deal: sell record with the buyer, if any
+class Supply(Record):
+    __slots__ = fields = ('id', 'buy_id', 'seller', 'buyer', 'trade_in_date', 'session_id', 'price')
+
+# rows of the columns as row_type objects, fields without a column are None
+def make_records(row_type, column_names: list, rows: list) -> list:
+    if list(column_names) == list(row_type.fields):
+        return [row_type(*row) for row in rows]
+
+    indexes = [column_names.index(name) if name in column_names else None for name in row_type.fields]
+    return [row_type(*[None if index is None else row[index] for index in indexes]) for row in rows]
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# PostgreSQL copy of conversation states, see utils.state_store
+
+from database.error import DatabaseError
+from database.internal import DatabaseInternal, ReturnType
+
+import json
+
+QUERY_CREATE_TABLE_CONVERSATION_STATE = (
+    'CREATE TABLE conversation_state ('
+        'token VARCHAR (16) PRIMARY KEY, '
+        'expires_at TIMESTAMPTZ NOT NULL, '
+        'state TEXT NOT NULL'
+    ')'
+)
+
+QUERY_CREATE_INDEX_CONVERSATION_STATE_EXPIRES = (
+    'CREATE INDEX IF NOT EXISTS conversation_state_expires_idx ON conversation_state (expires_at)'
+)
+
+QUERY_SELECT_STATE = (
+    'SELECT EXTRACT(EPOCH FROM expires_at), state FROM conversation_state '
+    'WHERE token = %s AND expires_at > to_timestamp(%s)'
+)
+
+class StateTable(DatabaseInternal):
+    def __init__(self, url: str):
+        super().__init__(url)
+
+    def init_table(self) -> DatabaseError:
+        status, exists = self.table_exists(name = 'conversation_state', primary = True)
+        if status != DatabaseError.Ok:
+            return status
+        if not exists:
+            status = self.run(QUERY_CREATE_TABLE_CONVERSATION_STATE, [], ReturnType.NONE, need_commit = True)
+            if status != DatabaseError.Ok:
+                return status
+        return self.run(QUERY_CREATE_INDEX_CONVERSATION_STATE_EXPIRES, [], ReturnType.NONE, need_commit = True)
+
+    # items: (token, expires_at epoch seconds, state), one statement for all
+    def save(self, items: list) -> DatabaseError:
+        if len(items) == 0:
+            return DatabaseError.Ok
+
+        query_format = 'INSERT INTO conversation_state (token, expires_at, state) VALUES '
+        query_format += ', '.join(['(%s, to_timestamp(%s), %s)'] * len(items))
+        query_format += ' ON CONFLICT (token) DO NOTHING'
+        query_args = []
+        for token, expires_at, state in items:
+            query_args.extend([token, expires_at, json.dumps(state)])
+        return self.run(query_format, query_args, ReturnType.NONE, need_commit = True)
+
+    # (expires_at, state), state is None for unknown and expired tokens
+    def load(self, token: str, now: float) -> (DatabaseError, tuple):
+        status, rows = self.run(QUERY_SELECT_STATE, [token, now], ReturnType.ALL_ROWS, need_commit = False)
+        if status != DatabaseError.Ok or len(rows) == 0:
+            return status, (0, None)
+        return status, (float(rows[0][0]), json.loads(rows[0][1]))
+
+    def purge(self, now: float) -> DatabaseError:
+        return self.run('DELETE FROM conversation_state WHERE expires_at <= to_timestamp(%s)', [now], ReturnType.NONE, need_commit = True)
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
+from database.error import DatabaseError
+from database.state import StateTable
 from training.actions import TrainingActions
+from utils.cluster import ClusterNode
+from utils.profiler import UpdateProfiler
+from utils.state_store import StateStore
 
 import logging
 import os
+import signal
 
-from telegram.ext import CallbackQueryHandler, CommandHandler, Updater
+from telegram.ext import CallbackQueryHandler, CommandHandler, Dispatcher, InlineQueryHandler, JobQueue, Updater
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -15,30 +21,156 @@ logger = logging.getLogger(__name__)
 CONFIG_PATH = 'training/data.json'
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+# optional read replica for selects
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+# seconds, reads fall back to DATABASE_URL when the replica lags more
+DATABASE_MAX_REPLICA_LAG = float(os.environ.get('DATABASE_MAX_REPLICA_LAG', 10))
 API_TOKEN = os.environ.get('API_TOKEN')
+# another Bot API server, e.g. http://127.0.0.1:8081/bot of tools/fake_bot_api.py
+BOT_API_URL = os.environ.get('BOT_API_URL')
+# updates are received by a webhook on WEBHOOK_LISTEN:WEBHOOK_PORT instead of
+# polling, WEBHOOK_URL is the address of it seen by the Bot API server
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 0))
+# log rows scanned/returned by every offer search (runs EXPLAIN ANALYZE)
+SEARCH_EXPLAIN = os.environ.get('SEARCH_EXPLAIN', '0') == '1'
+
+# seconds, 0 disables digests
+DIGEST_INTERVAL = int(os.environ.get('DIGEST_INTERVAL', 0))
+# seconds before the training start
+REMINDER_LEAD = int(os.environ.get('REMINDER_LEAD', 3 * 60 * 60))
+# days, 0 disables archiving
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+# seconds between refreshes of the trade rollups, 0 - never
+ANALYTICS_INTERVAL = int(os.environ.get('ANALYTICS_INTERVAL', 3600))
+# seconds, pinned status boards of groups are edited at most once per this
+# period, 0 - /status posts the board as new messages
+STATUS_BOARD_DELAY = int(os.environ.get('STATUS_BOARD_DELAY', 10))
+
+# market_events are written by JOURNAL_BATCH events or every JOURNAL_INTERVAL
+# seconds, whichever comes first
+JOURNAL_BATCH = int(os.environ.get('JOURNAL_BATCH', 100))
+JOURNAL_INTERVAL = float(os.environ.get('JOURNAL_INTERVAL', 1.0))
+
+# weeks of trainings generated ahead, dates to sell and order are taken from them
+OCCURRENCE_WEEKS = int(os.environ.get('OCCURRENCE_WEEKS', 8))
+
+# sell dialog in the v0.2 format (training/for v0.2/config.json), empty - built-in one
+DIALOG_CONFIG = os.environ.get('DIALOG_CONFIG', '')
+
+# conversation state behind callback tokens: seconds to keep it, states in
+# memory, copy in the database. Tokens are used with the copy only (always in
+# CLUSTER_MODE), without it buttons carry plain requests
+STATE_TTL = int(os.environ.get('STATE_TTL', 24 * 60 * 60))
+STATE_MAX_SIZE = int(os.environ.get('STATE_MAX_SIZE', 100000))
+STATE_PERSIST = os.environ.get('STATE_PERSIST', '0') == '1'
+
+# seconds an update may wait for the database (statement_timeout of its
+# queries), 0 - no limit
+UPDATE_DEADLINE = float(os.environ.get('UPDATE_DEADLINE', 5))
+
+# live profiling (/profile of an admin or SIGUSR1): 'sample' - collapsed
+# stacks, 'cprofile' - .prof files; updates profiled after SIGUSR1
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_UPDATES = int(os.environ.get('PROFILE_UPDATES', 100))
+PROFILE_FRACTION = float(os.environ.get('PROFILE_FRACTION', 1.0))
+
+profiler = UpdateProfiler(PROFILE_DIR, PROFILE_MODE, PROFILE_INTERVAL)
+
+# market reads are served from memory
+ORDER_BOOK = os.environ.get('ORDER_BOOK', '1') == '1'
+# seconds between checks of the order book against the database
+ORDER_BOOK_RECONCILE = int(os.environ.get('ORDER_BOOK_RECONCILE', 300))
+
+# several instances share DATABASE_URL, one of them receives updates from
+# Telegram (polling or WEBHOOK_PORT, only the leader listens to it, so
+# WEBHOOK_URL has to lead to the current leader)
+CLUSTER_MODE = os.environ.get('CLUSTER_MODE', '0') == '1'
+CLUSTER_LOCK_ID = int(os.environ.get('CLUSTER_LOCK_ID', 730510))
+CLUSTER_WORKERS = int(os.environ.get('CLUSTER_WORKERS', 4))
+
+def add_handlers(dispatcher: Dispatcher) -> None:
+    # Only for group chat
+    dispatcher.add_handler(CommandHandler('status', profiler.wrap('/status', TrainingActions.GroupChat.status)))
+    dispatcher.add_handler(CommandHandler('bind', TrainingActions.GroupChat.bind))
+    dispatcher.add_handler(CommandHandler('unbind', TrainingActions.GroupChat.unbind))
+
+    # Only for user chat
+    dispatcher.add_handler(CommandHandler('start', profiler.wrap('/start', TrainingActions.UserChat.start)))
+    dispatcher.add_handler(CommandHandler('profile', TrainingActions.UserChat.profile))
+    dispatcher.add_handler(CommandHandler('export', TrainingActions.UserChat.export))
+    dispatcher.add_handler(CommandHandler('stats', TrainingActions.UserChat.stats))
+    dispatcher.add_handler(CallbackQueryHandler(profiler.wrap('button', TrainingActions.UserChat.callback_button)))
+
+    # Inline mode, must be enabled in @BotFather
+    dispatcher.add_handler(InlineQueryHandler(TrainingActions.Inline.query))
+
+# SIGUSR1 starts profiling of the next PROFILE_UPDATES updates or stops it
+def toggle_profiler(signum, frame) -> None:
+    if profiler.active:
+        profiler.stop()
+    else:
+        profiler.start(PROFILE_UPDATES, PROFILE_FRACTION)
+
+def init_jobs(job_queue: JobQueue) -> None:
+    # Scheduled digests & reminders
+    TrainingActions.init_jobs(job_queue, DIGEST_INTERVAL, ARCHIVE_AFTER_DAYS, ORDER_BOOK_RECONCILE, ANALYTICS_INTERVAL)
+
+def start_updates(updater: Updater) -> None:
+    if WEBHOOK_PORT > 0:
+        updater.start_webhook(WEBHOOK_LISTEN, WEBHOOK_PORT, url_path = API_TOKEN, webhook_url = WEBHOOK_URL.rstrip('/') + '/' + API_TOKEN)
+    else:
+        updater.start_polling()
+
+# tokens known to one process only would break every menu on a restart and
+# on taps served by another cluster instance
+def make_state_store(url: str) -> StateStore:
+    if not STATE_PERSIST and not CLUSTER_MODE:
+        return None
+    backend = StateTable(url)
+    if backend.init_table() != DatabaseError.Ok:
+        logger.critical('Cannot create conversation_state, buttons carry plain requests')
+        return None
+    return StateStore(STATE_MAX_SIZE, STATE_TTL, backend)
 
 def main() -> None:
     try:
-        TrainingActions.init(CONFIG_PATH, DATABASE_URL)
+        TrainingActions.init(CONFIG_PATH, DATABASE_URL, DATABASE_READ_URL, DATABASE_MAX_REPLICA_LAG, SEARCH_EXPLAIN, ORDER_BOOK, DIALOG_CONFIG,
+                             make_state_store(DATABASE_URL), UPDATE_DEADLINE, profiler, JOURNAL_BATCH, JOURNAL_INTERVAL, STATUS_BOARD_DELAY,
+                             OCCURRENCE_WEEKS, REMINDER_LEAD)
     except Exception:
         logger.critical('Cannot start')
         return
 
-    updater = Updater(API_TOKEN)
+    updater = Updater(API_TOKEN, base_url = BOT_API_URL)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle_profiler)
 
-    # Only for group chat
-    updater.dispatcher.add_handler(CommandHandler('status', TrainingActions.GroupChat.status))
+    if CLUSTER_MODE:
+        # jobs run only on the leader
+        node = ClusterNode(updater, DATABASE_URL, CLUSTER_LOCK_ID, lambda: init_jobs(updater.job_queue), workers = CLUSTER_WORKERS,
+                           start_updates = lambda: start_updates(updater))
+        add_handlers(node.dispatcher)
+        if node.start() != DatabaseError.Ok:
+            logger.critical('Cannot start cluster node')
+            return
+        node.idle()
+        TrainingActions.shutdown()
+        return
 
-    # Only for user chat
-    updater.dispatcher.add_handler(CommandHandler('start', TrainingActions.UserChat.start))
-    updater.dispatcher.add_handler(CallbackQueryHandler(TrainingActions.UserChat.callback_button))
+    add_handlers(updater.dispatcher)
+    init_jobs(updater.job_queue)
 
     # Start the Bot
-    updater.start_polling()
+    start_updates(updater)
 
     # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT
     updater.idle()
+    TrainingActions.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Usage: python -m tools.archive --days 30
+
+from database.error import DatabaseError
+from training.db_manager import DatabaseManager
+
+import argparse
+import logging
+import os
+import sys
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
+)
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = 'training/data.json'
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Move past sell/buy records into history tables')
+    parser.add_argument('--days', type = int, default = 30, help = 'archive records older than this number of days')
+    parser.add_argument('--batch-size', type = int, default = 500)
+    parser.add_argument('--database-url', default = os.environ.get('DATABASE_URL'))
+    args = parser.parse_args()
+
+    dbm = DatabaseManager()
+    if dbm.init(CONFIG_PATH, args.database_url) != DatabaseError.Ok:
+        logger.critical('Cannot connect to database')
+        return 1
+
+    status, counts = dbm.archive_records(args.days, args.batch_size)
+    if status != DatabaseError.Ok:
+        logger.critical('Archiving failed')
+        return 1
+
+    print('sell_records: {}, buy_records: {}'.format(counts['sell_records'], counts['buy_records']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Usage: python -m tools.bench_matching --events 100000 1000000 --trainings 50
+
+from training.matching import MatchingEngine
+
+import argparse
+import random
+import sys
+import time
+
+PRICES = list(range(100, 2001, 50))
+
+def make_events(count: int, trainings: int, cancel_share: float, seed: int) -> list:
+    rnd = random.Random(seed)
+    events = []
+    placed = []
+    for i in range(count):
+        if len(placed) != 0 and rnd.random() < cancel_share:
+            events.append(('cancel',) + placed.pop(rnd.randrange(len(placed))))
+            continue
+        side = 'ask' if rnd.random() < 0.5 else 'bid'
+        events.append((side, i, rnd.randrange(1000), rnd.randrange(trainings), '01.01.2030', rnd.choice(PRICES)))
+        placed.append((side, i))
+    return events
+
+def run_engine(events: list) -> (int, list):
+    engine = MatchingEngine()
+    matches = 0
+    latencies = []
+    for event in events:
+        start = time.perf_counter()
+        if event[0] == 'cancel':
+            if event[1] == 'ask':
+                engine.remove_ask(event[2])
+            else:
+                engine.remove_bid(event[2])
+        elif event[0] == 'ask':
+            side, entry_id, user_id, session_id, date, price = event
+            if engine.take_bid(session_id, date, price, user_id) is None:
+                engine.add_ask(entry_id, user_id, session_id, date, price)
+            else:
+                matches += 1
+        else:
+            side, entry_id, user_id, session_id, date, limit = event
+            if engine.take_ask(session_id, date, limit, user_id) is None:
+                engine.add_bid(entry_id, user_id, session_id, date, limit)
+            else:
+                matches += 1
+        latencies.append(time.perf_counter() - start)
+    return matches, latencies
+
+# full scan of the resting entries of the training, the way a query without
+# the engine would look for the best counterparty
+def run_scan(events: list) -> (int, list):
+    resting = {'ask': dict(), 'bid': dict()}
+    matches = 0
+    latencies = []
+    for event in events:
+        start = time.perf_counter()
+        if event[0] == 'cancel':
+            for entries in resting[event[1]].values():
+                entries.pop(event[2], None)
+        else:
+            side, entry_id, user_id, session_id, date, price = event
+            other = resting['bid' if side == 'ask' else 'ask'].setdefault((session_id, date), dict())
+            best = None
+            for other_id, (other_user, other_price, seq) in other.items():
+                order = (-other_price if side == 'ask' else other_price, seq)
+                if best is None or order < best[0]:
+                    best = (order, other_id, other_user, other_price)
+            # same rules as MatchingEngine: price-time priority, no match with own entries
+            if best is not None:
+                fits = best[3] >= price if side == 'ask' else best[3] <= price
+                if best[2] == user_id or not fits:
+                    best = None
+            if best is None:
+                resting[side].setdefault((session_id, date), dict())[entry_id] = (user_id, price, entry_id)
+            else:
+                del other[best[1]]
+                matches += 1
+        latencies.append(time.perf_counter() - start)
+    return matches, latencies
+
+def _percentile(values: list, share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Benchmark of offer/order matching')
+    parser.add_argument('--events', type = int, nargs = '+', default = [10000, 100000])
+    parser.add_argument('--trainings', type = int, default = 20)
+    parser.add_argument('--cancel-share', type = float, default = 0.1)
+    parser.add_argument('--scan', action = 'store_true', help = 'compare with a full scan of resting entries')
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>10} {:>12} {:>10} {:>10}'.format('events', 'method', 'matches', 'events/s', 'p50, us', 'p99, us'))
+    for count in args.events:
+        events = make_events(count, args.trainings, args.cancel_share, args.seed)
+        methods = [('heaps', run_engine)] + ([('scan', run_scan)] if args.scan else [])
+        results = []
+        for name, func in methods:
+            start = time.perf_counter()
+            matches, latencies = func(events)
+            elapsed = time.perf_counter() - start
+            latencies.sort()
+            results.append(matches)
+            print('{:>10} {:>8} {:>10} {:>12.0f} {:>10.2f} {:>10.2f}'.format(count, name, matches, count / elapsed,
+                  _percentile(latencies, 0.5) * 1e6, _percentile(latencies, 0.99) * 1e6))
+        if len(set(results)) != 1:
+            print('Methods disagree on the number of matches')
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
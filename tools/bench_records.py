@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# Time and memory of select results as dicts and as database.records rows,
+# for a market snapshot of the given sizes. Rows are built from tuples the
+# way a cursor returns them, then read once the way DatabaseManager does.
+#
+# Usage: python -m tools.bench_records --rows 10000 100000 1000000
+
+from database.internal import _make_rows
+from database.records import Supply
+
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+COLUMNS = ['id', 'buy_id', 'seller', 'buyer', 'trade_in_date', 'session_id', 'price']
+
+def make_cursor_rows(count: int) -> list:
+    rows = []
+    for i in range(count):
+        closed = i % 3 == 0
+        rows.append((i, i if closed else None, i % 5000, (i + 1) % 5000 if closed else None,
+                     '2030.01.{:02d}'.format(i % 28 + 1), i % 50, 500 if i % 2 == 0 else None))
+    return rows
+
+def read_rows(rows: list) -> int:
+    users = 0
+    for row in rows:
+        users += row['seller']
+        if row.get('buyer') is not None:
+            users += row['buyer']
+        if row.get('price') is not None:
+            users += 1
+    return users
+
+def measure(rows: list, row_type) -> (float, float, float):
+    gc.collect()
+    start = time.perf_counter()
+    result = _make_rows(COLUMNS, rows, row_type)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    read_rows(result)
+    read = time.perf_counter() - start
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = _make_rows(COLUMNS, rows, row_type)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return build, read, size / len(rows)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Benchmark of dict and typed rows of select')
+    parser.add_argument('--rows', type = int, nargs = '+', default = [10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>10} {:>10} {:>12}'.format('rows', 'type', 'build, ms', 'read, ms', 'bytes/row'))
+    for count in args.rows:
+        rows = make_cursor_rows(count)
+        for name, row_type in [('dict', None), ('Supply', Supply)]:
+            build, read, size = measure(rows, row_type)
+            print('{:>10} {:>8} {:>10.1f} {:>10.1f} {:>12.0f}'.format(count, name, build * 1000, read * 1000, size))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Usage: python -m tools.bench_renderer --supplies 1000 10000 100000
+
+import training.renderer as renderer
+
+import argparse
+import sys
+import time
+
+def make_market(supplies_count: int, places_count: int = 5, sessions_count: int = 4, dates_count: int = 4) -> list:
+    supplies = []
+    per_date = max(1, supplies_count // (places_count * sessions_count * dates_count))
+    supply_id = 0
+    for place in range(places_count):
+        place_data = {'place_name': 'Бассейн {}'.format(place), 'sessions': []}
+        for session in range(sessions_count):
+            session_data = {'info_prefix': '🟢', 'weekday': 'ВС', 'time': '{}:00'.format(7 + session), 'dates': []}
+            for date in range(dates_count):
+                date_data = {'date': '{:02}.01.2030'.format(date + 1), 'supplies': []}
+                for i in range(per_date):
+                    supply_id += 1
+                    supply = {
+                        'id': supply_id,
+                        'seller': {'nick': 'seller{}'.format(supply_id), 'fullname': 'Продавец {}'.format(supply_id)}
+                    }
+                    if supply_id % 2 == 0:
+                        supply['buyer'] = {'nick': 'buyer{}'.format(supply_id), 'fullname': 'Покупатель {}'.format(supply_id)}
+                    date_data['supplies'].append(supply)
+                session_data['dates'].append(date_data)
+            place_data['sessions'].append(session_data)
+        supplies.append(place_data)
+    return supplies
+
+# the way _get_status built the text before training.renderer
+def legacy_status(supplies: list) -> str:
+    text = 'Статус:'
+    for place_data in supplies:
+        text += '\n\n{}:'.format(place_data['place_name'])
+        for session_data in place_data['sessions']:
+            text += '\n   {}:'.format(' '.join([session_data['info_prefix'], session_data['weekday'], session_data['time']]))
+            for date_data in session_data['dates']:
+                text += '\n      {}:'.format(date_data['date'])
+                for supply in date_data['supplies']:
+                    text += '\n         Продавец: @{} ({})'.format(supply['seller']['nick'], supply['seller']['fullname'])
+                    if 'buyer' in supply:
+                        text += '  Покупатель: @{} ({})'.format(supply['buyer']['nick'], supply['buyer']['fullname'])
+    return text
+
+def _measure(func, repeat: int) -> float:
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Benchmark of market listing rendering')
+    parser.add_argument('--supplies', type = int, nargs = '+', default = [1000, 10000, 100000])
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>12} {:>8} {:>10}'.format('supplies', 'legacy, ms', 'render, ms', 'chunks', 'max chunk'))
+    for supplies_count in args.supplies:
+        supplies = make_market(supplies_count)
+        chunks = renderer.render('status', supplies)
+        # chunks never start with the empty line before a place
+        if '\n'.join(chunks).replace('\n\n', '\n') != legacy_status(supplies).replace('\n\n', '\n'):
+            print('Rendered text differs from the legacy one')
+            return 1
+
+        legacy_time = _measure(lambda: legacy_status(supplies), args.repeat)
+        render_time = _measure(lambda: renderer.render('status', supplies), args.repeat)
+        print('{:>10} {:>12.2f} {:>12.2f} {:>8} {:>10}'.format(supplies_count, legacy_time * 1000, render_time * 1000, len(chunks), max(len(chunk) for chunk in chunks)))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Runs several local instances of the cluster primitives against a local
+# PostgreSQL and checks leader uniqueness and per-chat ordering.
+#
+# Usage: python -m tools.cluster_check --database-url postgresql://localhost/trade_in_test
+
+from database.cluster import LeaderElection, WorkQueue
+from database.error import DatabaseError
+from database.internal import DatabaseInternal, ReturnType
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+QUERY_CREATE_TABLE_RESULTS = (
+    'CREATE TABLE IF NOT EXISTS cluster_check_results ('
+        'id BIGSERIAL PRIMARY KEY, '
+        'chat_id BIGINT NOT NULL, '
+        'seq INT NOT NULL, '
+        'instance VARCHAR (64) NOT NULL'
+    ')'
+)
+
+QUERY_CREATE_TABLE_LEADERS = (
+    'CREATE TABLE IF NOT EXISTS cluster_check_leaders ('
+        'id BIGSERIAL PRIMARY KEY, '
+        'instance VARCHAR (64) NOT NULL, '
+        'event VARCHAR (16) NOT NULL, '
+        'event_time TIMESTAMP NOT NULL DEFAULT clock_timestamp()'
+    ')'
+)
+
+def _instance(url: str, lock_id: int, workers: int, run_time: float) -> None:
+    instance_id = 'pid{}'.format(os.getpid())
+    db = DatabaseInternal(url)
+    queue = WorkQueue(url)
+    stop_event = threading.Event()
+
+    def work(worker_id: str) -> None:
+        while not stop_event.is_set():
+            status, item = queue.claim(worker_id)
+            if status != DatabaseError.Ok or len(item) == 0:
+                stop_event.wait(0.05)
+                continue
+            payload = json.loads(item['payload'])
+            db.insert('cluster_check_results', {'chat_id': item['chat_id'], 'seq': payload['seq'], 'instance': worker_id})
+            queue.done(item['id'])
+
+    def elected() -> None:
+        db.insert('cluster_check_leaders', {'instance': instance_id, 'event': 'elected'})
+
+    def lost() -> None:
+        db.insert('cluster_check_leaders', {'instance': instance_id, 'event': 'lost'})
+
+    election = LeaderElection(url, lock_id, elected, lost, on_tick = lambda: queue.release_stale(30), interval = 0.5)
+    election.start()
+    threads = [threading.Thread(target = work, args = ('{}#{}'.format(instance_id, i),)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(run_time)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    # recorded before the lock is released
+    if election.is_leader:
+        lost()
+    election.stop()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Check clustered mode with several local processes')
+    parser.add_argument('--database-url', default = os.environ.get('DATABASE_URL'))
+    parser.add_argument('--instances', type = int, default = 3)
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--chats', type = int, default = 20)
+    parser.add_argument('--updates-per-chat', type = int, default = 50)
+    parser.add_argument('--run-time', type = float, default = 20.0)
+    parser.add_argument('--lock-id', type = int, default = 730511)
+    args = parser.parse_args()
+
+    db = DatabaseInternal(args.database_url)
+    queue = WorkQueue(args.database_url)
+    if queue.init_table() != DatabaseError.Ok:
+        print('Cannot create update_queue')
+        return 1
+    for query_format in [QUERY_CREATE_TABLE_RESULTS, QUERY_CREATE_TABLE_LEADERS]:
+        db.run(query_format, [], ReturnType.NONE, need_commit = True)
+    for table in ['update_queue', 'cluster_check_results', 'cluster_check_leaders']:
+        db.run('TRUNCATE {}'.format(table), [], ReturnType.NONE, need_commit = True)
+
+    for seq in range(args.updates_per_chat):
+        for chat_id in range(args.chats):
+            queue.push(chat_id, json.dumps({'seq': seq}))
+
+    processes = [multiprocessing.Process(target = _instance, args = (args.database_url, args.lock_id, args.workers, args.run_time)) for i in range(args.instances)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    ok = True
+
+    status, rows = db.run('SELECT chat_id, seq FROM cluster_check_results ORDER BY id', [], ReturnType.ALL_ROWS, need_commit = False)
+    last_seq = dict()
+    for chat_id, seq in rows:
+        if seq <= last_seq.get(chat_id, -1):
+            print('Order violated for chat {}: {} after {}'.format(chat_id, seq, last_seq[chat_id]))
+            ok = False
+        last_seq[chat_id] = seq
+    expected = args.chats * args.updates_per_chat
+    print('processed {} of {} updates'.format(len(rows), expected))
+    if len(rows) != expected:
+        ok = False
+
+    status, rows = db.run('SELECT instance, event FROM cluster_check_leaders ORDER BY event_time', [], ReturnType.ALL_ROWS, need_commit = False)
+    leaders = set()
+    for instance, event in rows:
+        if event == 'elected':
+            leaders.add(instance)
+        else:
+            leaders.discard(instance)
+        if len(leaders) > 1:
+            print('Several leaders at once: {}'.format(', '.join(leaders)))
+            ok = False
+    print('leader events: {}'.format(len(rows)))
+
+    print('OK' if ok else 'FAILED')
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
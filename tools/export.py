@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+# Usage: python -m tools.export --format csv --out history.csv [--admin coach_nick]
+
+from database.error import DatabaseError
+from training.db_manager import DatabaseManager
+from training.export import FORMATS, export_history
+
+import argparse
+import logging
+import os
+import sys
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
+)
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = 'training/data.json'
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Export the whole trade history')
+    parser.add_argument('--format', choices = FORMATS, default = 'csv')
+    parser.add_argument('--out', required = True)
+    parser.add_argument('--admin', help = 'only sessions of this coach')
+    parser.add_argument('--database-url', default = os.environ.get('DATABASE_URL'))
+    parser.add_argument('--database-read-url', default = os.environ.get('DATABASE_READ_URL'))
+    args = parser.parse_args()
+
+    dbm = DatabaseManager()
+    if dbm.init(CONFIG_PATH, args.database_url, args.database_read_url) != DatabaseError.Ok:
+        logger.critical('Cannot connect to database')
+        return 1
+
+    status, count = export_history(dbm, args.out, args.format, args.admin)
+    if status != DatabaseError.Ok:
+        logger.critical('Export failed')
+        return 1
+
+    print('{} rows written to {}'.format(count, args.out))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the Telegram Bot API (the methods used by the bot) to run
+# the whole network path on one machine. Updates come from a script or are
+# generated, and are served by getUpdates or posted to the webhook set by the
+# bot. Every answer can be delayed and a share of sends answered with 429.
+#
+# Usage: python -m tools.fake_bot_api --port 8081 --generate 10000 --users 500 --latency 30 --flood 0.01
+#        BOT_API_URL=http://127.0.0.1:8081/bot API_TOKEN=123456:fake python main.py
+#
+# Statistics are printed on Ctrl-C and served at /stats.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import argparse
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+METHOD_PATH = re.compile(r'^/bot([^/]+)/(\w+)$')
+OUTBOUND_METHODS = ['sendMessage', 'editMessageText']
+
+def _percentile(values: list, share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+# /start of every user, then presses of buttons which need no state
+def generate_updates(count: int, users: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    updates = []
+    started = set()
+    for i in range(count):
+        user_id = 10000000 + rnd.randrange(users)
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'Пользователь', 'username': 'load_user_{}'.format(user_id)}
+        chat = {'id': user_id, 'type': 'private', 'first_name': 'Пользователь', 'username': 'load_user_{}'.format(user_id)}
+        if user_id not in started:
+            started.add(user_id)
+            updates.append({'message': {'message_id': i + 1, 'date': int(time.time()), 'chat': chat, 'from': user, 'text': '/start',
+                                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}})
+            continue
+        updates.append({'callback_query': {'id': str(i), 'from': user, 'chat_instance': str(user_id), 'data': rnd.choice(['status', 'about', 'restart']),
+                                           'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': ''}}})
+    return [{'delay': 0, 'update': update} for update in updates]
+
+# [{"delay": seconds before the update, "update": {...}}, ...] or plain updates
+def load_script(path: str) -> list:
+    with open(path, 'r', encoding = 'utf-8') as script_file:
+        items = json.load(script_file)
+    return [item if 'update' in item else {'delay': 0, 'update': item} for item in items]
+
+class FakeBotApi:
+    def __init__(self, latency: float, jitter: float, flood: float, retry_after: int, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood = flood
+        self.retry_after = retry_after
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000000)
+        self._pending = []
+        self.webhook_url = ''
+        # method -> calls
+        self.calls = dict()
+        self.floods = 0
+        self.delivered = 0
+        # chat id -> time of the last delivered update without an answer
+        self._waiting = dict()
+        # seconds from delivery of an update to the first answer in its chat
+        self.response_times = []
+        self.first_delivery = None
+        self.last_answer = None
+
+    #----- updates
+
+    def push(self, update: dict) -> None:
+        with self._cond:
+            update = dict(update)
+            update['update_id'] = next(self._update_ids)
+            self._pending.append(update)
+            self._cond.notify_all()
+        if self.webhook_url:
+            self._post_webhook()
+
+    def play(self, script: list) -> None:
+        for item in script:
+            if item['delay'] > 0:
+                time.sleep(item['delay'])
+            self.push(item['update'])
+
+    def _delivered(self, updates: list) -> None:
+        now = time.perf_counter()
+        for update in updates:
+            body = update.get('message') or update.get('callback_query', {}).get('message') or {}
+            chat_id = body.get('chat', {}).get('id')
+            if chat_id is not None:
+                self._waiting.setdefault(chat_id, now)
+        self.delivered += len(updates)
+        if self.first_delivery is None and len(updates) != 0:
+            self.first_delivery = now
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self._pending = [update for update in self._pending if update['update_id'] >= offset]
+                if len(self._pending) != 0 or time.monotonic() >= deadline:
+                    break
+                self._cond.wait(deadline - time.monotonic())
+            updates = self._pending[0:limit]
+            self._delivered(updates)
+            return updates
+
+    def _post_webhook(self) -> None:
+        with self._cond:
+            updates = self._pending
+            self._pending = []
+            self._delivered(updates)
+        for update in updates:
+            request = urllib.request.Request(self.webhook_url, json.dumps(update).encode('utf-8'), {'Content-Type': 'application/json'})
+            try:
+                urllib.request.urlopen(request, timeout = 10).close()
+            except Exception as error:
+                print('Cannot post update {}: {}'.format(update['update_id'], error), file = sys.stderr)
+
+    #----- methods
+
+    def _answered(self, chat_id) -> None:
+        now = time.perf_counter()
+        started = self._waiting.pop(int(chat_id), None) if chat_id is not None else None
+        if started is not None:
+            self.response_times.append(now - started)
+        self.last_answer = now
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        message = {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'text': params.get('text', '')
+        }
+        markup = params.get('reply_markup')
+        if markup:
+            message['reply_markup'] = json.loads(markup) if isinstance(markup, str) else markup
+        return message
+
+    # Returns (http status, body)
+    def call(self, method: str, params: dict) -> (int, dict):
+        delay = self.latency + self._rnd.uniform(-self.jitter, self.jitter) if self.jitter > 0 else self.latency
+        if delay > 0 and method != 'getUpdates':
+            time.sleep(delay)
+
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method in OUTBOUND_METHODS and self.flood > 0 and self._rnd.random() < self.flood:
+                self.floods += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after {}'.format(self.retry_after),
+                             'parameters': {'retry_after': self.retry_after}}
+
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url', '')
+            if self.webhook_url:
+                threading.Thread(target = self._post_webhook, daemon = True).start()
+            return 200, {'ok': True, 'result': True}
+        if method == 'deleteWebhook':
+            self.webhook_url = ''
+            return 200, {'ok': True, 'result': True}
+        if method == 'getWebhookInfo':
+            return 200, {'ok': True, 'result': {'url': self.webhook_url, 'has_custom_certificate': False, 'pending_update_count': len(self._pending)}}
+        if method in OUTBOUND_METHODS:
+            with self._lock:
+                self._answered(params.get('chat_id'))
+            return 200, {'ok': True, 'result': self._message(params)}
+        if method in ['answerCallbackQuery', 'pinChatMessage', 'answerInlineQuery', 'deleteMessage']:
+            return 200, {'ok': True, 'result': True}
+        return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: method {} is not supported'.format(method)}
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            times = sorted(self.response_times)
+            stats = {'calls': dict(self.calls), 'floods': self.floods, 'delivered': self.delivered, 'answered': len(times)}
+            sends = sum(self.calls.get(method, 0) for method in OUTBOUND_METHODS)
+            if self.first_delivery is not None and self.last_answer is not None and self.last_answer > self.first_delivery:
+                stats['sends_per_second'] = sends / (self.last_answer - self.first_delivery)
+            if len(times) != 0:
+                stats['response_ms'] = {'p50': _percentile(times, 0.5) * 1000, 'p95': _percentile(times, 0.95) * 1000, 'p99': _percentile(times, 0.99) * 1000}
+            return stats
+
+def make_handler(api: FakeBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _params(self) -> dict:
+            url = urllib.parse.urlsplit(self.path)
+            params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > 0:
+                body = self.rfile.read(length).decode('utf-8')
+                if 'json' in (self.headers.get('Content-Type') or ''):
+                    params.update(json.loads(body))
+                else:
+                    params.update({key: values[-1] for key, values in urllib.parse.parse_qs(body).items()})
+            return params
+
+        def _reply(self, status: int, body: dict) -> None:
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _handle(self) -> None:
+            path = urllib.parse.urlsplit(self.path).path
+            params = self._params()
+            if path == '/stats':
+                self._reply(200, api.get_stats())
+                return
+            match = METHOD_PATH.match(path)
+            if match is None:
+                self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                return
+            self._reply(*api.call(match.group(2), params))
+
+        do_GET = _handle
+        do_POST = _handle
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return Handler
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Fake Telegram Bot API server')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8081)
+    parser.add_argument('--latency', type = float, default = 0, help = 'ms added to every call')
+    parser.add_argument('--jitter', type = float, default = 0, help = 'ms, latency is uniform in +-jitter')
+    parser.add_argument('--flood', type = float, default = 0, help = 'share of sends answered with 429')
+    parser.add_argument('--retry-after', type = int, default = 1)
+    parser.add_argument('--script', help = 'JSON list of updates to play')
+    parser.add_argument('--generate', type = int, default = 0, help = 'number of updates to generate')
+    parser.add_argument('--users', type = int, default = 100)
+    parser.add_argument('--rate', type = float, default = 0, help = 'generated updates per second, 0 - all at once')
+    parser.add_argument('--seed', type = int, default = 1)
+    args = parser.parse_args()
+
+    api = FakeBotApi(args.latency / 1000, args.jitter / 1000, args.flood, args.retry_after, args.seed)
+    script = load_script(args.script) if args.script else []
+    if args.generate > 0:
+        generated = generate_updates(args.generate, args.users, args.seed)
+        if args.rate > 0:
+            for item in generated:
+                item['delay'] = 1 / args.rate
+        script += generated
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target = api.play, args = (script,), daemon = True).start()
+    print('Fake Bot API at http://{}:{}/bot, {} updates scripted'.format(args.host, args.port, len(script)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(json.dumps(api.get_stats(), indent = 2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
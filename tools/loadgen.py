@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+# Load generator: virtual users press the buttons of the bot through complete
+# flows (sell, buy with confirm/reject of the seller, cancel, status). Updates
+# are real telegram objects bound to a fake bot, so handlers run as in
+# production except the Bot API calls. Needs an empty test database: the
+# generated places, sessions and users are written into it.
+#
+# The bot is set up by the same environment variables as main.py (ORDER_BOOK,
+# UPDATE_DEADLINE, STATE_PERSIST, ...), so the load meets the production setup.
+#
+# Usage: python -m tools.loadgen --database-url postgresql://localhost/trade_in_load \
+#            --users 200 --places 5 --offers 300 --flows 2000 --threads 8 --save-baseline load.json
+#        python -m tools.loadgen ... --baseline load.json
+
+from database.error import DatabaseError
+from training.actions import TrainingActions
+import main as bot_main
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+WEEKDAYS = ['ПН', 'ВТ', 'СР', 'ЧТ', 'ПТ', 'СБ', 'ВС']
+NAV_BUTTONS = ['В начало', 'Назад']
+# request of a buyer sent to the seller
+SELLER_BUTTONS = ['Разрешить', 'Отклонить']
+FIRST_USER_ID = 10000000
+GROUP_ID = -10000000
+ADMIN_NICK = 'load_admin'
+
+# a step is the text of the button or ANY - a random button except navigation
+# and the texts listed after it
+ANY = None
+
+FLOWS = {
+    'sell':   [('menu', 'Продать'), ('place', ANY), ('session', ANY), ('date', ANY), ('price', ANY), ('confirm', 'Да')],
+    'buy':    [('menu', 'Купить'), ('place', ANY), ('session', ANY), ('period', ANY),
+               ('offer', ANY, 'Оставить заявку', 'Подписаться', 'Подписаться на новые предложения'), ('confirm', 'Да')],
+    'cancel': [('menu', 'Отменить'), ('item', ANY), ('confirm', 'Да')],
+    'status': [('menu', 'Статус')]
+}
+
+def make_config(places: int, sessions: int) -> str:
+    config = [{
+        'admin': ADMIN_NICK,
+        'places': [{
+            'name': 'Площадка {}'.format(i + 1),
+            'schedule': [{
+                'time': '{}:00'.format(8 + j % 12),
+                'weekday': WEEKDAYS[(i + j) % 7],
+                'info_prefix': ''
+            } for j in range(sessions)]
+        } for i in range(places)]
+    }]
+    fd, path = tempfile.mkstemp(suffix = '.json')
+    with os.fdopen(fd, 'w', encoding = 'utf-8') as config_file:
+        json.dump(config, config_file, ensure_ascii = False)
+    return path
+
+# Bot API of the handlers: messages are kept in memory
+class FakeBot:
+    # read by telegram.Message
+    defaults = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._chats = dict()
+        # (chat id, message id) -> message, for edits
+        self._messages = dict()
+        # chat id -> messages not seen by the user yet
+        self._inbox = dict()
+
+    def get_chat(self, chat_id: int) -> Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id < 0:
+                chat = Chat(chat_id, Chat.GROUP, title = 'Группа нагрузки')
+            else:
+                number = chat_id - FIRST_USER_ID
+                chat = Chat(chat_id, Chat.PRIVATE, username = 'load_user_{}'.format(number), first_name = 'Пользователь {}'.format(number))
+            self._chats[chat_id] = chat
+        return chat
+
+    def make_message(self, chat_id: int, text: str, reply_markup = None) -> Message:
+        with self._lock:
+            chat = self.get_chat(chat_id)
+            message = Message(next(self._ids), datetime.datetime.now(), chat, text = text, reply_markup = reply_markup, bot = self)
+            self._messages[(chat_id, message.message_id)] = message
+            self._inbox.setdefault(chat_id, []).append(message)
+            return message
+
+    def send_message(self, chat_id: int, text: str, reply_markup = None, **kwargs) -> Message:
+        return self.make_message(chat_id, text, reply_markup)
+
+    def edit_message_text(self, text: str, chat_id: int = None, message_id: int = None, reply_markup = None, **kwargs) -> Message:
+        with self._lock:
+            message = self._messages.get((chat_id, message_id))
+            if message is None:
+                return True
+            message.text = text
+            message.reply_markup = reply_markup
+            return message
+
+    def answer_callback_query(self, callback_query_id: str, text: str = None, **kwargs) -> bool:
+        return True
+
+    def pin_chat_message(self, chat_id: int, message_id: int, **kwargs) -> bool:
+        return True
+
+    def take_inbox(self, chat_id: int) -> list:
+        with self._lock:
+            return self._inbox.pop(chat_id, [])
+
+    # takes the messages with one of the buttons from all chats
+    def take_with_buttons(self, texts: list) -> list:
+        result = []
+        with self._lock:
+            for chat_id, messages in self._inbox.items():
+                keep = []
+                for message in messages:
+                    (result if any(button.text in texts for button in _buttons(message)) else keep).append(message)
+                self._inbox[chat_id] = keep
+        return result
+
+class FakeContext:
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self.args = []
+
+def _buttons(message: Message) -> list:
+    if message is None or message.reply_markup is None:
+        return []
+    return [button for row in message.reply_markup.inline_keyboard for button in row]
+
+class LoadGenerator:
+    def __init__(self, bot: FakeBot, users: int, seed: int):
+        self._bot = bot
+        self._context = FakeContext(bot)
+        self._users = [FIRST_USER_ID + i for i in range(users)]
+        self._rnd = random.Random(seed)
+        self._rnd_lock = threading.Lock()
+        # a user runs one flow at a time, like a real one
+        self._user_locks = {user_id: threading.Lock() for user_id in self._users}
+        self._stats_lock = threading.Lock()
+        # action -> latencies, seconds
+        self.latencies = dict()
+        # flow -> [completed, aborted]
+        self.flows = dict()
+
+    def _random(self, func, *args):
+        with self._rnd_lock:
+            return func(*args)
+
+    def _measure(self, action: str, handler, update: Update) -> None:
+        start = time.perf_counter()
+        handler(update, self._context)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.latencies.setdefault(action, []).append(elapsed)
+
+    def _count_flow(self, flow: str, completed: bool) -> None:
+        with self._stats_lock:
+            counts = self.flows.setdefault(flow, [0, 0])
+            counts[0 if completed else 1] += 1
+
+    def start(self, user_id: int, action: str = 'start') -> Message:
+        message = self._bot.make_message(user_id, '/start')
+        self._measure(action, TrainingActions.UserChat.start, Update(0, message = message))
+        replies = self._bot.take_inbox(user_id)
+        return replies[-1] if len(replies) != 0 else None
+
+    def press(self, user_id: int, message: Message, button, action: str) -> None:
+        user = User(user_id, 'Пользователь', False)
+        query = CallbackQuery(str(message.message_id), user, str(user_id), message = message, data = button.callback_data, bot = self._bot)
+        self._measure(action, TrainingActions.UserChat.callback_button, Update(0, callback_query = query))
+
+    def _choose(self, message: Message, step: tuple):
+        buttons = _buttons(message)
+        if step[1] is not ANY:
+            return next((button for button in buttons if button.text == step[1]), None)
+        skip = NAV_BUTTONS + list(step[2:])
+        buttons = [button for button in buttons if button.text not in skip]
+        return self._random(self._rnd.choice, buttons) if len(buttons) != 0 else None
+
+    def run_flow(self, flow: str, user_id: int) -> None:
+        with self._user_locks[user_id]:
+            message = self.start(user_id)
+            for step in FLOWS[flow]:
+                button = self._choose(message, step)
+                if button is None:
+                    self._count_flow(flow, False)
+                    return
+                self.press(user_id, message, button, '{}.{}'.format(flow, step[0]))
+            self._count_flow(flow, True)
+            if flow == 'buy':
+                self._answer_sellers()
+
+    # sellers allow or reject the requests they got
+    def _answer_sellers(self) -> None:
+        for message in self._bot.take_with_buttons(SELLER_BUTTONS):
+            buttons = [button for button in _buttons(message) if button.text in SELLER_BUTTONS]
+            button = self._random(self._rnd.choice, buttons)
+            self.press(message.chat_id, message, button, 'buy.allow' if button.text == SELLER_BUTTONS[0] else 'buy.reject')
+
+    def group_status(self) -> None:
+        message = self._bot.make_message(GROUP_ID, '/status')
+        self._measure('group.status', TrainingActions.GroupChat.status, Update(0, message = message))
+        self._bot.take_inbox(GROUP_ID)
+
+    def run(self, jobs: list, threads: int) -> float:
+        queue = list(reversed(jobs))
+        queue_lock = threading.Lock()
+
+        def worker() -> None:
+            while True:
+                with queue_lock:
+                    if len(queue) == 0:
+                        return
+                    flow, user_id = queue.pop()
+                if flow == 'group':
+                    self.group_status()
+                else:
+                    self.run_flow(flow, user_id)
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target = worker) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - start
+
+def _percentile(values: list, share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def make_report(latencies: dict, elapsed: float) -> dict:
+    report = {'elapsed': elapsed, 'updates': sum(len(values) for values in latencies.values()), 'actions': dict()}
+    report['throughput'] = report['updates'] / elapsed
+    for action, values in latencies.items():
+        values = sorted(values)
+        report['actions'][action] = {
+            'count': len(values),
+            'p50': _percentile(values, 0.5) * 1000,
+            'p95': _percentile(values, 0.95) * 1000,
+            'p99': _percentile(values, 0.99) * 1000
+        }
+    return report
+
+def print_report(report: dict, flows: dict, baseline: dict = None) -> None:
+    print('{} updates in {:.1f} s, {:.1f} updates/s'.format(report['updates'], report['elapsed'], report['throughput']))
+    for flow, (completed, aborted) in sorted(flows.items()):
+        print('  {}: {} completed, {} aborted'.format(flow, completed, aborted))
+    print('{:>20} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('action', 'count', 'p50, ms', 'p95, ms', 'p99, ms', 'p95 diff'))
+    for action, row in sorted(report['actions'].items()):
+        diff = ''
+        if baseline is not None and action in baseline['actions']:
+            diff = '{:+.0f}%'.format((row['p95'] / baseline['actions'][action]['p95'] - 1) * 100)
+        print('{:>20} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10}'.format(action, row['count'], row['p50'], row['p95'], row['p99'], diff))
+
+# actions whose p95 grew more than tolerance, throughput included
+def find_regressions(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    if report['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append('throughput')
+    for action, row in report['actions'].items():
+        base = baseline['actions'].get(action)
+        if base is not None and row['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append(action)
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Drive the bot handlers with virtual users')
+    parser.add_argument('--database-url', default = bot_main.DATABASE_URL)
+    parser.add_argument('--database-read-url', default = bot_main.DATABASE_READ_URL)
+    parser.add_argument('--users', type = int, default = 100)
+    parser.add_argument('--places', type = int, default = 3)
+    parser.add_argument('--sessions', type = int, default = 3, help = 'sessions of every place')
+    parser.add_argument('--offers', type = int, default = 100, help = 'sell flows run before the mix')
+    parser.add_argument('--flows', type = int, default = 1000)
+    parser.add_argument('--mix', default = 'sell=3,buy=4,cancel=1,status=1,group=1', help = 'weights of flows')
+    parser.add_argument('--threads', type = int, default = 4)
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--save-baseline', help = 'write the report to this file')
+    parser.add_argument('--baseline', help = 'compare with a saved report')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'allowed p95/throughput regression')
+    args = parser.parse_args()
+
+    config_path = make_config(args.places, args.sessions)
+    try:
+        status = TrainingActions.init(config_path, args.database_url, args.database_read_url, bot_main.DATABASE_MAX_REPLICA_LAG,
+                                      bot_main.SEARCH_EXPLAIN, bot_main.ORDER_BOOK, bot_main.DIALOG_CONFIG,
+                                      bot_main.make_state_store(args.database_url), bot_main.UPDATE_DEADLINE, None,
+                                      bot_main.JOURNAL_BATCH, bot_main.JOURNAL_INTERVAL, bot_main.STATUS_BOARD_DELAY,
+                                      bot_main.OCCURRENCE_WEEKS, bot_main.REMINDER_LEAD)
+        if status != DatabaseError.Ok:
+            print('Cannot init the bot')
+            return 1
+    finally:
+        os.remove(config_path)
+
+    bot = FakeBot()
+    generator = LoadGenerator(bot, args.users, args.seed)
+    rnd = random.Random(args.seed)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+
+    # registration and offers to buy
+    generator.run([('status', user_id) for user_id in users] + [('sell', rnd.choice(users)) for i in range(args.offers)], args.threads)
+    generator.latencies = dict()
+    generator.flows = dict()
+
+    weights = dict(part.split('=') for part in args.mix.split(','))
+    names = list(weights.keys())
+    jobs = [(flow, rnd.choice(users)) for flow in rnd.choices(names, [float(weights[name]) for name in names], k = args.flows)]
+    elapsed = generator.run(jobs, args.threads)
+    report = make_report(generator.latencies, elapsed)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding = 'utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, generator.flows, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding = 'utf-8') as baseline_file:
+            json.dump(report, baseline_file, indent = 2)
+
+    if baseline is not None:
+        regressions = find_regressions(report, baseline, args.tolerance)
+        if len(regressions) != 0:
+            print('Regressions: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Measures how long it takes for a change made by one instance to reach the
+# market_changes listener of another one. Needs a local PostgreSQL with the
+# bot tables and at least one place.
+#
+# Usage: python -m tools.notify_check --database-url postgresql://localhost/trade_in_test
+
+from database.error import DatabaseError
+from database.internal import ReturnType
+from training.db_api import DatabaseAPI, MARKET_CHANNEL
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Measure cache invalidation latency between instances')
+    parser.add_argument('--database-url', default = os.environ.get('DATABASE_URL'))
+    parser.add_argument('--changes', type = int, default = 100)
+    parser.add_argument('--timeout', type = float, default = 5.0)
+    args = parser.parse_args()
+
+    writer = DatabaseAPI(args.database_url)
+    if writer.init_tables() != DatabaseError.Ok:
+        print('Cannot init tables')
+        return 1
+
+    status, row = writer.run('SELECT min(id) FROM places', [], ReturnType.ONE_ROW, need_commit = False)
+    if status != DatabaseError.Ok or row[0] is None:
+        print('No places to change')
+        return 1
+    place_id = row[0]
+
+    latencies = []
+    connected = threading.Event()
+    received = threading.Event()
+
+    def on_change(payload: str) -> None:
+        if payload is None:
+            connected.set()
+            return
+        change = json.loads(payload)
+        if change['table'] == 'places' and change['id'] == place_id:
+            latencies.append(time.time() - change['sent_at'])
+            received.set()
+
+    reader = DatabaseAPI(args.database_url)
+    reader.listen(MARKET_CHANNEL, on_change)
+    if not connected.wait(args.timeout):
+        print('Listener is not connected')
+        return 1
+
+    lost = 0
+    for i in range(args.changes):
+        received.clear()
+        writer.run('UPDATE places SET name = name WHERE id = %s', [place_id], ReturnType.NONE, need_commit = True)
+        if not received.wait(args.timeout):
+            lost += 1
+
+    if len(latencies) == 0:
+        print('No notifications received')
+        return 1
+
+    latencies.sort()
+    print('received {} of {} notifications'.format(len(latencies), args.changes))
+    print('latency, ms: p50 {:.2f}, p95 {:.2f}, max {:.2f}'.format(
+        latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        latencies[-1] * 1000))
+    return 0 if lost == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Rebuilds the market from market_events: offers with their buyers, opened buy
+# orders and requests of buyers waiting for the seller. With --until the state
+# is the one at that time. --compare checks the rebuilt market of today on
+# against sell_records/buy_records/buy_orders and prints the differences.
+#
+# Usage: python -m tools.replay_journal [--until '2030-01-31 12:00'] [--compare] [--show]
+
+from database.error import DatabaseError
+from training.db_api import DatabaseAPI
+from training.journal import MarketJournal
+
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
+)
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%d.%m.%Y"
+
+class MarketState:
+    def __init__(self):
+        # sell_id -> seller, session_id, trade_in_date, price, buyer (None - opened)
+        self.offers = dict()
+        # order_id -> buyer, session_id, trade_in_date, price_limit
+        self.orders = dict()
+        # (sell_id, buyer) of requests without an answer yet
+        self.requests = set()
+        self.events = 0
+        self.last_id = 0
+        # events which refer to unknown offers or orders
+        self.unresolved = 0
+
+    def _find_offer(self, session_id: int, date: str, seller: int) -> int:
+        for sell_id, offer in self.offers.items():
+            if offer['session_id'] == session_id and offer['trade_in_date'] == date and offer['seller'] == seller and offer['buyer'] is None:
+                return sell_id
+        return None
+
+    def _set_buyer(self, sell_id: int, buyer: int) -> None:
+        if sell_id not in self.offers:
+            self.unresolved += 1
+            return
+        self.offers[sell_id]['buyer'] = buyer
+
+    def apply(self, event_id: int, event_time: datetime.datetime, kind: str, sell_id: int, order_id: int, user_id: int, peer_id: int,
+              session_id: int, trade_in_date: str, price: int) -> None:
+        self.events += 1
+        self.last_id = max(self.last_id, event_id)
+        if kind == 'sell':
+            self.offers[sell_id] = {'seller': user_id, 'session_id': session_id, 'trade_in_date': trade_in_date, 'price': price, 'buyer': None}
+        elif kind == 'sell_cancel':
+            if self.offers.pop(sell_id, None) is None:
+                self.unresolved += 1
+        elif kind == 'buy':
+            if sell_id is None:
+                sell_id = self._find_offer(session_id, trade_in_date, peer_id)
+            self._set_buyer(sell_id, user_id)
+            self.requests.discard((sell_id, user_id))
+        elif kind == 'buy_cancel':
+            self._set_buyer(sell_id, None)
+        elif kind == 'buy_request':
+            self.requests.add((sell_id, user_id))
+        elif kind == 'buy_reject':
+            self.requests.discard((sell_id, user_id))
+        elif kind == 'order':
+            self.orders[order_id] = {'buyer': user_id, 'session_id': session_id, 'trade_in_date': trade_in_date, 'price_limit': price}
+        elif kind == 'order_cancel':
+            if self.orders.pop(order_id, None) is None:
+                self.unresolved += 1
+        elif kind == 'fill':
+            if self.orders.pop(order_id, None) is None:
+                self.unresolved += 1
+            self._set_buyer(sell_id, user_id)
+        else:
+            logger.warning('Unknown event %s: %s', event_id, kind)
+
+    # offers and orders of today on, past trainings are archived anyway
+    def actual(self, today: datetime.date) -> (dict, dict):
+        is_actual = lambda entry: datetime.datetime.strptime(entry['trade_in_date'], DATE_FORMAT).date() >= today
+        return ({sell_id: offer for sell_id, offer in self.offers.items() if is_actual(offer)},
+                {order_id: order for order_id, order in self.orders.items() if is_actual(order)})
+
+# Returns (status, sell_id -> buyer or None, order ids)
+def load_live_market(db: DatabaseAPI, today: datetime.date) -> (DatabaseError, dict, set):
+    date_start = today.strftime(DATE_FORMAT)
+    status, opened_deals = db.get_opened_deals(date_start, primary = True)
+    if status != DatabaseError.Ok:
+        return status, {}, set()
+    status, closed_deals = db.get_closed_deals(date_start, primary = True)
+    if status != DatabaseError.Ok:
+        return status, {}, set()
+    status, buy_orders = db.get_opened_buy_orders(date_start, primary = True)
+    if status != DatabaseError.Ok:
+        return status, {}, set()
+
+    offers = {deal['id']: None for deal in opened_deals}
+    offers.update({deal['id']: deal['buyer'] for deal in closed_deals})
+    return DatabaseError.Ok, offers, {buy_order['id'] for buy_order in buy_orders}
+
+def compare(offers: dict, orders: dict, live_offers: dict, live_orders: set) -> int:
+    differences = 0
+    for sell_id in sorted(offers.keys() | live_offers.keys()):
+        if sell_id not in live_offers:
+            print('offer {}: in the journal only'.format(sell_id))
+        elif sell_id not in offers:
+            print('offer {}: in sell_records only'.format(sell_id))
+        elif offers[sell_id]['buyer'] != live_offers[sell_id]:
+            print('offer {}: buyer {} in the journal, {} in the records'.format(sell_id, offers[sell_id]['buyer'], live_offers[sell_id]))
+        else:
+            continue
+        differences += 1
+    for order_id in sorted(orders.keys() ^ live_orders):
+        print('order {}: in {} only'.format(order_id, 'the journal' if order_id in orders else 'buy_orders'))
+        differences += 1
+    return differences
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = 'Rebuild the market from the market_events journal')
+    parser.add_argument('--database-url', default = os.environ.get('DATABASE_URL'))
+    parser.add_argument('--until', type = datetime.datetime.fromisoformat, help = 'state at this time, ISO format')
+    parser.add_argument('--compare', action = 'store_true', help = 'compare with the records of today on')
+    parser.add_argument('--show', action = 'store_true', help = 'print the rebuilt offers and orders')
+    args = parser.parse_args()
+
+    journal = MarketJournal(args.database_url)
+    state = MarketState()
+    if journal.stream_events(lambda row: state.apply(*row), until = args.until) != DatabaseError.Ok:
+        logger.critical('Cannot read market_events')
+        return 1
+
+    today = (args.until or datetime.datetime.now()).date()
+    offers, orders = state.actual(today)
+    print('events: {}, last id: {}, unresolved: {}'.format(state.events, state.last_id, state.unresolved))
+    print('offers: {} opened, {} closed; buy orders: {}; requests waiting: {}'.format(
+        sum(1 for offer in offers.values() if offer['buyer'] is None), sum(1 for offer in offers.values() if offer['buyer'] is not None),
+        len(orders), len(state.requests)))
+
+    if args.show:
+        for sell_id, offer in sorted(offers.items()):
+            print('offer {id}: {trade_in_date} session {session_id} seller {seller} price {price} buyer {buyer}'.format(id = sell_id, **offer))
+        for order_id, order in sorted(orders.items()):
+            print('order {id}: {trade_in_date} session {session_id} buyer {buyer} limit {price_limit}'.format(id = order_id, **order))
+
+    if args.compare:
+        if args.until is not None:
+            logger.critical('--compare needs the current state, without --until')
+            return 1
+        status, live_offers, live_orders = load_live_market(DatabaseAPI(args.database_url), today)
+        if status != DatabaseError.Ok:
+            logger.critical('Cannot read the market')
+            return 1
+        differences = compare(offers, orders, live_offers, live_orders)
+        print('differences: {}'.format(differences))
+        return 0 if differences == 0 else 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,91 +1,450 @@
 #!/usr/bin/env python3
 
 from database.error import DatabaseError
+from database.internal import DeadlineExceeded, set_deadline, clear_deadline
 from training.db_manager import DatabaseManager
-from utils.keyboard import KeyboardManager
+from training.export import FORMATS, export_history
+from training.offer_search import OfferSearchIndex
+import training.renderer as renderer
+from utils.dialog import DialogTree, load_tree, make_callback
+from utils.keyboard import KeyboardManager, StaticKeyboard, set_state_store
+from utils.profiler import UpdateProfiler
+from utils.state_store import StateStore, TOKEN_PREFIX
+from utils.scheduler import ReminderQueue
 import utils.utils as utils
 
 import datetime
 import logging
+import os
+import tempfile
+import threading
+import time
 
-from telegram import Update, CallbackQuery
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
+from telegram import Update, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext, JobQueue
 
 logger = logging.getLogger(__name__)
 dbm = DatabaseManager()
+reminders = ReminderQueue()
+_reminder_lead = 0
+
+MAIN_MENU_KEYBOARD = StaticKeyboard(
+    buttons = [
+        ('Продать',  'sell'),
+        ('Купить',   'buy'),
+        ('Отменить', 'cancel'),
+        ('Статус',   'status'),
+        ('О боте',   'about')
+    ],
+    show_button_home = False
+)
+# places are loaded once from the config, see DatabaseManager.init
+_places_keyboards = dict()
+
+# (admin, place_id, date) -> (market version, chunks) of status boards, see _get_status
+_status_cache = dict()
+
+# pinned status boards of groups are edited at most once per _boards_delay
+# seconds after the market has changed, see _schedule_boards_refresh. Boards
+# are edited by any instance, so what a board shows is not cached here
+_job_queue = None
+_boards_delay = 0
+_boards_lock = threading.Lock()
+_boards_pending = False
+
+# opened offers for inline queries, see _get_offer_index
+_offer_index = OfferSearchIndex()
+_offer_index_lock = threading.Lock()
+# seconds, the index is rebuilt not more often without the order book
+OFFER_INDEX_TTL = 30
+# seconds, answers to inline queries are cached by Telegram
+INLINE_CACHE_TIME = 30
+# Telegram takes up to 50 results per answer
+INLINE_PAGE_SIZE = 50
+# /start parameter of deep links into the buy flow
+BUY_LINK_PREFIX = 'buy_'
+# offers on one page of the buy listing, a message keeps up to 100 buttons
+SELLERS_PAGE_SIZE = 20
+
+# state behind callback tokens, None - callback_data carries the whole request
+_state_store = None
+
+# sell dialog compiled from a v0.2 config, None - the built-in one.
+# _dialog_sessions[node id] is (place_id, session_id) of a leaf
+_dialog = None
+_dialog_sessions = []
+
+# profiler of live updates, see TrainingActions.UserChat.profile
+_profiler = None
+
+# seconds an update may spend in the database, 0 - no limit
+_update_deadline = 0
+# action -> number of updates stopped by the deadline
+deadline_stats = dict()
+
+# preset prices of offers and limits of buy orders, rubles
+PRICES = [300, 500, 700, 1000]
+
+# name, days from today (0 - no limit)
+SEARCH_PERIODS = [
+    ('Неделя',   7),
+    ('2 недели', 14),
+    ('Месяц',    28),
+    ('Все даты', 0)
+]
 
 class TrainingActions:
     @staticmethod
-    def init(config_path: str, url: str) -> DatabaseError:
-        return dbm.init(config_path, url)
+    def init(config_path: str, url: str, read_url: str = None, max_replica_lag: float = 10.0, explain_searches: bool = False,
+             use_order_book: bool = False, dialog_config_path: str = None, state_store: StateStore = None,
+             update_deadline: float = 0, profiler: UpdateProfiler = None, journal_batch: int = 100,
+             journal_interval: float = 1.0, status_board_delay: int = 0, occurrence_weeks: int = 8,
+             reminder_lead: int = 3 * 60 * 60) -> DatabaseError:
+        global _state_store, _update_deadline, _profiler, _boards_delay, _reminder_lead
+        _state_store = state_store
+        _update_deadline = update_deadline
+        _profiler = profiler
+        _boards_delay = status_board_delay
+        _reminder_lead = reminder_lead
+        set_state_store(state_store)
+        status = dbm.init(config_path, url, read_url, max_replica_lag, explain_searches, use_order_book, journal_batch, journal_interval,
+                          occurrence_weeks)
+        dbm.add_invalidation_callback(_on_market_invalidated)
+        dbm.add_supply_callback(_on_supply_changed)
+        if status == DatabaseError.Ok and dialog_config_path:
+            status = _init_dialog(dialog_config_path)
+        return status
+
+    # events still buffered are written
+    @staticmethod
+    def shutdown() -> None:
+        dbm.close_journal()
+
+    @staticmethod
+    def init_jobs(job_queue: JobQueue, digest_interval: int, archive_after_days: int, order_book_reconcile: int,
+                  analytics_interval: int = 0, reminder_tick: int = 60) -> None:
+        global _job_queue
+        _job_queue = job_queue
+        _load_reminders()
+        if digest_interval > 0:
+            job_queue.run_repeating(send_digests, interval = digest_interval, first = digest_interval)
+        job_queue.run_repeating(send_reminders, interval = reminder_tick, first = reminder_tick)
+        job_queue.run_repeating(generate_occurrences, interval = datetime.timedelta(days = 1), first = datetime.timedelta(days = 1))
+        job_queue.run_once(match_crossed, 5)
+        if order_book_reconcile > 0:
+            job_queue.run_repeating(reconcile_order_book, interval = order_book_reconcile, first = order_book_reconcile)
+        if archive_after_days > 0:
+            job_queue.run_repeating(archive_records, interval = datetime.timedelta(days = 1), first = 60, context = archive_after_days)
+        if analytics_interval > 0:
+            job_queue.run_repeating(refresh_analytics, interval = analytics_interval, first = 120)
+        # without the order book there are no change events, so boards are polled
+        if _boards_delay > 0 and dbm.get_market_version() is None:
+            job_queue.run_repeating(refresh_boards, interval = _boards_delay, first = _boards_delay)
+        if _state_store is not None:
+            job_queue.run_repeating(purge_states, interval = 10 * 60, first = 10 * 60)
 
     class GroupChat:
         @staticmethod
         def status(update: Update, context: CallbackContext) -> None:
             if not utils.is_group_chat(update):
                 return
-            status_text = _get_status()
-            update.message.reply_text(status_text)
+            _start_deadline()
+            try:
+                chat = update.message.chat
+                if dbm.add_group_info(chat.id, chat.title) != DatabaseError.Ok:
+                    logger.warning('Cannot register group %s', chat.id)
+                status, group = dbm.get_group_info(chat.id)
+                if status != DatabaseError.Ok:
+                    logger.warning('Cannot get scope of group %s', chat.id)
+                chunks = _get_status(group.get('admin'), group.get('place_id'))
+            except DeadlineExceeded:
+                _on_deadline_exceeded(update, '/status')
+                return
+            finally:
+                clear_deadline()
+            if _boards_delay > 0:
+                _show_board(update, context, group.get('status_message_id'), chunks)
+                return
+            for chunk in chunks:
+                update.message.reply_text(chunk)
+
+        # /bind [place name] - the status board of the group shows only the
+        # sessions of the coach who sent the command (at the place). A bound
+        # group is rebound or unbound by its coach only
+        @staticmethod
+        def bind(update: Update, context: CallbackContext) -> None:
+            if not utils.is_group_chat(update):
+                return
+            user = update.message.from_user
+            if not dbm.is_admin(user.username):
+                return
+
+            place = None
+            if len(context.args) != 0:
+                status, places = dbm.get_all_places_info()
+                if status != DatabaseError.Ok:
+                    update.message.reply_text('Возникла непредвиденная ошибка. Не удалось получить данные о месте')
+                    return
+                name = ' '.join(context.args).lower()
+                place = next((place for place in places if place['name'].lower() == name), None)
+                if place is None:
+                    update.message.reply_text('Место не найдено. Доступные места: ' + ', '.join(place['name'] for place in places))
+                    return
+
+            chat = update.message.chat
+            status = dbm.bind_group(chat.id, chat.title, user.username, place['id'] if place else None, user.username)
+            if status == DatabaseError.RecordUsed:
+                update.message.reply_text('Группа привязана к другому тренеру, изменить привязку может только он')
+                return
+            if status != DatabaseError.Ok:
+                update.message.reply_text('Возникла непредвиденная ошибка. Привязать группу не удалось')
+                return
+            text = 'Статус группы: тренировки @' + user.username
+            if place is not None:
+                text += ', ' + place['name']
+            update.message.reply_text(text)
+            _schedule_boards_refresh()
+
+        @staticmethod
+        def unbind(update: Update, context: CallbackContext) -> None:
+            if not utils.is_group_chat(update):
+                return
+            user = update.message.from_user
+            if not dbm.is_admin(user.username):
+                return
+            chat = update.message.chat
+            status = dbm.bind_group(chat.id, chat.title, None, None, user.username)
+            if status == DatabaseError.RecordUsed:
+                update.message.reply_text('Группа привязана к другому тренеру, отвязать её может только он')
+                return
+            if status != DatabaseError.Ok:
+                update.message.reply_text('Возникла непредвиденная ошибка. Отвязать группу не удалось')
+                return
+            update.message.reply_text('Статус группы: все тренировки')
+            _schedule_boards_refresh()
+
+    class Inline:
+        # @bot <words> in any chat: opened offers, every word is a prefix of
+        # the place, the session, the weekday, the time, the date or the seller
+        @staticmethod
+        def query(update: Update, context: CallbackContext) -> None:
+            inline_query = update.inline_query
+            offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+            offers = _get_offer_index().search(inline_query.query)
+            page = offers[offset:offset + INLINE_PAGE_SIZE]
+            results = [_make_offer_result(offer, context.bot.username) for offer in page]
+            next_offset = str(offset + INLINE_PAGE_SIZE) if len(offers) > offset + INLINE_PAGE_SIZE else ''
+            inline_query.answer(results, cache_time = INLINE_CACHE_TIME, is_personal = False, next_offset = next_offset)
 
     class UserChat:
         @staticmethod
         def callback_button(update: Update, context: CallbackContext) -> None:
-            req = update.callback_query.data
-            index = req.find(',')
-            action = req if index == -1 else req[0:index]
-
-            if action == 'sell':
-                sell_actions(update, req)
-            elif action == 'buy':
-                buy_actions(update, context, req)
-            elif action == 'cancel':
-                cancel_actions(update, context, req)
-            elif action == 'restart':
-                restart(update, context)
-            elif action == 'status':
-                status(update)
-            elif action == 'about':
-                about(update)
-            elif action == 'confirm':
-                confirm(update, context, req)
-            elif action == 'reject':
-                reject(update, context, req)
-            else:
-                logger.warning('Unknown command: %s', req)
+            # the action is not known until the token is resolved
+            action = TOKEN_PREFIX
+            _start_deadline()
+            try:
+                req = update.callback_query.data
+                if req.startswith(TOKEN_PREFIX + ','):
+                    state = None if _state_store is None else _state_store.get(req[len(TOKEN_PREFIX) + 1:])
+                    if state is None:
+                        common_start(update, is_start = False, text = 'Это меню устарело. Чего изволите?')
+                        return
+                    req = state['req']
+
+                index = req.find(',')
+                action = req if index == -1 else req[0:index]
+                if _profiler is not None:
+                    _profiler.rename('button:' + action)
+
+                if action == 'sell':
+                    sell_actions(update, context, req)
+                elif action == 'buy':
+                    buy_actions(update, context, req)
+                elif action == 'cancel':
+                    cancel_actions(update, context, req)
+                elif action == 'restart':
+                    restart(update, context)
+                elif action == 'status':
+                    status(update)
+                elif action == 'about':
+                    about(update)
+                elif action == 'd':
+                    dialog_actions(update, context, req)
+                elif action == 'confirm':
+                    confirm(update, context, req)
+                elif action == 'reject':
+                    reject(update, context, req)
+                else:
+                    logger.warning('Unknown command: %s', req)
+            except DeadlineExceeded:
+                _on_deadline_exceeded(update, action)
+            finally:
+                clear_deadline()
 
         @staticmethod
         def start(update: Update, context: CallbackContext) -> None:
             if utils.is_group_chat(update):
                 return
-            user_data = update.message.chat
-            status = dbm.add_user_info(user_data.id, user_data.username, user_data.full_name)
+            _start_deadline()
+            try:
+                user_data = update.message.chat
+                status = dbm.add_user_info(user_data.id, user_data.username, user_data.full_name)
+                if status != DatabaseError.Ok:
+                    _send_text(update, req = req, text = 'Возникла непредвиденная ошибка')
+                    return
+                # /start buy_<supply id> - a link from the inline search
+                link = context.args[0] if len(context.args) != 0 else ''
+                if link.startswith(BUY_LINK_PREFIX) and link[len(BUY_LINK_PREFIX):].isdigit():
+                    supply_id = link[len(BUY_LINK_PREFIX):]
+                    confirm_buy(update, ['buy', supply_id], 'buy,' + supply_id, is_start = True)
+                    return
+                common_start(update, is_start = True)
+            except DeadlineExceeded:
+                _on_deadline_exceeded(update, '/start')
+            finally:
+                clear_deadline()
+
+        # /profile [count [fraction]] - profile the next updates, /profile stop
+        @staticmethod
+        def profile(update: Update, context: CallbackContext) -> None:
+            if utils.is_group_chat(update) or _profiler is None:
+                return
+            chat = update.message.chat
+            if not dbm.is_admin(chat.username):
+                return
+
+            args = context.args
+            if len(args) != 0 and args[0] == 'stop':
+                path = _profiler.stop()
+                update.message.reply_text('Профилирование не запущено' if path is None else 'Профиль записан: {}'.format(path))
+                return
+
+            try:
+                count = int(args[0]) if len(args) > 0 else 100
+                fraction = float(args[1]) if len(args) > 1 else 1.0
+            except ValueError:
+                update.message.reply_text('Формат: /profile [число обновлений [доля]] или /profile stop')
+                return
+
+            bot = context.bot
+            on_finish = lambda path: bot.send_message(chat.id, 'Профиль записан: {}'.format(path))
+            if not _profiler.start(count, fraction, on_finish):
+                update.message.reply_text('Профилирование уже запущено')
+                return
+            update.message.reply_text('Профилируются следующие {} обновлений'.format(count))
+
+        # /export [csv|json] - history of trades on sessions of the coach
+        @staticmethod
+        def export(update: Update, context: CallbackContext) -> None:
+            if utils.is_group_chat(update):
+                return
+            chat = update.message.chat
+            if not dbm.is_admin(chat.username):
+                return
+
+            fmt = context.args[0] if len(context.args) != 0 else 'csv'
+            if fmt not in FORMATS:
+                update.message.reply_text('Формат: /export [{}]'.format('|'.join(FORMATS)))
+                return
+
+            fd, path = tempfile.mkstemp(suffix = '.' + fmt)
+            os.close(fd)
+            try:
+                status, count = export_history(dbm, path, fmt, chat.username)
+                if status != DatabaseError.Ok:
+                    update.message.reply_text('Возникла непредвиденная ошибка. Выгрузить историю не удалось')
+                    return
+                with open(path, 'rb') as document:
+                    context.bot.send_document(chat.id, document, filename = 'history.' + fmt, caption = 'Сделок: {}'.format(count))
+            finally:
+                os.remove(path)
+
+        @staticmethod
+        def stats(update: Update, context: CallbackContext) -> None:
+            if utils.is_group_chat(update):
+                return
+            chat = update.message.chat
+            if not dbm.is_admin(chat.username):
+                return
+
+            try:
+                days = int(context.args[0]) if len(context.args) != 0 else STATS_DAYS
+            except ValueError:
+                update.message.reply_text('Использование: /stats [дней]')
+                return
+
+            status, report = dbm.get_analytics(chat.username, days)
             if status != DatabaseError.Ok:
-                _send_text(update, req = req, text = 'Возникла непредвиденная ошибка')
+                update.message.reply_text('Возникла непредвиденная ошибка. Статистику получить не удалось')
                 return
-            common_start(update, is_start = True)
+            if len(report) == 0:
+                update.message.reply_text('За {} дн. сделок не было'.format(days))
+                return
+
+            lines = ['Статистика за {} дн.:'.format(days)]
+            for row in report:
+                line = '{} {} {}: предложений {}, продано {} ({}%), перепродано {}, отменено {} ({}%)'.format(
+                    row['place_name'], row['weekday'], row['time'], row['offers'], row['sold'], _percent(row['sold'], row['offers']),
+                    row['resold'], row['canceled'], _percent(row['canceled'], row['offers']))
+                if row['buy_hours'] is not None:
+                    line += ', до покупки в среднем {:.1f} ч'.format(row['buy_hours'])
+                lines.append(line)
+            update.message.reply_text('\n'.join(lines))
 
 #----------
 
-def _send_text(update: Update, text: str, req: str = '') -> None:
+def _start_deadline() -> None:
+    if _update_deadline > 0:
+        set_deadline(_update_deadline)
+
+# the query is already cancelled, so the user gets a short answer instead of a
+# menu which would need the database again
+def _on_deadline_exceeded(update: Update, action: str) -> None:
+    deadline_stats[action] = deadline_stats.get(action, 0) + 1
+    logger.warning('Deadline of update exceeded, action: %s, total: %s', action, deadline_stats[action])
+    text = 'Сервер занят, попробуйте ещё раз'
+    try:
+        if update.callback_query is not None:
+            update.callback_query.answer(text)
+        else:
+            update.message.reply_text(text)
+    except Exception as error:
+        logger.warning('Cannot answer after deadline. Cause: %s', error)
+
+# is_first_msg - answer to a message (a command), not to a button
+def _send_text(update: Update, text: str, req: str = '', is_first_msg: bool = False) -> None:
     km = KeyboardManager(update, text)
+    km.set_is_first_msg(is_first_msg)
     km.update()
 
 #----- sell actions
 
-def choose_place(update: Update, req: str) -> None:
-    km = KeyboardManager(update, text = 'Выберите место')
-
-    status, plases = dbm.get_all_places_info()
-    if status != DatabaseError.Ok:
-        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о месте')
-        return
+def _on_market_invalidated(table: str) -> None:
+    if table in [None, 'places']:
+        _places_keyboards.clear()
+    # changes could have been missed
+    if table is None and _job_queue is not None:
+        _load_reminders()
+    _schedule_boards_refresh()
+
+def _send_places(update: Update, text: str, req: str, first_buttons: list = []) -> None:
+    if req not in _places_keyboards:
+        status, plases = dbm.get_all_places_info()
+        if status != DatabaseError.Ok:
+            _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о месте')
+            return
 
-    for place in plases:
-        new_cmd = ','.join([req, str(place['id'])])
-        km.add_button(place['name'], new_cmd)
+        buttons = first_buttons + [(place['name'], ','.join([req, str(place['id'])])) for place in plases]
+        _places_keyboards[req] = StaticKeyboard(buttons)
 
+    km = KeyboardManager(update, text = text)
+    km.set_static_keyboard(_places_keyboards[req])
     km.update()
 
+def choose_place(update: Update, req: str) -> None:
+    _send_places(update, 'Выберите место', req)
+
 def choose_session(update: Update, place_id: str, req: str) -> None:
     if not place_id.isdigit():
         logger.warning('Отправлена некорректная команда: %s', req)
@@ -113,29 +472,57 @@ def choose_date(update: Update, session_id: str, req: str) -> None:
         _send_text(update, req = req, text = 'Отправлена некорректная команда')
         return
 
-    status, session_info = dbm.get_session_info(int(session_id))
+    status, occurrences = dbm.get_occurrences(int(session_id), count = 4)
     if status != DatabaseError.Ok:
-        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о времени')
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о дате')
         return
 
     km = KeyboardManager(update, text = 'Выберите дату')
-    today = datetime.date.today()
-    needed_date = utils.nearest_weekday(today, utils.weekday_id(session_info['weekday']))
 
-    for count in range(4):
-        formated_date = needed_date.strftime("%d.%m.%Y")
-        km.add_button(formated_date, req + ',' + formated_date)
-        needed_date += datetime.timedelta(7)
+    for occurrence in occurrences:
+        km.add_button(occurrence['date'], req + ',' + str(occurrence['id']))
 
     km.set_back_action(req[0:req.rfind(',', 0, req.rfind(','))])
     km.update()
 
+def _get_occurrence_date(update: Update, session_id: str, occurrence_id: str, req: str) -> str:
+    status, occurrence_info = dbm.get_occurrence_info(int(occurrence_id))
+    if status != DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о дате')
+        return None
+    if len(occurrence_info) == 0 or occurrence_info['session_id'] != int(session_id):
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        return None
+    return occurrence_info['date']
+
+def _get_price_text(price: int) -> str:
+    return 'по договорённости' if price is None else 'за {} ₽'.format(price)
+
+def choose_price(update: Update, cmd: list, req: str) -> None:
+    place_id = cmd[1]; session_id = cmd[2]; occurrence_id = cmd[3]
+    if not place_id.isdigit() or not session_id.isdigit() or not occurrence_id.isdigit():
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        return
+
+    km = KeyboardManager(update, text = 'Укажите цену')
+    # 0 - by agreement, such offers are bought with confirmation of the seller only
+    km.add_button('Договорная', req + ',0')
+    for price in PRICES:
+        km.add_button('{} ₽'.format(price), req + ',' + str(price))
+
+    km.set_back_action(req[0:req.rfind(',')])
+    km.update()
+
 def confirm_sell(update: Update, cmd: list, req: str) -> None:
-    place_id = cmd[1]; session_id = cmd[2]; date = cmd[3]
-    if not place_id.isdigit() or not session_id.isdigit():
+    place_id = cmd[1]; session_id = cmd[2]; occurrence_id = cmd[3]; price = cmd[4]
+    if not place_id.isdigit() or not session_id.isdigit() or not occurrence_id.isdigit() or not price.isdigit():
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
         return
 
+    date = _get_occurrence_date(update, session_id, occurrence_id, req)
+    if date is None:
+        return
+
     status, session_info = dbm.get_session_info(int(session_id))
     if status != DatabaseError.Ok:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о времени')
@@ -146,18 +533,22 @@ def confirm_sell(update: Update, cmd: list, req: str) -> None:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о месте')
         return
 
-    question = 'Вы уверены, что желаете продать слот {} {} в {}?'.format(session_info['time'], date, place_info['name'])
+    question = 'Вы уверены, что желаете продать слот {} {} в {} {}?'.format(session_info['time'], date, place_info['name'], _get_price_text(int(price) or None))
     km = KeyboardManager(update, text = question)
     km.add_button('Да', req + ',Y')
     km.set_back_action(req[0:req.rfind(',')])
     km.update()
 
-def do_sell(update: Update, cmd: list, req: str) -> None:
-    place_id = cmd[1]; session_id = cmd[2]; date = cmd[3]
-    if not place_id.isdigit() or not session_id.isdigit():
+def do_sell(update: Update, context: CallbackContext, cmd: list, req: str) -> None:
+    place_id = cmd[1]; session_id = cmd[2]; occurrence_id = cmd[3]; price = cmd[4]
+    if not place_id.isdigit() or not session_id.isdigit() or not occurrence_id.isdigit() or not price.isdigit():
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
         return
 
+    date = _get_occurrence_date(update, session_id, occurrence_id, req)
+    if date is None:
+        return
+
     status, session_info = dbm.get_session_info(int(session_id))
     if status != DatabaseError.Ok:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о времени')
@@ -168,9 +559,12 @@ def do_sell(update: Update, cmd: list, req: str) -> None:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о месте')
         return
 
-    status = dbm.add_sell_record(session_id = session_id, date = date, user_id = update.callback_query.message.chat.id)
+    status, offer = dbm.add_sell_record(session_id = session_id, date = date, user_id = update.callback_query.message.chat.id, occurrence_id = int(occurrence_id), price = int(price) or None)
     if status == DatabaseError.Ok:
         _send_text(update, req = req, text = 'Ваша заявка на продажу слота {} {} в {} успешно создана'.format(session_info['time'], date, place_info['name']))
+        _notify_matches(context.bot, offer['matches'])
+        slot = '{} {} в {} {}'.format(session_info['time'], date, place_info['name'], _get_price_text(int(price) or None))
+        _notify_wants(context.bot, offer['id'], offer['wants'], slot)
         return
     elif status == DatabaseError.RecordExists:
         _send_text(update, req = req, text = 'Ваша заявка на продажу слота {} {} в {} уже существует'.format(session_info['time'], date, place_info['name']))
@@ -179,60 +573,223 @@ def do_sell(update: Update, cmd: list, req: str) -> None:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Создать заявку не удалось')
         return
 
+#----- sell dialog
+
+# leaves are bound to sessions by place name and session weekday/time, the
+# prefix of the session is shown only
+def _init_dialog(config_path: str) -> DatabaseError:
+    global _dialog, _dialog_sessions
+    dialog = DialogTree(load_tree(config_path))
+
+    status, places = dbm.get_all_places_info()
+    if status != DatabaseError.Ok:
+        return status
+
+    status, sessions = dbm.get_all_sessions_info()
+    if status != DatabaseError.Ok:
+        return status
+
+    place_ids = {place['name']: place['id'] for place in places}
+    session_ids = {(session['place_id'], session['weekday'], session['time']): session['id'] for session in sessions}
+
+    dialog_sessions = [None] * len(dialog)
+    for leaf in dialog.leaves():
+        place_id = place_ids.get(leaf.values.get('pool'))
+        parts = leaf.values.get('session', '').rsplit(' ', 2)
+        if place_id is None or len(parts) != 3:
+            logger.warning('Dialog node %s is not bound: %s', leaf.id, leaf.values)
+            continue
+        session_id = session_ids.get((place_id, parts[1], parts[2]))
+        if session_id is None:
+            logger.warning('Dialog node %s is not bound: %s', leaf.id, leaf.values)
+            continue
+        dialog_sessions[leaf.id] = (place_id, session_id)
+
+    _dialog = dialog
+    _dialog_sessions = dialog_sessions
+    logger.info('Dialog compiled: %s nodes', len(dialog))
+    return DatabaseError.Ok
+
+def show_dialog_node(update: Update, node) -> None:
+    km = KeyboardManager(update, text = node.text)
+    km.set_static_keyboard(node.keyboard)
+    km.update()
+
+# d,<leaf> - date, d,<leaf>,<occurrence> - price, then confirmation and sell
+# as in the built-in dialog
+def dialog_actions(update: Update, context: CallbackContext, req: str) -> None:
+    node, args = (None, []) if _dialog is None else _dialog.parse(req)
+    if node is None:
+        logger.warning('Unknown command: %s', req)
+        return
+
+    if node.end is None:
+        show_dialog_node(update, node)
+        return
+
+    if _dialog_sessions[node.id] is None:
+        _send_text(update, req = req, text = 'Продажа этого сеанса пока недоступна')
+        return
+
+    place_id, session_id = _dialog_sessions[node.id]
+    cmd = ['sell', str(place_id), str(session_id)] + args
+    if len(args) == 0:
+        status, occurrences = dbm.get_occurrences(session_id, count = node.end['date']['count'])
+        if status != DatabaseError.Ok:
+            _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о дате')
+            return
+
+        km = KeyboardManager(update, text = node.end['date']['text'])
+        for occurrence in occurrences:
+            km.add_button(occurrence['date'], make_callback(node.id, [occurrence['id']]))
+        km.set_back_action(make_callback(node.parent))
+        km.update()
+    elif len(args) == 1:
+        if not args[0].isdigit():
+            _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+            return
+
+        km = KeyboardManager(update, text = node.end['price']['text'])
+        km.add_button('Договорная', req + ',0')
+        for price in PRICES:
+            km.add_button('{} ₽'.format(price), req + ',' + str(price))
+        km.set_back_action(make_callback(node.id))
+        km.update()
+    elif len(args) == 2:
+        confirm_sell(update, cmd, req)
+    elif len(args) == 3:
+        do_sell(update, context, cmd, req)
+    else:
+        logger.warning('Unknown command: %s', req)
+
 #----- buy actions
 
-def choose_seller(update: Update, req: str) -> None:
-    status, supplies = dbm.get_opened_supplies(date_start = datetime.date.today().strftime("%d.%m.%Y")) # !!!
+def search_place(update: Update, req: str) -> None:
+    _send_places(update, 'Где ищем?', req + ',s', first_buttons = [('Все места', req + ',s,0')])
+
+def search_session(update: Update, cmd: list, req: str) -> None:
+    place_id = cmd[2]
+    if not place_id.isdigit():
+        logger.warning('Отправлена некорректная команда: %s', req)
+        _send_text(update, req = req, text = 'Отправлена некорректная команда')
+        return
 
+    if place_id == '0':
+        search_period(update, ['buy', 'd', '0', '0'], 'buy,d,0,0')
+        return
+
+    status, schedules = dbm.get_schedules(int(place_id))
+    if status != DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о расписании')
+        return
+
+    km = KeyboardManager(update, text = 'Выберите время')
+    km.add_button('Любое время', ','.join(['buy', 'd', place_id, '0']))
+    for schedule in schedules:
+        show_name = ' '.join([schedule['info_prefix'], schedule['weekday'], schedule['time']])
+        km.add_button(show_name, ','.join(['buy', 'd', place_id, str(schedule['id'])]))
+
+    km.set_back_action('buy')
+    km.update()
+
+def search_period(update: Update, cmd: list, req: str) -> None:
+    place_id = cmd[2]; session_id = cmd[3]
+    if not place_id.isdigit() or not session_id.isdigit():
+        logger.warning('Отправлена некорректная команда: %s', req)
+        _send_text(update, req = req, text = 'Отправлена некорректная команда')
+        return
+
+    km = KeyboardManager(update, text = 'За какой период?')
+    for name, days in SEARCH_PERIODS:
+        km.add_button(name, ','.join(['buy', 'l', place_id, session_id, str(days)]))
+
+    km.set_back_action('buy' if place_id == '0' else ','.join(['buy', 's', place_id]))
+    km.update()
+
+# cmd: buy,l,place_id,session_id,days[,page]
+def choose_seller(update: Update, cmd: list, req: str) -> None:
+    place_id = cmd[2]; session_id = cmd[3]; days = cmd[4]
+    page = cmd[5] if len(cmd) == 6 else '0'
+    if not place_id.isdigit() or not session_id.isdigit() or not days.isdigit() or not page.isdigit():
+        logger.warning('Отправлена некорректная команда: %s', req)
+        _send_text(update, req = req, text = 'Отправлена некорректная команда')
+        return
+
+    today = datetime.date.today()
+    date_end = None if days == '0' else (today + datetime.timedelta(int(days))).strftime("%d.%m.%Y")
+    status, supplies = dbm.search_opened_supplies(today.strftime("%d.%m.%Y"), date_end, int(place_id), int(session_id))
+
+    back_action = ','.join(['buy', 'd', place_id, session_id])
     if status != DatabaseError.Ok:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получить список предложений не удалось')
         return
     if len(supplies) == 0:
-        _send_text(update, req = req, text = 'Не найдено ни одного предложения')
+        km = KeyboardManager(update, text = 'Не найдено ни одного предложения')
+        if session_id != '0':
+            km.add_button('Оставить заявку', 'buy,o,' + session_id)
+        km.add_button('Подписаться', ','.join(['buy', 'w', place_id, session_id, days]))
+        km.set_back_action(back_action)
+        km.update()
         return
 
+    # the text and the buttons show the same page
+    total = sum(1 for entry in renderer.walk_supplies(supplies))
+    page = min(int(page), (total - 1) // SELLERS_PAGE_SIZE)
+    supplies = renderer.slice_supplies(supplies, page * SELLERS_PAGE_SIZE, SELLERS_PAGE_SIZE)
+    list_req = ','.join(['buy', 'l', place_id, session_id, days])
+
     km = KeyboardManager(update, text = '', width = 1)
 
-    text = 'Выберите предложение:'
-    for place_data in supplies:
-        place_name = place_data['place_name']
-        text += '\n\n{}:'.format(place_name)
-        for session_data in place_data['sessions']:
-            info_prefix = session_data['info_prefix']
-            weekday = session_data['weekday']
-            time = session_data['time']
-            text += '\n   {}:'.format(' '.join([info_prefix, weekday, time]))
-            for date_data in session_data['dates']:
-                date = date_data['date']
-                text += '\n      {}:'.format(date)
-                for supply in date_data['supplies']:
-                    nick = supply['seller']['nick']
-                    fullname = supply['seller']['fullname']
-                    text += '\n         Продавец: @{} ({})'.format(nick, fullname)
-                    km.add_button(' '.join([place_name, time, date, nick]), req + ',' + str(supply['id']))
-
-    km.set_text(text)
+    for place_data, session_data, date_data, supply in renderer.walk_supplies(supplies):
+        name = ' '.join([place_data['place_name'], session_data['time'], date_data['date'], supply['seller']['nick']])
+        if 'price' in supply:
+            name += ' {} ₽'.format(supply['price'])
+        # the listing goes with the offer, so "Назад" returns to this page
+        km.add_button(name, ','.join([list_req, str(page), str(supply['id'])]))
+
+    if page > 0:
+        km.add_button('◀ Предыдущие', ','.join([list_req, str(page - 1)]))
+    if (page + 1) * SELLERS_PAGE_SIZE < total:
+        km.add_button('Следующие ▶', ','.join([list_req, str(page + 1)]))
+    if session_id != '0':
+        km.add_button('Оставить заявку', 'buy,o,' + session_id)
+    km.add_button('Подписаться на новые предложения', ','.join(['buy', 'w', place_id, session_id, days]))
+    km.set_back_action(back_action)
+    km.set_chunks(renderer.render('buy', supplies))
     km.update()
 
-def confirm_buy(update: Update, cmd: list, req: str) -> None:
-    supply_id = cmd[1]
+# cmd: buy,supply_id or buy,l,place_id,session_id,days,page,supply_id from a listing.
+# is_start - opened by a link from the inline search, offers there may be stale
+def confirm_buy(update: Update, cmd: list, req: str, is_start: bool = False) -> None:
+    supply_id = cmd[-1]
     if not supply_id.isdigit():
-        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные', is_first_msg = is_start)
         return
 
-    status, supply_info = dbm.get_supply_info(int(supply_id))
+    status, opened = dbm.is_offer_opened(int(supply_id))
+    if status == DatabaseError.Ok and not opened:
+        if is_start:
+            common_start(update, is_start = True, text = 'Это предложение уже неактуально')
+        else:
+            _send_text(update, req = req, text = 'Это предложение уже неактуально')
+        return
+
+    if status == DatabaseError.Ok:
+        status, supply_info = dbm.get_supply_info(int(supply_id))
     if status != DatabaseError.Ok:
-        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о предложении')
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о предложении', is_first_msg = is_start)
         return
 
-    question = 'Вы уверены, что желаете зафиксировать покупку слота {} {} в {} у @{} ({})?'.format(supply_info['time'], supply_info['date'], supply_info['place_name'], supply_info['seller_nick'], supply_info['seller_fullname'])
+    question = 'Вы уверены, что желаете зафиксировать покупку слота {} {} в {} у @{} ({}) {}?'.format(supply_info['time'], supply_info['date'], supply_info['place_name'], supply_info['seller_nick'], supply_info['seller_fullname'], _get_price_text(supply_info['price']))
     km = KeyboardManager(update, text = question)
     km.add_button('Да', req + ',Y')
     km.set_back_action(req[0:req.rfind(',')])
+    km.set_is_first_msg(is_start)
     km.update()
 
+# cmd: the request of confirm_buy and Y
 def send_buy_confirm(update: Update, context: CallbackContext, cmd: list, req: str) -> None:
-    supply_id = cmd[1]
+    supply_id = cmd[-2]
     if not supply_id.isdigit():
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
         return
@@ -258,6 +815,7 @@ def send_buy_confirm(update: Update, context: CallbackContext, cmd: list, req: s
         }
     )
     context.bot.send_message(supply_info['seller_id'], text, reply_markup = reply_markup)
+    dbm.journal_event('buy_request', sell_id = int(supply_id), user_id = user_data.id, peer_id = supply_info['seller_id'])
 
     _send_text(update, text = 'Пользователю @{} ({}) отправлен запрос на фиксацию слота на {} {} в {}. Согласуйте с ним дальнейшие действия.'.format(supply_info['seller_nick'], supply_info['seller_fullname'], supply_info['time'], supply_info['date'], supply_info['place_name']))
 
@@ -269,6 +827,7 @@ def do_buy(update: Update, supply_id: int, buyer_id: int) -> None:
 
     status = dbm.add_buy_record(supply_info['session_id'], supply_info['date'], seller_id = supply_info['seller_id'], user_id = int(buyer_id))
     if status == DatabaseError.Ok:
+        _add_reminder(supply_id, int(buyer_id), supply_info['time'], supply_info['date'], supply_info['place_name'])
         _send_text(update, text = 'Фиксация слота {} {} в {} успешно произведена'.format(supply_info['time'], supply_info['date'], supply_info['place_name']))
         return status
     elif status == DatabaseError.RecordExists:
@@ -284,56 +843,231 @@ def do_buy(update: Update, supply_id: int, buyer_id: int) -> None:
         _send_text(update, text = 'Возникла непредвиденная ошибка. Зафиксировать слот не удалось')
         return status
 
+#----- inline search
+
+# the index follows the market version of the order book (and the day, past
+# offers drop out); without the book it lives OFFER_INDEX_TTL seconds.
+# Concurrent queries wait for one rebuild instead of reading the market each
+def _get_offer_index() -> OfferSearchIndex:
+    version = dbm.get_market_version()
+    if version is None:
+        version = int(time.monotonic() // OFFER_INDEX_TTL)
+    version = (datetime.date.today(), version)
+    if _offer_index.version == version:
+        return _offer_index
+
+    with _offer_index_lock:
+        if _offer_index.version != version:
+            status, supplies = dbm.get_opened_supplies(datetime.date.today().strftime("%d.%m.%Y"))
+            if status == DatabaseError.Ok:
+                _offer_index.rebuild(supplies, version)
+            else:
+                logger.warning('Cannot rebuild the offer index')
+    return _offer_index
+
+def _make_offer_result(offer: dict, bot_username: str) -> InlineQueryResultArticle:
+    title = ' '.join([offer['place_name'], offer['weekday'], offer['time'], offer['date']])
+    description = '@{} ({}) {}'.format(offer['seller']['nick'], offer['seller']['fullname'], _get_price_text(offer['price']))
+    link = 'https://t.me/{}?start={}{}'.format(bot_username, BUY_LINK_PREFIX, offer['id'])
+    return InlineQueryResultArticle(
+        id = str(offer['id']),
+        title = title,
+        description = description,
+        input_message_content = InputTextMessageContent('Слот {}: {}'.format(title, description)),
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Купить', url = link)]])
+    )
+
+#----- buy orders
+
+def choose_order_date(update: Update, cmd: list, req: str) -> None:
+    session_id = cmd[2]
+    if not session_id.isdigit():
+        logger.warning('Отправлена некорректная команда: %s', req)
+        _send_text(update, req = req, text = 'Отправлена некорректная команда')
+        return
+
+    status, occurrences = dbm.get_occurrences(int(session_id), count = 4)
+    if status != DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о дате')
+        return
+
+    km = KeyboardManager(update, text = 'Выберите дату')
+    for occurrence in occurrences:
+        km.add_button(occurrence['date'], req + ',' + str(occurrence['id']))
+
+    km.set_back_action('buy')
+    km.update()
+
+def choose_order_limit(update: Update, cmd: list, req: str) -> None:
+    session_id = cmd[2]; occurrence_id = cmd[3]
+    if not session_id.isdigit() or not occurrence_id.isdigit():
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        return
+
+    km = KeyboardManager(update, text = 'Укажите максимальную цену')
+    for price in PRICES:
+        km.add_button('{} ₽'.format(price), req + ',' + str(price))
+
+    km.set_back_action(req[0:req.rfind(',')])
+    km.update()
+
+def do_order(update: Update, context: CallbackContext, cmd: list, req: str) -> None:
+    session_id = cmd[2]; occurrence_id = cmd[3]; price_limit = cmd[4]
+    if not session_id.isdigit() or not occurrence_id.isdigit() or not price_limit.isdigit():
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        return
+
+    date = _get_occurrence_date(update, session_id, occurrence_id, req)
+    if date is None:
+        return
+
+    status, session_info = dbm.get_session_info(int(session_id))
+    if status != DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о времени')
+        return
+
+    status, place_info = dbm.get_place_info(session_info['place_id'])
+    if status != DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о месте')
+        return
+
+    status, matches = dbm.add_buy_order(int(session_id), date, update.callback_query.message.chat.id, int(price_limit), int(occurrence_id))
+    if status == DatabaseError.Ok:
+        text = 'Ваша заявка на покупку слота {} {} в {} до {} ₽ успешно создана'.format(session_info['time'], date, place_info['name'], price_limit)
+        if len(matches) == 0:
+            text += '. Сообщу, когда найдётся продавец'
+        _send_text(update, req = req, text = text)
+        _notify_matches(context.bot, matches)
+    elif status == DatabaseError.RecordExists:
+        _send_text(update, req = req, text = 'У вас уже есть заявка на покупку или покупка слота {} {} в {}'.format(session_info['time'], date, place_info['name']))
+    else:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Создать заявку не удалось')
+
+# offers and orders crossed while nobody matched them (a failed fill, a stop)
+def match_crossed(context: CallbackContext) -> None:
+    status, matches = dbm.match_crossed()
+    if status != DatabaseError.Ok:
+        logger.warning('Cannot match crossed offers and orders')
+    if len(matches) != 0:
+        logger.info('Crossed offers and orders matched: %s', len(matches))
+        _notify_matches(context.bot, matches)
+
+def _notify_matches(bot, matches: list) -> None:
+    for match in matches:
+        status, supply_info = dbm.get_supply_info(match['supply_id'])
+        if status != DatabaseError.Ok:
+            logger.warning('Cannot notify about match of supply %s', match['supply_id'])
+            continue
+
+        status, buyer_info = dbm.get_user_info(match['buyer'])
+        if status != DatabaseError.Ok:
+            logger.warning('Cannot notify about match of supply %s', match['supply_id'])
+            continue
+
+        status, admin_info = dbm.get_user_info_by_nick(supply_info['admin'])
+        if status != DatabaseError.Ok:
+            admin_info = {}
+
+        _add_reminder(match['supply_id'], match['buyer'], supply_info['time'], supply_info['date'], supply_info['place_name'])
+
+        slot = '{} {} в {}'.format(supply_info['time'], supply_info['date'], supply_info['place_name'])
+        try:
+            bot.send_message(match['buyer'], 'Ваша заявка на покупку слота {} исполнена: продавец @{} ({}), цена {} ₽. Согласуйте с ним оплату'.format(slot, supply_info['seller_nick'], supply_info['seller_fullname'], match['price']))
+            bot.send_message(match['seller'], 'Ваш слот {} зафиксирован за @{} ({}) по цене {} ₽. Согласуйте с ним оплату'.format(slot, buyer_info['nick'], buyer_info['fullname'], match['price']))
+            if len(admin_info) != 0:
+                bot.send_message(admin_info['id'], '{} вместо @{} ({}) придёт @{} ({})'.format(slot, supply_info['seller_nick'], supply_info['seller_fullname'], buyer_info['nick'], buyer_info['fullname']))
+        except Exception as error:
+            logger.warning('Cannot notify about match of supply %s. Cause: %s', match['supply_id'], error)
+
+#----- wants
+
+def subscribe(update: Update, cmd: list, req: str) -> None:
+    place_id = cmd[2]; session_id = cmd[3]; days = cmd[4]
+    if not place_id.isdigit() or not session_id.isdigit() or not days.isdigit():
+        logger.warning('Отправлена некорректная команда: %s', req)
+        _send_text(update, req = req, text = 'Отправлена некорректная команда')
+        return
+
+    status = dbm.add_want(update.callback_query.message.chat.id, int(place_id), int(session_id), int(days))
+    if status == DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Подписка оформлена. Сообщу, как только появится подходящее предложение')
+    elif status == DatabaseError.RecordExists:
+        _send_text(update, req = req, text = 'Такая подписка у вас уже есть')
+    else:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Оформить подписку не удалось')
+
+def _get_want_text(want: dict) -> str:
+    parts = ['все места' if want['place_name'] is None else want['place_name']]
+    if want['session'] is not None:
+        parts.append(' '.join([want['session']['info_prefix'], want['session']['weekday'], want['session']['time']]))
+    parts.append('все даты' if want['date_end'] is None else 'до ' + want['date_end'])
+    return ', '.join(parts)
+
+def _notify_wants(bot, supply_id: int, wants: dict, slot: str) -> None:
+    if len(wants) == 0:
+        return
+
+    keyboard = StaticKeyboard([('Купить', 'buy,' + str(supply_id))], show_button_home = False)
+    text = 'Появилось предложение по вашей подписке: слот {}'.format(slot)
+    # a user may have several matching wants
+    for user_id in set(wants.values()):
+        try:
+            bot.send_message(user_id, text, reply_markup = keyboard.markup)
+        except Exception as error:
+            logger.warning('Cannot notify user %s about offer %s. Cause: %s', user_id, supply_id, error)
+
 #----- cancel actions
 
 def choose_cancel(update: Update, req: str) -> None:
-    status, supplies = dbm.get_own_supplies(date_start = datetime.date.today().strftime("%d.%m.%Y"), user_id = update.callback_query.message.chat.id)
+    date_start = datetime.date.today().strftime("%d.%m.%Y")
+    user_id = update.callback_query.message.chat.id
+    status, supplies = dbm.get_own_supplies(date_start = date_start, user_id = user_id)
+    if status == DatabaseError.Ok:
+        status, buy_orders = dbm.get_own_buy_orders(date_start, user_id)
+    if status == DatabaseError.Ok:
+        status, wants = dbm.get_own_wants(user_id)
 
     if status != DatabaseError.Ok:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получить список предложений не удалось')
         return
-    if len(supplies) == 0:
+    if len(supplies) == 0 and len(buy_orders) == 0 and len(wants) == 0:
         _send_text(update, req = req, text = 'Не найдено ни одного предложения')
         return
 
-    text = 'Что желаете отменить?'
-    km = KeyboardManager(update, text = '', width = 1)
+    km = KeyboardManager(update, text = renderer.TEMPLATES['cancel']['header'], width = 1)
+
+    for place_data, session_data, date_data, supply in renderer.walk_supplies(supplies):
+        name_action, type_action = ('Покупка', 'b') if 'buyer' in supply else ('Продажа', 's')
+        name = ' '.join([name_action, place_data['place_name'], session_data['time'], date_data['date']])
+        km.add_button(name, req + ',' + type_action + str(supply['id']))
 
-    for place_data in supplies:
-        place_name = place_data['place_name']
-        text += '\n\n{}:'.format(place_name)
-        for session_data in place_data['sessions']:
-            info_prefix = session_data['info_prefix']
-            weekday = session_data['weekday']
-            time = session_data['time']
-            text += '\n   {}:'.format(' '.join([info_prefix, weekday, time]))
-            for date_data in session_data['dates']:
-                date = date_data['date']
-                text += '\n      {}:'.format(date)
-                for supply in date_data['supplies']:
-                    seller_nick = supply['seller']['nick']
-                    seller_fullname = supply['seller']['fullname']
-                    text += '\n         Продавец: @{} ({})'.format(seller_nick, seller_fullname)
-                    if 'buyer' in supply:
-                        buyer_nick = supply['buyer']['nick']
-                        buyer_fullname = supply['buyer']['fullname']
-                        text += '  Покупатель: @{} ({})'.format(buyer_nick, buyer_fullname)
-                    name_action, type_action = ('Покупка', 'b') if 'buyer' in supply else ('Продажа', 's')
-                    km.add_button(' '.join([name_action, place_name, time, date]), req + ',' + type_action + str(supply['id']))
-
-    km.set_text(text)
+    for buy_order in buy_orders:
+        name = ' '.join(['Заявка', buy_order['place_name'], buy_order['time'], buy_order['date'], 'до {} ₽'.format(buy_order['price_limit'])])
+        km.add_button(name, req + ',o' + str(buy_order['id']))
+
+    for want in wants:
+        km.add_button('Подписка: ' + _get_want_text(want), req + ',w' + str(want['id']))
+
+    if len(supplies) != 0:
+        km.set_chunks(renderer.render('cancel', supplies))
     km.update()
 
 def confirm_cancel(update: Update, cmd: list, req: str) -> None:
     action_id = cmd[1]
-    if len(action_id) == 0 or action_id[0] not in ['b', 's'] or not action_id[1:].isdigit():
+    if action_id[0:1] == 'w':
+        confirm_cancel_want(update, action_id[1:], req)
+        return
+    if len(action_id) == 0 or action_id[0] not in ['b', 's', 'o'] or not action_id[1:].isdigit():
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
         return
 
     cancel_type = action_id[0]
     supply_id = action_id[1:]
 
-    status, supply_info = dbm.get_supply_info(int(supply_id))
+    if cancel_type == 'o':
+        status, supply_info = dbm.get_buy_order_info(int(supply_id))
+    else:
+        status, supply_info = dbm.get_supply_info(int(supply_id))
     if status != DatabaseError.Ok:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о предложении')
         return
@@ -343,6 +1077,8 @@ def confirm_cancel(update: Update, cmd: list, req: str) -> None:
         question += 'продажу'
     elif cancel_type == 'b':
         question += 'покупку'
+    elif cancel_type == 'o':
+        question += 'заявку на покупку'
     question += ' слота {} {} в {}?'.format(supply_info['time'], supply_info['date'], supply_info['place_name'])
 
     km = KeyboardManager(update, text = question)
@@ -350,16 +1086,43 @@ def confirm_cancel(update: Update, cmd: list, req: str) -> None:
     km.set_back_action(req[0:req.rfind(',')])
     km.update()
 
+def confirm_cancel_want(update: Update, want_id: str, req: str) -> None:
+    if not want_id.isdigit():
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        return
+
+    km = KeyboardManager(update, text = 'Вы уверены, что желаете отменить подписку?')
+    km.add_button('Да', req + ',Y')
+    km.set_back_action(req[0:req.rfind(',')])
+    km.update()
+
+def do_cancel_want(update: Update, want_id: str, req: str) -> None:
+    if not want_id.isdigit():
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
+        return
+
+    status = dbm.cancel_want(int(want_id), update.callback_query.message.chat.id)
+    if status == DatabaseError.Ok:
+        _send_text(update, req = req, text = 'Отмена подписки прошла успешно')
+    else:
+        _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Произвести отмену не удалось')
+
 def do_cancel(update: Update, context: CallbackContext, cmd: list, req: str) -> None:
     action_id = cmd[1]
-    if len(action_id) == 0 or action_id[0] not in ['b', 's'] or not action_id[1:].isdigit():
+    if action_id[0:1] == 'w':
+        do_cancel_want(update, action_id[1:], req)
+        return
+    if len(action_id) == 0 or action_id[0] not in ['b', 's', 'o'] or not action_id[1:].isdigit():
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Получены некорректные данные')
         return
 
     cancel_type = action_id[0]
     supply_id = action_id[1:]
 
-    status, supply_info = dbm.get_supply_info(int(supply_id))
+    if cancel_type == 'o':
+        status, supply_info = dbm.get_buy_order_info(int(supply_id))
+    else:
+        status, supply_info = dbm.get_supply_info(int(supply_id))
     if status != DatabaseError.Ok:
         _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о предложении')
         return
@@ -375,9 +1138,21 @@ def do_cancel(update: Update, context: CallbackContext, cmd: list, req: str) ->
         else:
             _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Произвести отмену не удалось')
             return
+    elif cancel_type == 'o':
+        status = dbm.cancel_buy_order(int(supply_id), update.callback_query.message.chat.id)
+        if status == DatabaseError.Ok:
+            _send_text(update, req = req, text = 'Отмена заявки на покупку слота {} {} в {} прошла успешно'.format(supply_info['time'], supply_info['date'], supply_info['place_name']))
+        elif status == DatabaseError.RecordUsed:
+            _send_text(update, req = req, text = 'Заявка на покупку слота {} {} в {} уже исполнена. Отменить заявку невозможно'.format(supply_info['time'], supply_info['date'], supply_info['place_name']))
+        else:
+            _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Произвести отмену не удалось')
+        return
     elif cancel_type == 'b':
-        status = dbm.cancel_buy_record(int(supply_id))
+        status, matches = dbm.cancel_buy_record(int(supply_id))
         if status == DatabaseError.Ok:
+            reminders.remove(int(supply_id))
+            # the slot is filled again whatever happens to the messages below
+            _notify_matches(context.bot, matches)
             status, admin_info = dbm.get_user_info_by_nick(supply_info['admin'])
             if status != DatabaseError.Ok:
                 _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о тренере')
@@ -385,7 +1160,7 @@ def do_cancel(update: Update, context: CallbackContext, cmd: list, req: str) ->
 
             text_to_buyer = 'Отмена фиксации слота {} {} в {} прошла успешно'.format(supply_info['time'], supply_info['date'], supply_info['place_name'])
             if len(admin_info) != 0:
-                text_to_seller += '. Сообщение об отмене отправлено тренеру @{} ({})'.format(admin_info['nick'], admin_info['fullname'])
+                text_to_buyer += '. Сообщение об отмене отправлено тренеру @{} ({})'.format(admin_info['nick'], admin_info['fullname'])
             _send_text(update, req = req, text = text_to_buyer)
 
             user_data = update.callback_query.message.chat
@@ -397,7 +1172,6 @@ def do_cancel(update: Update, context: CallbackContext, cmd: list, req: str) ->
 
             if len(admin_info) != 0:
                 context.bot.send_message(admin_info['id'], 'Пользователь @{} ({}) отменил фиксацию слота на {} {} в {}'.format(user_data.username, user_data.full_name, supply_info['time'], supply_info['date'], supply_info['place_name']))
-
             return
         else:
             _send_text(update, req = req, text = 'Возникла непредвиденная ошибка. Произвести отмену не удалось')
@@ -405,41 +1179,243 @@ def do_cancel(update: Update, context: CallbackContext, cmd: list, req: str) ->
 
 #----- status
 
-def _get_status() -> str:
-    status, supplies = dbm.get_status(date_start = datetime.date.today().strftime("%d.%m.%Y"))
+# admin/place_id equal to None mean any. Boards are cached while the order
+# book keeps the market version, without the book they are built every time
+def _get_status(admin: str = None, place_id: int = None) -> list:
+    status, chunks = _build_status(admin, place_id)
+    if status != DatabaseError.Ok:
+        return ['Возникла непредвиденная ошибка. Получить статус не удалось']
+    return chunks
+
+def _build_status(admin: str, place_id: int) -> (DatabaseError, list):
+    date_start = datetime.date.today().strftime("%d.%m.%Y")
+    key = (admin, place_id, date_start)
+    version = dbm.get_market_version()
+    cached = _status_cache.get(key)
+    if version is not None and cached is not None and cached[0] == version:
+        return DatabaseError.Ok, cached[1]
+
+    status, session_ids = dbm.get_scope_session_ids(admin, place_id)
+    if status == DatabaseError.Ok:
+        status, supplies = dbm.get_status(date_start = date_start, session_ids = session_ids)
     if status != DatabaseError.Ok:
-        return 'Возникла непредвиденная ошибка. Получить статус не удалось'
+        return status, []
 
     if len(supplies) == 0:
-        return 'Заявок на бирже нет'
-
-    text = 'Статус:'
-    for place_data in supplies:
-        place_name = place_data['place_name']
-        text += '\n\n{}:'.format(place_name)
-        for session_data in place_data['sessions']:
-            info_prefix = session_data['info_prefix']
-            weekday = session_data['weekday']
-            time = session_data['time']
-            text += '\n   {}:'.format(' '.join([info_prefix, weekday, time]))
-            for date_data in session_data['dates']:
-                date = date_data['date']
-                text += '\n      {}:'.format(date)
-                for supply in date_data['supplies']:
-                    seller_nick = supply['seller']['nick']
-                    seller_fullname = supply['seller']['fullname']
-                    text += '\n         Продавец: @{} ({})'.format(seller_nick, seller_fullname)
-                    if 'buyer' in supply:
-                        buyer_nick = supply['buyer']['nick']
-                        buyer_fullname = supply['buyer']['fullname']
-                        text += '  Покупатель: @{} ({})'.format(buyer_nick, buyer_fullname)
-
-    return text
+        chunks = ['Заявок на бирже нет']
+    else:
+        chunks = renderer.render('status', supplies)
+
+    if version is not None:
+        for stale_key, value in list(_status_cache.items()):
+            if value[0] != version:
+                _status_cache.pop(stale_key, None)
+        _status_cache[key] = (version, chunks)
+    return DatabaseError.Ok, chunks
 
 def status(update: Update) -> None:
-    km = KeyboardManager(update, text = _get_status())
+    km = KeyboardManager(update, text = '')
+    km.set_chunks(_get_status())
     km.update()
 
+#----- status boards
+
+BOARD_MORE = '\n… и другие заявки'
+
+# the board is one message, the lines which do not fit are cut
+def _make_board(chunks: list) -> str:
+    text = chunks[0]
+    if len(chunks) == 1:
+        return text
+    while len(text) + len(BOARD_MORE) > renderer.MESSAGE_LIMIT and '\n' in text:
+        text = text.rsplit('\n', 1)[0]
+    return text + BOARD_MORE
+
+# Returns False if the message cannot be edited anymore (deleted by somebody)
+def _edit_board(bot, group_id: int, message_id: int, text: str) -> bool:
+    try:
+        bot.edit_message_text(text, chat_id = group_id, message_id = message_id)
+    except BadRequest as error:
+        reason = error.message.lower()
+        if 'message is not modified' not in reason:
+            if 'not found' in reason or "can't be edited" in reason:
+                return False
+            raise
+    return True
+
+# /status in a group refreshes its board or posts and pins a new one
+def _show_board(update: Update, context: CallbackContext, message_id: int, chunks: list) -> None:
+    chat_id = update.message.chat.id
+    text = _make_board(chunks)
+    if message_id is not None:
+        try:
+            if _edit_board(context.bot, chat_id, message_id, text):
+                update.message.reply_text('Статус — в закреплённом сообщении', reply_to_message_id = message_id)
+                return
+        except Exception as error:
+            logger.warning('Cannot update status board of group %s. Cause: %s', chat_id, error)
+
+    message = update.message.reply_text(text)
+    try:
+        context.bot.pin_chat_message(chat_id, message.message_id, disable_notification = True)
+    except Exception as error:
+        logger.warning('Cannot pin status board in group %s. Cause: %s', chat_id, error)
+    if dbm.set_group_status_message(chat_id, message.message_id) != DatabaseError.Ok:
+        logger.warning('Cannot save status board of group %s', chat_id)
+
+# a burst of changes gives one refresh: the job is queued by the first change
+# and every change before it runs is covered by it
+def _schedule_boards_refresh() -> None:
+    global _boards_pending
+    if _job_queue is None or _boards_delay <= 0:
+        return
+    with _boards_lock:
+        if _boards_pending:
+            return
+        _boards_pending = True
+    _job_queue.run_once(refresh_boards, _boards_delay)
+
+def refresh_boards(context: CallbackContext) -> None:
+    global _boards_pending
+    with _boards_lock:
+        _boards_pending = False
+
+    status, groups = dbm.get_groups_info()
+    if status != DatabaseError.Ok:
+        logger.warning('Cannot get groups to refresh status boards')
+        return
+
+    # one pipeline run for every scope
+    scope_texts = dict()
+    for group in groups:
+        message_id = group.get('status_message_id')
+        if message_id is None:
+            continue
+        scope = (group.get('admin'), group.get('place_id'))
+        if scope not in scope_texts:
+            status, chunks = _build_status(*scope)
+            scope_texts[scope] = _make_board(chunks) if status == DatabaseError.Ok else None
+        if scope_texts[scope] is None:
+            continue
+        try:
+            if not _edit_board(context.bot, group['id'], message_id, scope_texts[scope]):
+                logger.info('Status board of group %s is gone', group['id'])
+                dbm.set_group_status_message(group['id'], None)
+        except Exception as error:
+            logger.warning('Cannot update status board of group %s. Cause: %s', group['id'], error)
+
+#----- digests & reminders
+
+def send_digests(context: CallbackContext) -> None:
+    status, groups = dbm.get_groups_info()
+    if status != DatabaseError.Ok or len(groups) == 0:
+        return
+
+    # one pipeline run for every scope
+    scope_chunks = dict()
+    for group in groups:
+        scope = (group.get('admin'), group.get('place_id'))
+        if scope not in scope_chunks:
+            scope_chunks[scope] = _get_status(*scope)
+        try:
+            for chunk in scope_chunks[scope]:
+                context.bot.send_message(group['id'], chunk)
+        except Exception as error:
+            logger.warning('Cannot send digest to group %s. Cause: %s', group['id'], error)
+
+# Reminders are sent by the instance which runs the jobs (the leader of a
+# cluster). It loads them from the deals and follows every change of them by
+# the market channel, so buys and cancels of other instances reach it too.
+def _add_reminder(supply_id: int, buyer_id: int, time: str, date: str, place_name: str, skip_overdue: bool = False) -> None:
+    if _job_queue is None:
+        return
+    now = datetime.datetime.now()
+    start_time = utils.session_datetime(date, time)
+    remind_time = start_time - datetime.timedelta(seconds = _reminder_lead)
+    if start_time <= now or (skip_overdue and remind_time <= now):
+        return
+    reminders.push(remind_time, supply_id, {
+        'buyer_id': buyer_id,
+        'text': 'Напоминание: слот {} {} в {} зафиксирован за вами'.format(time, date, place_name)
+    })
+
+def _load_reminders() -> None:
+    reminders.clear()
+
+    status, supplies = dbm.get_closed_supplies(date_start = datetime.date.today().strftime("%d.%m.%Y"))
+    if status != DatabaseError.Ok:
+        logger.warning('Cannot load reminders')
+        return
+
+    for place_data, session_data, date_data, supply in renderer.walk_supplies(supplies):
+        if 'buyer' not in supply:
+            continue
+        # do not repeat reminders after restart
+        _add_reminder(supply['id'], supply['buyer']['id'], session_data['time'], date_data['date'], place_data['place_name'], skip_overdue = True)
+
+# a reminder sent already is not added again, it is overdue
+def _on_supply_changed(supply_id: int, deal: dict) -> None:
+    if _job_queue is None:
+        return
+    if 'buyer' not in deal:
+        reminders.remove(supply_id)
+        return
+
+    status, supply_info = dbm.get_supply_info(supply_id)
+    if status != DatabaseError.Ok:
+        logger.warning('Cannot refresh reminder of supply %s', supply_id)
+        return
+    _add_reminder(supply_id, deal['buyer'], supply_info['time'], supply_info['date'], supply_info['place_name'], skip_overdue = True)
+
+def send_reminders(context: CallbackContext) -> None:
+    for reminder in reminders.pop_due(datetime.datetime.now()):
+        try:
+            context.bot.send_message(reminder['buyer_id'], reminder['text'])
+        except Exception as error:
+            logger.warning('Cannot send reminder to user %s. Cause: %s', reminder['buyer_id'], error)
+
+#----- session occurrences
+
+def generate_occurrences(context: CallbackContext) -> None:
+    if dbm.generate_occurrences() != DatabaseError.Ok:
+        logger.warning('Cannot generate session occurrences')
+    # wants of past dates go together with them
+    logger.info('Wants expired: %s', dbm.prune_wants())
+
+#----- order book
+
+def reconcile_order_book(context: CallbackContext) -> None:
+    if dbm.reconcile_order_book() != DatabaseError.Ok:
+        logger.warning('Cannot reconcile order book')
+
+#----- conversation state
+
+def purge_states(context: CallbackContext) -> None:
+    logger.info('Conversation states expired: %s', _state_store.purge())
+
+#----- archive
+
+def archive_records(context: CallbackContext) -> None:
+    status, counts = dbm.archive_records(days = context.job.context)
+    if status != DatabaseError.Ok:
+        logger.warning('Cannot archive records')
+        return
+    logger.info('Archived %s sell records and %s buy records', counts['sell_records'], counts['buy_records'])
+
+#----- analytics
+
+STATS_DAYS = 28
+
+def _percent(part: int, total: int) -> int:
+    return round(part * 100 / total) if total != 0 else 0
+
+def refresh_analytics(context: CallbackContext) -> None:
+    status, since = dbm.refresh_analytics()
+    if status != DatabaseError.Ok:
+        logger.warning('Cannot refresh trade analytics')
+        return
+    logger.info('Trade analytics refreshed from %s', since or 'the beginning')
+
 #----- about
 
 def about(update: Update) -> None:
@@ -447,14 +1423,9 @@ def about(update: Update) -> None:
 
 #----- start
 
-def common_start(update: Update, is_start: bool) -> None:
-    km = KeyboardManager(update, text = 'Чего изволите?')
-    km.add_button('Продать',  'sell')
-    km.add_button('Купить',   'buy')
-    km.add_button('Отменить', 'cancel')
-    km.add_button('Статус',   'status')
-    km.add_button('О боте',   'about')
-    km.set_show_button_home(False)
+def common_start(update: Update, is_start: bool, text: str = 'Чего изволите?') -> None:
+    km = KeyboardManager(update, text = text)
+    km.set_static_keyboard(MAIN_MENU_KEYBOARD)
     km.set_is_first_msg(is_start)
     km.update()
 
@@ -466,7 +1437,25 @@ def restart(update: Update, context: CallbackContext) -> None:
 def buy_actions(update: Update, context: CallbackContext, req: str) -> None:
     cmd = req.split(',')
     if len(cmd) == 1:
-        choose_seller(update, req)
+        search_place(update, req)
+    elif cmd[1] == 'o' and len(cmd) == 3:
+        choose_order_date(update, cmd, req)
+    elif cmd[1] == 'o' and len(cmd) == 4:
+        choose_order_limit(update, cmd, req)
+    elif cmd[1] == 'o' and len(cmd) == 5:
+        do_order(update, context, cmd, req)
+    elif cmd[1] == 'w' and len(cmd) == 5:
+        subscribe(update, cmd, req)
+    elif cmd[1] == 's' and len(cmd) == 3:
+        search_session(update, cmd, req)
+    elif cmd[1] == 'd' and len(cmd) == 4:
+        search_period(update, cmd, req)
+    elif cmd[1] == 'l' and len(cmd) in [5, 6]:
+        choose_seller(update, cmd, req)
+    elif cmd[1] == 'l' and len(cmd) == 7:
+        confirm_buy(update, cmd, req)
+    elif cmd[1] == 'l' and len(cmd) == 8:
+        send_buy_confirm(update, context, cmd, req)
     elif len(cmd) == 2:
         confirm_buy(update, cmd, req)
     elif len(cmd) == 3:
@@ -485,18 +1474,22 @@ def cancel_actions(update: Update, context: CallbackContext, req: str) -> None:
     else:
         logger.warning('Unknown command: %s', req)
 
-def sell_actions(update: Update, req: str) -> None:
+def sell_actions(update: Update, context: CallbackContext, req: str) -> None:
     cmd = req.split(',')
-    if len(cmd) == 1:
+    if len(cmd) == 1 and _dialog is not None:
+        show_dialog_node(update, _dialog.root)
+    elif len(cmd) == 1:
         choose_place(update, req)
     elif len(cmd) == 2:
         choose_session(update, place_id = cmd[1], req = req)
     elif len(cmd) == 3:
         choose_date(update, session_id = cmd[2], req = req)
     elif len(cmd) == 4:
-        confirm_sell(update, cmd, req)
+        choose_price(update, cmd, req)
     elif len(cmd) == 5:
-        do_sell(update, cmd, req)
+        confirm_sell(update, cmd, req)
+    elif len(cmd) == 6:
+        do_sell(update, context, cmd, req)
     else:
         logger.warning('Unknown command: %s', req)
 
@@ -555,6 +1548,7 @@ def do_reject(update: Update, context: CallbackContext, supply_id: int, buyer_id
         _send_text(update, text = 'Возникла непредвиденная ошибка. Не удалось получить данные о покупателе')
         return
 
+    dbm.journal_event('buy_reject', sell_id = supply_id, user_id = buyer_id, peer_id = supply_info['seller_id'])
     _send_text(update, text = 'Предложение фиксации слота {} {} в {} для @{} ({}) было отменено'.format(supply_info['time'], supply_info['date'], supply_info['place_name'], buyer_info['nick'], buyer_info['fullname']))
 
     user_data = update.callback_query.message.chat
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Trade analytics: daily rollups per session (offers, sold, resold, canceled,
+# time to buy) kept in trade_daily_stats. A training can change until it has
+# passed, so refresh recomputes only the days from analytics_state.final_before
+# on and moves that mark; reports read the rollups and never touch the records.
+
+from database.error import DatabaseError
+from database.internal import DatabaseInternal, ReturnType
+
+import datetime
+
+# a day is final when late cancels are not expected anymore
+FINAL_AFTER_DAYS = 2
+# the mark before the first refresh, dates are stored as YYYY.MM.DD
+FIRST_DAY = '0001.01.01'
+
+QUERY_CREATE_TABLE_TRADE_DAILY_STATS = (
+    'CREATE TABLE trade_daily_stats ('
+        'trade_date DATE NOT NULL, '
+        'session_id INT NOT NULL REFERENCES sessions (id), '
+        'offers INT NOT NULL, '
+        'sold INT NOT NULL, '
+        'resold INT NOT NULL, '
+        'canceled INT NOT NULL, '
+        'buy_seconds DOUBLE PRECISION NOT NULL, '
+        'PRIMARY KEY (trade_date, session_id)'
+    ')'
+)
+
+QUERY_CREATE_TABLE_ANALYTICS_STATE = (
+    'CREATE TABLE analytics_state ('
+        'name VARCHAR (64) PRIMARY KEY, '
+        'final_before VARCHAR (10) NOT NULL'
+    ')'
+)
+
+# archived buys are found by id, see QUERY_REFRESH_TRADE_DAILY_STATS
+QUERY_CREATE_INDEX_BUY_RECORDS_HISTORY = 'CREATE INDEX IF NOT EXISTS buy_records_history_id_idx ON buy_records_history (id)'
+
+QUERY_SELECT_FINAL_BEFORE = 'SELECT final_before FROM analytics_state WHERE name = \'trade_daily_stats\''
+
+# One execution, one transaction: rollups of the days from %(since)s on are
+# rebuilt from live and archived records, then the mark is moved. Buys are
+# looked up by the ids of those offers only, so the cost follows the window.
+# resold - offers of a slot the seller has bought before
+QUERY_REFRESH_TRADE_DAILY_STATS = (
+    'DELETE FROM trade_daily_stats WHERE trade_date >= to_date(%(since)s, \'YYYY.MM.DD\'); '
+    'WITH sells AS ('
+        'SELECT id, record_time, user_id, session_id, trade_in_date, buy_id, canceled FROM sell_records WHERE trade_in_date >= %(since)s '
+        'UNION ALL '
+        'SELECT id, record_time, user_id, session_id, trade_in_date, buy_id, canceled FROM sell_records_history WHERE trade_in_date >= %(since)s'
+    '), buys AS ('
+        'SELECT id, record_time, user_id, canceled FROM buy_records WHERE id IN (SELECT buy_id FROM sells) '
+        'UNION ALL '
+        'SELECT id, record_time, user_id, canceled FROM buy_records_history WHERE id IN (SELECT buy_id FROM sells)'
+    '), deals AS ('
+        'SELECT sells.*, buys.id IS NOT NULL AND NOT buys.canceled AS is_sold, buys.record_time AS buy_time, buys.user_id AS buyer '
+        'FROM sells LEFT JOIN buys ON buys.id = sells.buy_id'
+    ') '
+    'INSERT INTO trade_daily_stats (trade_date, session_id, offers, sold, resold, canceled, buy_seconds) '
+    'SELECT to_date(deals.trade_in_date, \'YYYY.MM.DD\'), deals.session_id, COUNT(*), '
+        'COUNT(*) FILTER (WHERE deals.is_sold), '
+        'COUNT(*) FILTER (WHERE EXISTS ('
+            'SELECT 1 FROM deals bought WHERE bought.is_sold AND bought.buyer = deals.user_id '
+            'AND bought.session_id = deals.session_id AND bought.trade_in_date = deals.trade_in_date AND bought.buy_time < deals.record_time'
+        ')), '
+        'COUNT(*) FILTER (WHERE deals.canceled), '
+        'COALESCE(SUM(EXTRACT(EPOCH FROM deals.buy_time - deals.record_time)) FILTER (WHERE deals.is_sold), 0) '
+    'FROM deals GROUP BY 1, 2; '
+    'INSERT INTO analytics_state (name, final_before) VALUES (\'trade_daily_stats\', %(final_before)s) '
+    'ON CONFLICT (name) DO UPDATE SET final_before = EXCLUDED.final_before'
+)
+
+QUERY_SELECT_REPORT = (
+    'SELECT places.name, sessions.weekday, sessions.time, SUM(stats.offers), SUM(stats.sold), SUM(stats.resold), '
+        'SUM(stats.canceled), SUM(stats.buy_seconds) '
+    'FROM trade_daily_stats stats '
+    'INNER JOIN sessions ON sessions.id = stats.session_id '
+    'INNER JOIN places ON places.id = sessions.place_id '
+    'WHERE sessions.admin = %s AND stats.trade_date >= %s '
+    'GROUP BY places.name, sessions.id, sessions.weekday, sessions.time '
+    'ORDER BY places.name, sessions.id'
+)
+
+def _reverse_date(date: datetime.date) -> str:
+    return date.strftime('%Y.%m.%d')
+
+class Analytics(DatabaseInternal):
+    def __init__(self, url: str, read_url: str = None, max_replica_lag: float = 10.0):
+        super().__init__(url, read_url, max_replica_lag)
+
+    def init_tables(self) -> DatabaseError:
+        tables = [
+            ('trade_daily_stats', QUERY_CREATE_TABLE_TRADE_DAILY_STATS),
+            ('analytics_state', QUERY_CREATE_TABLE_ANALYTICS_STATE)
+        ]
+        for name, query_format in tables:
+            status, exists = self.table_exists(name = name, primary = True)
+            if status != DatabaseError.Ok:
+                return status
+            if not exists:
+                status = self.run(query_format, [], ReturnType.NONE, need_commit = True)
+                if status != DatabaseError.Ok:
+                    return status
+        return self.run(QUERY_CREATE_INDEX_BUY_RECORDS_HISTORY, [], ReturnType.NONE, need_commit = True)
+
+    # Returns (status, first recomputed day, None - all history)
+    def refresh(self, today: datetime.date) -> (DatabaseError, str):
+        status, rows = self.run(QUERY_SELECT_FINAL_BEFORE, [], ReturnType.ALL_ROWS, need_commit = False, primary = True)
+        if status != DatabaseError.Ok:
+            return status, None
+
+        since = rows[0][0] if len(rows) != 0 else FIRST_DAY
+        final_before = max(since, _reverse_date(today - datetime.timedelta(FINAL_AFTER_DAYS)))
+        status = self.run(QUERY_REFRESH_TRADE_DAILY_STATS, {'since': since, 'final_before': final_before}, ReturnType.NONE, need_commit = True)
+        return status, None if since == FIRST_DAY else since
+
+    # sessions of the admin from date_start on: place_name, weekday, time,
+    # offers, sold, resold, canceled, buy_hours (mean time to buy or None)
+    def get_report(self, admin: str, date_start: datetime.date) -> (DatabaseError, list):
+        status, rows = self.run(QUERY_SELECT_REPORT, [admin, date_start], ReturnType.ALL_ROWS, need_commit = False)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        report = []
+        for place_name, weekday, time, offers, sold, resold, canceled, buy_seconds in rows:
+            report.append({
+                'place_name': place_name,
+                'weekday': weekday,
+                'time': time,
+                'offers': int(offers),
+                'sold': int(sold),
+                'resold': int(resold),
+                'canceled': int(canceled),
+                'buy_hours': None if sold == 0 else float(buy_seconds) / sold / 3600
+            })
+        return DatabaseError.Ok, report
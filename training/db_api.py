@@ -2,7 +2,9 @@
 
 from database.error import DatabaseError
 from database.internal import DatabaseInternal, ReturnType
+from database.records import Place, SellRecord, Session, Supply, User
 
+import datetime
 import logging
 
 logger = logging.getLogger(__name__)
@@ -39,6 +41,17 @@ QUERY_CREATE_TABLE_SESSIONS = (
     ')'
 )
 
+# concrete trainings of sessions, generated ahead, see QUERY_GENERATE_OCCURRENCES
+QUERY_CREATE_TABLE_SESSION_OCCURRENCES = (
+    'CREATE TABLE session_occurrences ('
+        'id serial PRIMARY KEY, '
+        'session_id INT NOT NULL REFERENCES sessions (id), '
+        'occurrence_date DATE NOT NULL, '
+        'starts_at TIMESTAMP NOT NULL, '
+        'UNIQUE (session_id, occurrence_date)'
+    ')'
+)
+
 QUERY_CREATE_TABLE_BUY_RECORDS = (
     'CREATE TABLE buy_records ('
         'id serial PRIMARY KEY, '
@@ -56,6 +69,7 @@ QUERY_CREATE_TABLE_SELL_RECORDS = (
         'user_id BIGINT NOT NULL REFERENCES users (id), '
         'session_id INT NOT NULL REFERENCES sessions (id), '
         'trade_in_date VARCHAR (10) NOT NULL, '
+        'occurrence_id INT REFERENCES session_occurrences (id), '
         'price INT, '
         'buy_id INT REFERENCES buy_records (id), '
         'canceled BOOLEAN NOT NULL DEFAULT FALSE, '
@@ -63,12 +77,239 @@ QUERY_CREATE_TABLE_SELL_RECORDS = (
     ')'
 )
 
+# standing orders of buyers, filled by DatabaseManager matching. sell_id has no
+# reference since filled sell_records are archived
+QUERY_CREATE_TABLE_BUY_ORDERS = (
+    'CREATE TABLE buy_orders ('
+        'id serial PRIMARY KEY, '
+        'record_time TIMESTAMP NOT NULL DEFAULT NOW(), '
+        'user_id BIGINT NOT NULL REFERENCES users (id), '
+        'session_id INT NOT NULL REFERENCES sessions (id), '
+        'trade_in_date VARCHAR (10) NOT NULL, '
+        'occurrence_id INT REFERENCES session_occurrences (id), '
+        'price_limit INT NOT NULL, '
+        'sell_id INT, '
+        'fill_time TIMESTAMP, '
+        'canceled BOOLEAN NOT NULL DEFAULT FALSE, '
+        'cancel_time TIMESTAMP'
+    ')'
+)
+
+# subscriptions of buyers to new offers. place_id/session_id equal to NULL mean
+# any, date_end equal to NULL means no limit
+QUERY_CREATE_TABLE_WANTS = (
+    'CREATE TABLE wants ('
+        'id serial PRIMARY KEY, '
+        'record_time TIMESTAMP NOT NULL DEFAULT NOW(), '
+        'user_id BIGINT NOT NULL REFERENCES users (id), '
+        'place_id INT REFERENCES places (id), '
+        'session_id INT REFERENCES sessions (id), '
+        'date_start VARCHAR (10) NOT NULL, '
+        'date_end VARCHAR (10), '
+        'canceled BOOLEAN NOT NULL DEFAULT FALSE, '
+        'cancel_time TIMESTAMP'
+    ')'
+)
+
+QUERY_SELECT_ACTIVE_WANTS = (
+    'SELECT id, user_id, place_id, session_id, date_start, date_end FROM wants '
+    'WHERE canceled = FALSE AND (date_end IS NULL OR date_end >= %s)'
+)
+
+QUERY_CREATE_TABLE_BUY_RECORDS_HISTORY = (
+    'CREATE TABLE buy_records_history ('
+        'LIKE buy_records, '
+        'archive_time TIMESTAMP NOT NULL DEFAULT NOW()'
+    ')'
+)
+
+QUERY_CREATE_TABLE_SELL_RECORDS_HISTORY = (
+    'CREATE TABLE sell_records_history ('
+        'LIKE sell_records, '
+        'archive_time TIMESTAMP NOT NULL DEFAULT NOW()'
+    ')'
+)
+
+# Rows are moved in small batches, each batch is one statement (and one
+# transaction). Rows locked by live traffic are skipped and picked up by the
+# next run.
+# column order differs between fresh and migrated databases, so columns are listed
+SELL_RECORDS_COLUMNS = 'id, record_time, user_id, session_id, trade_in_date, occurrence_id, price, buy_id, canceled, cancel_time'
+BUY_RECORDS_COLUMNS = 'id, record_time, user_id, canceled, cancel_time'
+
+QUERY_ARCHIVE_SELL_RECORDS = (
+    'WITH moved AS ('
+        'DELETE FROM sell_records WHERE id IN ('
+            'SELECT id FROM sell_records '
+            'WHERE trade_in_date < %s '
+                'OR (canceled AND cancel_time < NOW() - %s * INTERVAL \'1 day\') '
+            'ORDER BY id LIMIT %s '
+            'FOR UPDATE SKIP LOCKED'
+        ') RETURNING *'
+    '), archived AS ('
+        'INSERT INTO sell_records_history (' + SELL_RECORDS_COLUMNS + ') '
+        'SELECT ' + SELL_RECORDS_COLUMNS + ' FROM moved RETURNING 1'
+    ') '
+    'SELECT COUNT(*) FROM archived'
+)
+
+# buy_records which are still referenced by sell_records stay in place
+QUERY_ARCHIVE_BUY_RECORDS = (
+    'WITH moved AS ('
+        'DELETE FROM buy_records WHERE id IN ('
+            'SELECT id FROM buy_records '
+            'WHERE record_time < NOW() - %s * INTERVAL \'1 day\' '
+                'AND NOT EXISTS (SELECT 1 FROM sell_records WHERE sell_records.buy_id = buy_records.id) '
+            'ORDER BY id LIMIT %s '
+            'FOR UPDATE SKIP LOCKED'
+        ') RETURNING *'
+    '), archived AS ('
+        'INSERT INTO buy_records_history (' + BUY_RECORDS_COLUMNS + ') '
+        'SELECT ' + BUY_RECORDS_COLUMNS + ' FROM moved RETURNING 1'
+    ') '
+    'SELECT COUNT(*) FROM archived'
+)
+
+# Whole trade history, live and archived records, oldest first. buy_* columns
+# are NULL for supplies nobody has bought
+EXPORT_COLUMNS = ['sell_id', 'sell_time', 'trade_in_date', 'place', 'weekday', 'time', 'seller_nick', 'seller_fullname', 'price',
+                  'sell_canceled', 'sell_cancel_time', 'buy_time', 'buyer_nick', 'buyer_fullname', 'buy_canceled', 'archived']
+
+QUERY_EXPORT_HISTORY = (
+    'SELECT s.id, s.record_time, s.trade_in_date, places.name, sessions.weekday, sessions.time, '
+        'sellers.nick, sellers.fullname, s.price, s.canceled, s.cancel_time, '
+        'b.record_time, buyers.nick, buyers.fullname, b.canceled, s.archived '
+    'FROM ('
+        'SELECT id, record_time, user_id, session_id, trade_in_date, price, buy_id, canceled, cancel_time, FALSE AS archived FROM sell_records '
+        'UNION ALL '
+        'SELECT id, record_time, user_id, session_id, trade_in_date, price, buy_id, canceled, cancel_time, TRUE FROM sell_records_history'
+    ') s '
+    'INNER JOIN sessions ON sessions.id = s.session_id '
+    'INNER JOIN places ON places.id = sessions.place_id '
+    'INNER JOIN users sellers ON sellers.id = s.user_id '
+    'LEFT JOIN ('
+        'SELECT id, record_time, user_id, canceled FROM buy_records '
+        'UNION ALL '
+        'SELECT id, record_time, user_id, canceled FROM buy_records_history'
+    ') b ON b.id = s.buy_id '
+    'LEFT JOIN users buyers ON buyers.id = b.user_id '
+    'WHERE %(admin)s IS NULL OR sessions.admin = %(admin)s '
+    'ORDER BY s.id'
+)
+
+# ISODOW: 1 - monday, ..., 7 - sunday
+QUERY_GENERATE_OCCURRENCES = (
+    'INSERT INTO session_occurrences (session_id, occurrence_date, starts_at) '
+    'SELECT sessions.id, day::date, day::date + sessions.time::time '
+    'FROM sessions '
+    'CROSS JOIN generate_series(CURRENT_DATE::timestamp, (CURRENT_DATE + %s * 7)::timestamp, INTERVAL \'1 day\') AS day '
+    'WHERE EXTRACT(ISODOW FROM day) = array_position(ARRAY[\'ПН\', \'ВТ\', \'СР\', \'ЧТ\', \'ПТ\', \'СБ\', \'ВС\'], sessions.weekday::text) '
+    'ON CONFLICT (session_id, occurrence_date) DO NOTHING'
+)
+
+QUERY_LINK_SELL_RECORDS_TO_OCCURRENCES = (
+    'UPDATE sell_records SET occurrence_id = session_occurrences.id '
+    'FROM session_occurrences '
+    'WHERE sell_records.occurrence_id IS NULL '
+        'AND session_occurrences.session_id = sell_records.session_id '
+        'AND session_occurrences.occurrence_date = to_date(sell_records.trade_in_date, \'YYYY.MM.DD\')'
+)
+
+MARKET_CHANNEL = 'market_changes'
+
+# payload: {"table": ..., "op": ..., "id": ..., "sent_at": epoch seconds}
+QUERY_CREATE_FUNCTION_NOTIFY_MARKET_CHANGE = (
+    'CREATE OR REPLACE FUNCTION notify_market_change() RETURNS trigger AS $$ '
+    'DECLARE '
+        'row_id INT; '
+    'BEGIN '
+        'IF TG_OP = \'DELETE\' THEN row_id := OLD.id; ELSE row_id := NEW.id; END IF; '
+        'PERFORM pg_notify(\'' + MARKET_CHANNEL + '\', json_build_object('
+            '\'table\', TG_TABLE_NAME, '
+            '\'op\', TG_OP, '
+            '\'id\', row_id, '
+            '\'sent_at\', EXTRACT(EPOCH FROM clock_timestamp())'
+        ')::text); '
+        'RETURN NULL; '
+    'END; '
+    '$$ LANGUAGE plpgsql'
+)
+
+def _make_notify_trigger_query(table: str) -> str:
+    return (
+        'DROP TRIGGER IF EXISTS {0}_notify ON {0}; '
+        'CREATE TRIGGER {0}_notify AFTER INSERT OR UPDATE OR DELETE ON {0} '
+        'FOR EACH ROW EXECUTE PROCEDURE notify_market_change()'
+    ).format(table)
+
+# one statement: the offer and the order are locked, the buy record is created
+# only when both are still opened.
+# Returns (offer is opened, order is opened, filled)
+QUERY_FILL_BUY_ORDER = (
+    'WITH offer AS ('
+        'SELECT id FROM sell_records WHERE id = %s AND buy_id IS NULL AND canceled = FALSE FOR UPDATE'
+    '), buy_order AS ('
+        'SELECT id, user_id FROM buy_orders o WHERE id = %s AND sell_id IS NULL AND canceled = FALSE AND NOT EXISTS ('
+            'SELECT 1 FROM sell_records s JOIN buy_records b ON b.id = s.buy_id '
+            'WHERE s.session_id = o.session_id AND s.trade_in_date = o.trade_in_date AND s.canceled = FALSE '
+            'AND b.user_id = o.user_id AND b.canceled = FALSE'
+        ') FOR UPDATE'
+    '), buy AS ('
+        'INSERT INTO buy_records (user_id) SELECT buy_order.user_id FROM buy_order, offer RETURNING id'
+    '), sold AS ('
+        'UPDATE sell_records SET buy_id = buy.id FROM buy WHERE sell_records.id = %s RETURNING sell_records.id'
+    '), filled AS ('
+        'UPDATE buy_orders SET sell_id = sold.id, fill_time = NOW() FROM sold WHERE buy_orders.id = %s RETURNING buy_orders.id'
+    ') '
+    'SELECT (SELECT COUNT(*) FROM offer), (SELECT COUNT(*) FROM buy_order), (SELECT COUNT(*) FROM filled)'
+)
+
+# a buyer with a slot needs no order for the same training
+QUERY_CANCEL_USER_BUY_ORDERS = (
+    'UPDATE buy_orders SET canceled = TRUE, cancel_time = NOW() '
+    'WHERE trade_in_date = %s AND session_id = %s AND user_id = %s AND sell_id IS NULL AND canceled = FALSE '
+    'RETURNING id'
+)
+
+MIGRATIONS = [
+    'ALTER TABLE sell_records ADD COLUMN IF NOT EXISTS occurrence_id INT REFERENCES session_occurrences (id)',
+    'ALTER TABLE sell_records_history ADD COLUMN IF NOT EXISTS occurrence_id INT',
+    'ALTER TABLE groups ADD COLUMN IF NOT EXISTS admin VARCHAR (255)',
+    'ALTER TABLE groups ADD COLUMN IF NOT EXISTS place_id INT REFERENCES places (id)',
+    'ALTER TABLE groups ADD COLUMN IF NOT EXISTS status_message_id BIGINT',
+]
+
+# opened offers are searched by session and date range
+QUERY_CREATE_INDEX_SELL_RECORDS_OPENED = (
+    'CREATE INDEX IF NOT EXISTS sell_records_opened_idx '
+    'ON sell_records (session_id, trade_in_date) '
+    'WHERE canceled = FALSE AND buy_id IS NULL'
+)
+
+# id equals telegram chat id; admin/place_id - scope of the status board,
+# NULL means all coaches/places; status_message_id - pinned status board
+QUERY_CREATE_TABLE_GROUPS = (
+    'CREATE TABLE groups ('
+        'id BIGINT PRIMARY KEY, '
+        'title VARCHAR (255), '
+        'admin VARCHAR (255), '
+        'place_id INT REFERENCES places (id), '
+        'status_message_id BIGINT'
+    ')'
+)
+
+# a group bound to a coach is rebound or unbound by this coach only
+QUERY_SET_GROUP_SCOPE = (
+    'UPDATE groups SET admin = %s, place_id = %s '
+    'WHERE id = %s AND (admin IS NULL OR admin = %s) RETURNING id'
+)
+
 class DatabaseAPI(DatabaseInternal):
-    def __init__(self, url: str):
-        super().__init__(url)
+    def __init__(self, url: str, read_url: str = None, max_replica_lag: float = 10.0):
+        super().__init__(url, read_url, max_replica_lag)
 
     def _check_and_create_table(self, table_name: str, create_query: str) -> DatabaseError:
-        status, exists = self.table_exists(name = table_name)
+        status, exists = self.table_exists(name = table_name, primary = True)
         if status != DatabaseError.Ok:
             return status
         if not exists:
@@ -82,21 +323,46 @@ class DatabaseAPI(DatabaseInternal):
             {'name':'users',        'query':QUERY_CREATE_TABLE_USERS},
             {'name':'places',       'query':QUERY_CREATE_TABLE_PLACES},
             {'name':'sessions',     'query':QUERY_CREATE_TABLE_SESSIONS},
+            {'name':'session_occurrences', 'query':QUERY_CREATE_TABLE_SESSION_OCCURRENCES},
             {'name':'buy_records',  'query':QUERY_CREATE_TABLE_BUY_RECORDS},
             {'name':'sell_records', 'query':QUERY_CREATE_TABLE_SELL_RECORDS},
+            {'name':'groups',       'query':QUERY_CREATE_TABLE_GROUPS},
+            {'name':'buy_orders',   'query':QUERY_CREATE_TABLE_BUY_ORDERS},
+            {'name':'wants',        'query':QUERY_CREATE_TABLE_WANTS},
+            {'name':'buy_records_history',  'query':QUERY_CREATE_TABLE_BUY_RECORDS_HISTORY},
+            {'name':'sell_records_history', 'query':QUERY_CREATE_TABLE_SELL_RECORDS_HISTORY},
         ]
         for table in tables:
             status = self._check_and_create_table(table['name'], table['query'])
             if status != DatabaseError.Ok:
                 return status
 
+        indexes = [
+            QUERY_CREATE_INDEX_SELL_RECORDS_OPENED,
+            'CREATE INDEX IF NOT EXISTS sell_records_occurrence_idx ON sell_records (occurrence_id)',
+            'CREATE INDEX IF NOT EXISTS buy_orders_opened_idx ON buy_orders (trade_in_date) WHERE canceled = FALSE AND sell_id IS NULL',
+        ]
+        triggers = [
+            QUERY_CREATE_FUNCTION_NOTIFY_MARKET_CHANGE,
+            _make_notify_trigger_query('sell_records'),
+            _make_notify_trigger_query('buy_records'),
+            _make_notify_trigger_query('sessions'),
+            _make_notify_trigger_query('places'),
+            _make_notify_trigger_query('buy_orders'),
+            _make_notify_trigger_query('wants'),
+        ]
+        for query_format in MIGRATIONS + indexes + triggers:
+            status = self.run(query_format, [], ReturnType.NONE, need_commit = True)
+            if status != DatabaseError.Ok:
+                return status
+
         return DatabaseError.Ok
 
     #----- Config
 
     # !!! Пока что только логика init
     def update_data(self, data: list) -> DatabaseError:
-        status, places = self.get_all_places_info()
+        status, places = self.get_all_places_info(primary = True)
         if status != DatabaseError.Ok:
             return status
 
@@ -142,7 +408,8 @@ class DatabaseAPI(DatabaseInternal):
                             'place_id': place_id,
                             'weekday': schedule['weekday'],
                             'time': schedule['time']
-                        }
+                        },
+                        primary = True
                     )
                     if status != DatabaseError.Ok:
                         return status
@@ -163,10 +430,12 @@ class DatabaseAPI(DatabaseInternal):
 
     #----- places
 
-    def get_all_places_info(self) -> (DatabaseError, list):
+    def get_all_places_info(self, primary: bool = False) -> (DatabaseError, list):
         return self.select(
             get_fields = ['id', 'name'],
-            table = 'places'
+            table = 'places',
+            primary = primary,
+            row_type = Place
         )
 
     def get_place_info(self, place_id: int) -> (DatabaseError, dict):
@@ -185,7 +454,8 @@ class DatabaseAPI(DatabaseInternal):
         status, places_info = self.select(
             get_fields = ['id', 'name'],
             table = 'places',
-            wheres = {'id': place_ids}
+            wheres = {'id': place_ids},
+            row_type = Place
         )
 
         if status != DatabaseError.Ok or len(places_info) == 0:
@@ -199,7 +469,8 @@ class DatabaseAPI(DatabaseInternal):
         return self.select(
             get_fields = ['id', 'weekday', 'time', 'info_prefix'],
             table = 'sessions',
-            wheres = {'place_id': place_id}
+            wheres = {'place_id': place_id},
+            row_type = Session
         )
 
     def get_session_info(self, session_id: int) -> (DatabaseError, dict):
@@ -214,11 +485,19 @@ class DatabaseAPI(DatabaseInternal):
 
         return status, sessions_info[0]
 
+    def get_all_sessions_info(self) -> (DatabaseError, list):
+        return self.select(
+            get_fields = ['id', 'admin', 'place_id', 'weekday', 'time', 'info_prefix'],
+            table = 'sessions',
+            row_type = Session
+        )
+
     def get_sessions_info(self, session_ids: list) -> (DatabaseError, list):
         status, sessions_info = self.select(
             get_fields = ['id', 'place_id', 'weekday', 'time', 'info_prefix'],
             table = 'sessions',
-            wheres = {'id': session_ids}
+            wheres = {'id': session_ids},
+            row_type = Session
         )
 
         if status != DatabaseError.Ok or len(sessions_info) == 0:
@@ -226,13 +505,60 @@ class DatabaseAPI(DatabaseInternal):
 
         return status, sessions_info
 
+    #----- session_occurrences
+
+    def generate_occurrences(self, weeks: int) -> DatabaseError:
+        status = self.run(QUERY_GENERATE_OCCURRENCES, [weeks], ReturnType.NONE, need_commit = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        return self.run(QUERY_LINK_SELL_RECORDS_TO_OCCURRENCES, [], ReturnType.NONE, need_commit = True)
+
+    # trainings which start after start_after
+    def get_occurrences(self, session_id: int, start_after: datetime.datetime, count: int) -> (DatabaseError, list):
+        status, occurrences = self.select(
+            get_fields = ['id', 'occurrence_date'],
+            table = 'session_occurrences',
+            wheres = {
+                'session_id': session_id,
+                'starts_at': {
+                    'sign': '>',
+                    'value': start_after
+                }
+            },
+            order_by = 'starts_at',
+            limit = count
+        )
+
+        if status != DatabaseError.Ok:
+            return status, []
+
+        return status, [{'id': occurrence['id'], 'date': occurrence['occurrence_date'].strftime("%d.%m.%Y")} for occurrence in occurrences]
+
+    def get_occurrence_info(self, occurrence_id: int) -> (DatabaseError, dict):
+        status, occurrences = self.select(
+            get_fields = ['id', 'session_id', 'occurrence_date'],
+            table = 'session_occurrences',
+            wheres = {'id': occurrence_id}
+        )
+
+        if status != DatabaseError.Ok or len(occurrences) == 0:
+            return status, {}
+
+        return status, {
+            'id': occurrences[0]['id'],
+            'session_id': occurrences[0]['session_id'],
+            'date': occurrences[0]['occurrence_date'].strftime("%d.%m.%Y")
+        }
+
     #----- sell_records
 
     def get_sell_record(self, record_id: int) -> (DatabaseError, dict):
         status, sell_records = self.select(
-            get_fields = ['id', 'user_id', 'session_id', 'trade_in_date'],
+            get_fields = ['id', 'user_id', 'session_id', 'trade_in_date', 'price'],
             table = 'sell_records',
-            wheres = {'id': record_id}
+            wheres = {'id': record_id},
+            row_type = SellRecord
         )
 
         if status != DatabaseError.Ok or len(sell_records) == 0:
@@ -243,6 +569,63 @@ class DatabaseAPI(DatabaseInternal):
 
         return status, sell_records[0]
 
+    # current state of one supply in the form of get_opened_deals/get_closed_deals,
+    # {} when it is not on the market anymore
+    def get_deal(self, record_id: int, date_start: str) -> (DatabaseError, dict):
+        status, deals = self.select(
+            get_fields = {
+                'sell_records.id': 'id',
+                'sell_records.user_id': 'seller',
+                'buy_records.user_id': 'buyer',
+                'buy_records.canceled': 'buy_canceled',
+                'sell_records.trade_in_date': 'trade_in_date',
+                'sell_records.session_id': 'session_id',
+                'sell_records.price': 'price'
+            },
+            table = 'sell_records',
+            joins = [
+                {
+                    'type': 'LEFT',
+                    'table': 'buy_records',
+                    'on': {
+                        'buy_records.id': 'sell_records.buy_id'
+                    }
+                }
+            ],
+            wheres = {
+                'sell_records.id': record_id,
+                'sell_records.canceled': False,
+                'sell_records.trade_in_date': {
+                    'sign': '>=',
+                    'value': _reverse_date(date_start)
+                }
+            },
+            primary = True
+        )
+
+        if status != DatabaseError.Ok or len(deals) == 0:
+            return status, {}
+
+        deal = deals[0]
+        deal['trade_in_date'] = _reverse_date(deal['trade_in_date'])
+        buy_canceled = deal.pop('buy_canceled')
+        if deal['buyer'] is None or buy_canceled:
+            del deal['buyer']
+        return status, deal
+
+    def get_sell_record_ids_by_buy_id(self, buy_id: int) -> (DatabaseError, list):
+        status, sell_records = self.select(
+            get_fields = ['id'],
+            table = 'sell_records',
+            wheres = {'buy_id': buy_id},
+            primary = True
+        )
+
+        if status != DatabaseError.Ok:
+            return status, []
+
+        return status, [sell_record['id'] for sell_record in sell_records]
+
     def sell_record_exists(self, date: str, session_id: int, user_id: int) -> (DatabaseError, bool):
         return self.record_exists(
             table = 'sell_records',
@@ -251,19 +634,35 @@ class DatabaseAPI(DatabaseInternal):
                 'session_id': session_id,
                 'user_id': user_id,
                 'canceled': False
-            }
+            },
+            primary = True
         )
 
-    def add_sell_record(self, date: str, session_id: int, user_id: int) -> DatabaseError:
-        return self.insert(
+    def add_sell_record(self, date: str, session_id: int, user_id: int, occurrence_id: int = None, price: int = None) -> (DatabaseError, int):
+        data = {
+            'trade_in_date': _reverse_date(date),
+            'user_id': user_id,
+            'session_id': session_id
+        }
+        if occurrence_id is not None:
+            data['occurrence_id'] = occurrence_id
+        if price is not None:
+            data['price'] = price
+
+        status, ret = self.insert(
             table = 'sell_records',
-            data = {
-                'trade_in_date': _reverse_date(date),
-                'user_id': user_id,
-                'session_id': session_id
-            }
+            data = data,
+            ret = ['id']
         )
 
+        if status != DatabaseError.Ok:
+            return status, None
+
+        if len(ret) == 0 or not 'id' in ret:
+            return DatabaseError.InternalError, None
+
+        return status, ret['id']
+
     def cancel_sell_record(self, record_id: int) -> DatabaseError:
         status, record_info = self.select(
             get_fields = ['buy_id'],
@@ -271,7 +670,8 @@ class DatabaseAPI(DatabaseInternal):
             wheres = {
                 'id': record_id,
                 'canceled': False
-            }
+            },
+            primary = True
         )
 
         if status != DatabaseError.Ok:
@@ -305,7 +705,8 @@ class DatabaseAPI(DatabaseInternal):
                 'trade_in_date': _reverse_date(date),
                 'session_id': session_id,
                 'canceled': False
-            }
+            },
+            primary = True
         )
 
         if status != DatabaseError.Ok or len(db_sell_info) == 0:
@@ -316,7 +717,7 @@ class DatabaseAPI(DatabaseInternal):
             buy_id = sell_info['buy_id']
             if buy_id is None:
                 continue
-            status, exists = self.record_exists(table = 'buy_records', wheres = {'id': buy_id, 'user_id': user_id})
+            status, exists = self.record_exists(table = 'buy_records', wheres = {'id': buy_id, 'user_id': user_id}, primary = True)
             if status != DatabaseError.Ok:
                 return status, False
             if exists:
@@ -355,7 +756,8 @@ class DatabaseAPI(DatabaseInternal):
             wheres = {
                 'id': record_id,
                 'canceled': False
-            }
+            },
+            primary = True
         )
 
         if status != DatabaseError.Ok:
@@ -388,6 +790,315 @@ class DatabaseAPI(DatabaseInternal):
             wheres = {'id': record_id}
         )
 
+    #----- buy_orders
+
+    def buy_order_exists(self, date: str, session_id: int, user_id: int) -> (DatabaseError, bool):
+        return self.record_exists(
+            table = 'buy_orders',
+            wheres = {
+                'trade_in_date': _reverse_date(date),
+                'session_id': session_id,
+                'user_id': user_id,
+                'sell_id': None,
+                'canceled': False
+            },
+            primary = True
+        )
+
+    def add_buy_order(self, date: str, session_id: int, user_id: int, price_limit: int, occurrence_id: int = None) -> (DatabaseError, int):
+        data = {
+            'trade_in_date': _reverse_date(date),
+            'user_id': user_id,
+            'session_id': session_id,
+            'price_limit': price_limit
+        }
+        if occurrence_id is not None:
+            data['occurrence_id'] = occurrence_id
+
+        status, ret = self.insert(
+            table = 'buy_orders',
+            data = data,
+            ret = ['id']
+        )
+
+        if status != DatabaseError.Ok:
+            return status, None
+
+        if len(ret) == 0 or not 'id' in ret:
+            return DatabaseError.InternalError, None
+
+        return status, ret['id']
+
+    def get_buy_order(self, order_id: int) -> (DatabaseError, dict):
+        status, buy_orders = self.select(
+            get_fields = {
+                'id': 'id',
+                'user_id': 'buyer',
+                'session_id': 'session_id',
+                'trade_in_date': 'trade_in_date',
+                'price_limit': 'price_limit',
+                'sell_id': 'sell_id',
+                'canceled': 'canceled'
+            },
+            table = 'buy_orders',
+            wheres = {'id': order_id},
+            primary = True
+        )
+
+        if status != DatabaseError.Ok or len(buy_orders) == 0:
+            return status, {}
+
+        buy_order = buy_orders[0]
+        buy_order['trade_in_date'] = _reverse_date(buy_order['trade_in_date'])
+        return status, buy_order
+
+    def get_opened_buy_orders(self, date_start: str, user_id: int = None, primary: bool = False, order_id: int = None) -> (DatabaseError, list):
+        wheres = {
+            'trade_in_date': {
+                'sign': '>=',
+                'value': _reverse_date(date_start)
+            },
+            'canceled': False,
+            'sell_id': None
+        }
+        if user_id is not None:
+            wheres['user_id'] = user_id
+        if order_id is not None:
+            wheres['id'] = order_id
+
+        status, buy_orders = self.select(
+            get_fields = {
+                'id': 'id',
+                'user_id': 'buyer',
+                'session_id': 'session_id',
+                'trade_in_date': 'trade_in_date',
+                'price_limit': 'price_limit'
+            },
+            table = 'buy_orders',
+            wheres = wheres,
+            order_by = 'id',
+            primary = primary
+        )
+
+        if status != DatabaseError.Ok or len(buy_orders) == 0:
+            return status, []
+
+        for buy_order in buy_orders:
+            buy_order['trade_in_date'] = _reverse_date(buy_order['trade_in_date'])
+
+        return DatabaseError.Ok, buy_orders
+
+    def cancel_buy_order(self, order_id: int) -> DatabaseError:
+        status, order_info = self.select(
+            get_fields = ['sell_id'],
+            table = 'buy_orders',
+            wheres = {
+                'id': order_id,
+                'canceled': False
+            },
+            primary = True
+        )
+
+        if status != DatabaseError.Ok:
+            return status
+
+        if len(order_info) == 0:
+            return DatabaseError.InvalidData
+
+        if order_info[0]['sell_id'] is not None:
+            return DatabaseError.RecordUsed
+
+        return self.update(
+            table = 'buy_orders',
+            data = {
+                'canceled': True,
+                'cancel_time': 'NOW()'
+            },
+            wheres = {'id': order_id}
+        )
+
+    # Returns (status, ids of the canceled orders)
+    def cancel_user_buy_orders(self, date: str, session_id: int, user_id: int) -> (DatabaseError, list):
+        status, rows = self.run(QUERY_CANCEL_USER_BUY_ORDERS, [_reverse_date(date), session_id, user_id], ReturnType.ALL_ROWS, need_commit = True)
+        if status != DatabaseError.Ok:
+            return status, []
+        return status, [row[0] for row in rows]
+
+    # Ok - filled, RecordUsed - the offer is not opened anymore, InvalidData -
+    # the order is not opened anymore or its buyer has a slot of the training
+    def fill_buy_order(self, order_id: int, sell_id: int) -> DatabaseError:
+        status, row = self.run(QUERY_FILL_BUY_ORDER, [sell_id, order_id, sell_id, order_id], ReturnType.ONE_ROW, need_commit = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        offer_opened, order_opened, filled = row
+        if filled == 1:
+            return DatabaseError.Ok
+        if offer_opened == 0:
+            return DatabaseError.RecordUsed
+        return DatabaseError.InvalidData
+
+    # opened offers with a price, oldest first
+    def get_priced_offers(self, date_start: str, primary: bool = False) -> (DatabaseError, list):
+        status, offers = self.select(
+            get_fields = {
+                'id': 'id',
+                'user_id': 'seller',
+                'trade_in_date': 'trade_in_date',
+                'session_id': 'session_id',
+                'price': 'price'
+            },
+            table = 'sell_records',
+            wheres = {
+                'trade_in_date': {
+                    'sign': '>=',
+                    'value': _reverse_date(date_start)
+                },
+                'canceled': False,
+                'buy_id': None,
+                'price': {
+                    'sign': '>=',
+                    'value': 0
+                }
+            },
+            order_by = 'id',
+            primary = primary,
+            row_type = Supply
+        )
+
+        if status != DatabaseError.Ok or len(offers) == 0:
+            return status, []
+
+        for offer in offers:
+            offer['trade_in_date'] = _reverse_date(offer['trade_in_date'])
+
+        return DatabaseError.Ok, offers
+
+    #----- wants
+
+    def want_exists(self, user_id: int, place_id: int, session_id: int, date_end: str) -> (DatabaseError, bool):
+        return self.record_exists(
+            table = 'wants',
+            wheres = {
+                'user_id': user_id,
+                'place_id': place_id,
+                'session_id': session_id,
+                'date_end': None if date_end is None else _reverse_date(date_end),
+                'canceled': False
+            },
+            primary = True
+        )
+
+    def add_want(self, user_id: int, place_id: int, session_id: int, date_start: str, date_end: str) -> (DatabaseError, int):
+        data = {
+            'user_id': user_id,
+            'date_start': _reverse_date(date_start)
+        }
+        if place_id is not None:
+            data['place_id'] = place_id
+        if session_id is not None:
+            data['session_id'] = session_id
+        if date_end is not None:
+            data['date_end'] = _reverse_date(date_end)
+
+        status, ret = self.insert(
+            table = 'wants',
+            data = data,
+            ret = ['id']
+        )
+
+        if status != DatabaseError.Ok:
+            return status, None
+
+        if len(ret) == 0 or not 'id' in ret:
+            return DatabaseError.InternalError, None
+
+        return status, ret['id']
+
+    def get_active_wants(self, date: str, user_id: int = None, primary: bool = False, want_id: int = None) -> (DatabaseError, list):
+        query_format = QUERY_SELECT_ACTIVE_WANTS
+        query_args = [_reverse_date(date)]
+        if user_id is not None:
+            query_format += ' AND user_id = %s'
+            query_args.append(user_id)
+        if want_id is not None:
+            query_format += ' AND id = %s'
+            query_args.append(want_id)
+
+        status, rows = self.run(query_format + ' ORDER BY id', query_args, ReturnType.ALL_ROWS, need_commit = False, primary = primary)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        wants = []
+        for want_id, want_user_id, place_id, session_id, date_start, date_end in rows:
+            wants.append({
+                'id': want_id,
+                'user_id': want_user_id,
+                'place_id': place_id,
+                'session_id': session_id,
+                'date_start': _reverse_date(date_start),
+                'date_end': None if date_end is None else _reverse_date(date_end)
+            })
+        return DatabaseError.Ok, wants
+
+    def get_want(self, want_id: int) -> (DatabaseError, dict):
+        status, wants = self.select(
+            get_fields = ['id', 'user_id', 'canceled'],
+            table = 'wants',
+            wheres = {'id': want_id},
+            primary = True
+        )
+
+        if status != DatabaseError.Ok or len(wants) == 0:
+            return status, {}
+
+        return status, wants[0]
+
+    def cancel_want(self, want_id: int) -> DatabaseError:
+        return self.update(
+            table = 'wants',
+            data = {
+                'canceled': True,
+                'cancel_time': 'NOW()'
+            },
+            wheres = {'id': want_id}
+        )
+
+    #----- archive
+
+    def _archive_batches(self, query_format: str, query_args: list) -> (DatabaseError, int):
+        batch_size = query_args[-1]
+        total = 0
+        while True:
+            status, row = self.run(query_format, query_args, ReturnType.ONE_ROW, need_commit = True)
+            if status != DatabaseError.Ok:
+                return status, total
+            total += row[0]
+            if row[0] < batch_size:
+                return DatabaseError.Ok, total
+
+    def archive_records(self, date_before: str, days: int, batch_size: int) -> (DatabaseError, dict):
+        status, sell_count = self._archive_batches(QUERY_ARCHIVE_SELL_RECORDS, [_reverse_date(date_before), days, batch_size])
+        if status != DatabaseError.Ok:
+            return status, {}
+
+        status, buy_count = self._archive_batches(QUERY_ARCHIVE_BUY_RECORDS, [days, batch_size])
+        if status != DatabaseError.Ok:
+            return status, {}
+
+        return DatabaseError.Ok, {
+            'sell_records': sell_count,
+            'buy_records': buy_count
+        }
+
+    # on_row(row) gets rows in the order of EXPORT_COLUMNS, only sessions of
+    # the admin if it is set
+    def stream_history(self, on_row, admin: str = None, itersize: int = 1000) -> DatabaseError:
+        def on_history_row(row: tuple) -> None:
+            on_row(row[0:2] + (_reverse_date(row[2]),) + row[3:])
+
+        return self.stream(QUERY_EXPORT_HISTORY, {'admin': admin}, on_history_row, itersize)
+
     #----- users
 
     def get_user_info(self, user_id: int) -> (DatabaseError, dict):
@@ -414,11 +1125,13 @@ class DatabaseAPI(DatabaseInternal):
 
         return status, db_user_info[0]
 
-    def get_users_info(self, user_ids: list) -> (DatabaseError, list):
+    def get_users_info(self, user_ids: list, primary: bool = False) -> (DatabaseError, list):
         status, db_users_info = self.select(
             get_fields = ['id', 'nick', 'fullname'],
             table = 'users',
-            wheres = {'id': user_ids}
+            wheres = {'id': user_ids},
+            primary = primary,
+            row_type = User
         )
 
         if status != DatabaseError.Ok or len(db_users_info) == 0:
@@ -429,7 +1142,8 @@ class DatabaseAPI(DatabaseInternal):
     def user_record_exists(self, user_id: int) -> (DatabaseError, bool):
         return self.record_exists(
             table = 'users',
-            wheres = {'id': user_id}
+            wheres = {'id': user_id},
+            primary = True
         )
 
     def add_user_info(self, user_id: int, nick: str, fullname: str) -> DatabaseError:
@@ -442,9 +1156,62 @@ class DatabaseAPI(DatabaseInternal):
             }
         )
 
+    #----- groups
+
+    def get_groups_info(self) -> (DatabaseError, list):
+        return self.select(
+            get_fields = ['id', 'title', 'admin', 'place_id', 'status_message_id'],
+            table = 'groups'
+        )
+
+    def get_group_info(self, group_id: int) -> (DatabaseError, dict):
+        status, groups_info = self.select(
+            get_fields = ['id', 'title', 'admin', 'place_id', 'status_message_id'],
+            table = 'groups',
+            wheres = {'id': group_id}
+        )
+
+        if status != DatabaseError.Ok or len(groups_info) == 0:
+            return status, {}
+
+        return status, groups_info[0]
+
+    def group_record_exists(self, group_id: int) -> (DatabaseError, bool):
+        return self.record_exists(
+            table = 'groups',
+            wheres = {'id': group_id},
+            primary = True
+        )
+
+    def add_group_info(self, group_id: int, title: str) -> DatabaseError:
+        return self.insert(
+            table = 'groups',
+            data = {
+                'id': group_id,
+                'title': title
+            }
+        )
+
+    # changed_by - nick of the coach who changes the scope.
+    # RecordUsed - the group is bound to another coach
+    def set_group_scope(self, group_id: int, admin: str, place_id: int, changed_by: str) -> DatabaseError:
+        status, rows = self.run(QUERY_SET_GROUP_SCOPE, [admin, place_id, group_id, changed_by], ReturnType.ALL_ROWS, need_commit = True)
+        if status != DatabaseError.Ok:
+            return status
+        return DatabaseError.Ok if len(rows) != 0 else DatabaseError.RecordUsed
+
+    # message_id equal to None - the group has no status board
+    def set_group_status_message(self, group_id: int, message_id: int) -> DatabaseError:
+        return self.update(
+            table = 'groups',
+            data = {'status_message_id': message_id},
+            wheres = {'id': group_id}
+        )
+
     #----- requests with deals
 
-    def get_opened_deals(self, date_start: str, user_id: int = None) -> (DatabaseError, list):
+    def get_opened_deals(self, date_start: str, user_id: int = None, date_end: str = None, session_ids: list = None, stats: dict = None,
+                         primary: bool = False) -> (DatabaseError, list):
         wheres = {
             'trade_in_date': {
                 'sign': '>=',
@@ -453,18 +1220,29 @@ class DatabaseAPI(DatabaseInternal):
             'canceled': False,
             'buy_id': None
         }
+        if date_end is not None:
+            wheres['trade_in_date'] = {
+                'sign': 'BETWEEN',
+                'value': [_reverse_date(date_start), _reverse_date(date_end)]
+            }
         if user_id is not None:
             wheres['user_id'] = user_id
+        if session_ids is not None:
+            wheres['session_id'] = session_ids
 
         status, opened_deals = self.select(
             get_fields = {
                 'id': 'id',
                 'user_id': 'seller',
                 'trade_in_date': 'trade_in_date',
-                'session_id': 'session_id'
+                'session_id': 'session_id',
+                'price': 'price'
             },
             table = 'sell_records',
-            wheres = wheres
+            wheres = wheres,
+            stats = stats,
+            primary = primary,
+            row_type = Supply
         )
 
         if status != DatabaseError.Ok or len(opened_deals) == 0:
@@ -476,7 +1254,7 @@ class DatabaseAPI(DatabaseInternal):
 
         return DatabaseError.Ok, opened_deals
 
-    def get_closed_deals(self, date_start: str, user_id: int = None) -> (DatabaseError, list):
+    def get_closed_deals(self, date_start: str, user_id: int = None, session_ids: list = None, primary: bool = False) -> (DatabaseError, list):
         wheres = {
             'sell_records.trade_in_date': {
                 'sign': '>=',
@@ -486,6 +1264,8 @@ class DatabaseAPI(DatabaseInternal):
         }
         if user_id is not None:
             wheres['buy_records.user_id'] = user_id
+        if session_ids is not None:
+            wheres['sell_records.session_id'] = session_ids
 
         status, closed_deals = self.select(
             get_fields = {
@@ -494,7 +1274,8 @@ class DatabaseAPI(DatabaseInternal):
                 'sell_records.user_id': 'seller',
                 'buy_records.user_id': 'buyer',
                 'sell_records.trade_in_date': 'trade_in_date',
-                'sell_records.session_id': 'session_id'
+                'sell_records.session_id': 'session_id',
+                'sell_records.price': 'price'
             },
             table = 'sell_records',
             joins = [
@@ -506,7 +1287,9 @@ class DatabaseAPI(DatabaseInternal):
                     }
                 }
             ],
-            wheres = wheres
+            wheres = wheres,
+            primary = primary,
+            row_type = Supply
         )
 
         if status != DatabaseError.Ok or len(closed_deals) == 0:
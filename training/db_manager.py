@@ -1,10 +1,26 @@
 #!/usr/bin/env python3
 
-from training.db_api import DatabaseAPI
+from training.analytics import Analytics
+from training.db_api import DatabaseAPI, MARKET_CHANNEL
+from training.journal import MarketJournal
+from training.matching import MatchingEngine
+from training.order_book import OrderBook
+from training.wants import WantIndex
 from database.error import DatabaseError
+from database.internal import DeadlineExceeded, without_deadline
 from utils.config import Config
 import utils.utils
 
+import datetime
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# session_occurrences are kept this far ahead by default
+OCCURRENCE_WEEKS = 8
+
 def _get_elem_with_key_value(placement: list, key, value) -> (bool, dict):
     for place in placement:
         if key in place and place[key] == value:
@@ -16,11 +32,43 @@ def _get_elem_with_key_value(placement: list, key, value) -> (bool, dict):
 
 
 class DatabaseManager():
-    def init(self, config_path: str, url: str) -> DatabaseError:
+    def init(self, config_path: str, url: str, read_url: str = None, max_replica_lag: float = 10.0, explain_searches: bool = False,
+             use_order_book: bool = False, journal_batch: int = 100, journal_interval: float = 1.0,
+             occurrence_weeks: int = OCCURRENCE_WEEKS) -> DatabaseError:
+        self._explain_searches = explain_searches
+        self._occurrence_weeks = occurrence_weeks
+        self._book = OrderBook()
+        self._matching = MatchingEngine()
+        self._wants = WantIndex()
+        self._invalidation_callbacks = []
+        self._supply_callbacks = []
+        self.invalidation_stats = {'events': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self.search_stats = {'searches': 0, 'rows_scanned': 0, 'rows_returned': 0}
         self._config = Config(config_path) # !!! status
-        self._db = DatabaseAPI(url)
+        self._db = DatabaseAPI(url, read_url, max_replica_lag)
         status = self._db.init_tables()
         status = self._db.update_data(self._config.get_data())
+        self._analytics = Analytics(url, read_url, max_replica_lag)
+        if status == DatabaseError.Ok:
+            status = self._analytics.init_tables()
+        self._journal = MarketJournal(url, journal_batch, journal_interval)
+        if status == DatabaseError.Ok:
+            status, created = self._journal.init_table()
+            # the journal starts from the current market
+            if status == DatabaseError.Ok and created:
+                status = self._seed_journal()
+            self._journal.start()
+        if status == DatabaseError.Ok:
+            status = self.generate_occurrences()
+        if status == DatabaseError.Ok and use_order_book:
+            status = self.reload_order_book()
+        if status == DatabaseError.Ok:
+            status = self.load_matching()
+        if status == DatabaseError.Ok:
+            status = self.load_wants()
+        # changes made by other instances and by hand
+        if status == DatabaseError.Ok:
+            self._db.listen(MARKET_CHANNEL, self._on_market_change)
         # заготовка для самообновления
         # self._config.changes_handler(lambda places: self._db.update_data(places))
         # self._config.watchdog_start()
@@ -37,21 +85,572 @@ class DatabaseManager():
     #----- sessions
 
     def get_schedules(self, place_id: int) -> (DatabaseError, list):
+        if self._book.loaded:
+            return DatabaseError.Ok, [session for session in self._book.sessions.values() if session['place_id'] == place_id]
         return self._db.get_schedules(place_id)
 
     def get_session_info(self, session_id: int) -> (DatabaseError, dict):
         return self._db.get_session_info(session_id)
 
-    #----- supplies
+    def get_all_sessions_info(self) -> (DatabaseError, list):
+        if self._book.loaded:
+            return DatabaseError.Ok, list(self._book.sessions.values())
+        return self._db.get_all_sessions_info()
+
+    # sessions of the coach and/or the place, None means any.
+    # Returns (status, session ids or None - all sessions)
+    def get_scope_session_ids(self, admin: str, place_id: int) -> (DatabaseError, list):
+        if admin is None and place_id is None:
+            return DatabaseError.Ok, None
+        status, sessions = self.get_all_sessions_info()
+        if status != DatabaseError.Ok:
+            return status, []
+        return DatabaseError.Ok, [session['id'] for session in sessions
+                                  if (admin is None or session['admin'] == admin) and (place_id is None or session['place_id'] == place_id)]
 
-    def add_sell_record(self, session_id: int, date: str, user_id: int) -> DatabaseError:
-        status, exists = self._db.sell_record_exists(date, session_id, user_id)
+    #----- session_occurrences
+
+    def generate_occurrences(self) -> DatabaseError:
+        return self._db.generate_occurrences(self._occurrence_weeks)
+
+    # trainings which have not started yet, a training of today is not sold
+    # or ordered after its start
+    def get_occurrences(self, session_id: int, count: int) -> (DatabaseError, list):
+        return self._db.get_occurrences(session_id, datetime.datetime.now(), count)
+
+    def get_occurrence_info(self, occurrence_id: int) -> (DatabaseError, dict):
+        return self._db.get_occurrence_info(occurrence_id)
+
+    #----- order book
+
+    def _load_market(self) -> (DatabaseError, list):
+        date_start = datetime.date.today().strftime("%d.%m.%Y")
+
+        status, closed_deals = self._db.get_closed_deals(date_start, primary = True)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        status, opened_deals = self._db.get_opened_deals(date_start, primary = True)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        return DatabaseError.Ok, closed_deals + opened_deals
+
+    def reload_order_book(self) -> DatabaseError:
+        status, supplies = self._load_market()
+        if status != DatabaseError.Ok:
+            return status
+
+        user_ids = set()
+        for supply in supplies:
+            user_ids.add(supply['seller'])
+            if 'buyer' in supply:
+                user_ids.add(supply['buyer'])
+
+        users = []
+        if len(user_ids) != 0:
+            status, users = self._db.get_users_info(list(user_ids), primary = True)
+            if status != DatabaseError.Ok:
+                return status
+
+        status, sessions = self._db.get_all_sessions_info()
+        if status != DatabaseError.Ok:
+            return status
+
+        status, places = self._db.get_all_places_info()
+        if status != DatabaseError.Ok:
+            return status
+
+        self._book.load(supplies, users, sessions, places)
+        logger.info('Order book loaded: %s supplies', len(supplies))
+        return DatabaseError.Ok
+
+    # writes of other processes (manual fixes, archiving of old dates) are picked
+    # up here. A write of this process during the load makes it retry.
+    def reconcile_order_book(self, attempts: int = 3) -> DatabaseError:
+        if not self._book.loaded:
+            return DatabaseError.Ok
+
+        for attempt in range(attempts):
+            version = self._book.version
+            status, supplies = self._load_market()
+            if status != DatabaseError.Ok:
+                return status
+
+            changed = self._book.reconcile(supplies, version)
+            if changed is None:
+                continue
+
+            for supply in supplies:
+                for key in ['seller', 'buyer']:
+                    if key in supply:
+                        self._cache_user(supply[key])
+
+            if changed != 0:
+                logger.warning('Order book reconciled, %s supplies changed', changed)
+            return DatabaseError.Ok
+
+        logger.warning('Order book is busy, reconciliation skipped')
+        return DatabaseError.Ok
+
+    def _reload_schedule(self) -> DatabaseError:
+        status, sessions = self._db.get_all_sessions_info()
+        if status != DatabaseError.Ok:
+            return status
+
+        status, places = self._db.get_all_places_info()
+        if status != DatabaseError.Ok:
+            return status
+
+        self._book.set_schedule(sessions, places)
+        return DatabaseError.Ok
+
+    def _refresh_supply(self, record_id: int) -> DatabaseError:
+        status, deal = self._db.get_deal(record_id, datetime.date.today().strftime("%d.%m.%Y"))
+        if status != DatabaseError.Ok:
+            return status
+
+        for callback in self._supply_callbacks:
+            callback(record_id, deal)
+
+        # offers of other instances are matched here too
+        if len(deal) == 0 or 'buyer' in deal or deal['price'] is None:
+            self._matching.remove_ask(record_id)
+        elif not self._matching.has_ask(record_id):
+            self._matching.add_ask(record_id, deal['seller'], int(deal['session_id']), deal['trade_in_date'], deal['price'])
+
+        if not self._book.loaded:
+            return DatabaseError.Ok
+
+        if len(deal) == 0:
+            self._book.remove(record_id)
+            return DatabaseError.Ok
+
+        for key in ['seller', 'buyer']:
+            if key in deal:
+                self._cache_user(deal[key])
+        self._book.add(deal)
+        return DatabaseError.Ok
+
+    # changes on every change of the market while the order book is loaded,
+    # None - results cannot be cached
+    def get_market_version(self) -> int:
+        return self._book.version if self._book.loaded else None
+
+    # callback(table) is called after the order book has been updated, table is
+    # None when everything could have changed
+    def add_invalidation_callback(self, callback) -> None:
+        self._invalidation_callbacks.append(callback)
+
+    def _refresh_bid(self, order_id: int) -> DatabaseError:
+        status, buy_orders = self._db.get_opened_buy_orders(datetime.date.today().strftime("%d.%m.%Y"), primary = True, order_id = order_id)
+        if status != DatabaseError.Ok:
+            return status
+
+        if len(buy_orders) == 0:
+            self._matching.remove_bid(order_id)
+        elif not self._matching.has_bid(order_id):
+            buy_order = buy_orders[0]
+            self._matching.add_bid(buy_order['id'], buy_order['buyer'], buy_order['session_id'], buy_order['trade_in_date'], buy_order['price_limit'])
+        return DatabaseError.Ok
+
+    def _refresh_want(self, want_id: int) -> DatabaseError:
+        status, wants = self._db.get_active_wants(datetime.date.today().strftime("%d.%m.%Y"), primary = True, want_id = want_id)
+        if status != DatabaseError.Ok:
+            return status
+
+        if len(wants) == 0:
+            self._wants.remove(want_id)
+            return DatabaseError.Ok
+
+        want = wants[0]
+        status, sessions = self._get_want_sessions(want['place_id'], want['session_id'])
+        if status != DatabaseError.Ok:
+            return status
+        self._wants.add(want['id'], want['user_id'], sessions, want['date_start'], want['date_end'])
+        return DatabaseError.Ok
+
+    # buy records leave with their offers
+    def _forget_row(self, table: str, row_id: int) -> None:
+        if table == 'sell_records':
+            for callback in self._supply_callbacks:
+                callback(row_id, {})
+            self._matching.remove_ask(row_id)
+            if self._book.loaded:
+                self._book.remove(row_id)
+        elif table == 'buy_orders':
+            self._matching.remove_bid(row_id)
+        elif table == 'wants':
+            self._wants.remove(row_id)
+
+    # The engine and the wants are kept by every instance, orders and wants of
+    # the others come here as well as offers
+    # callback(supply_id, deal) is called for every change of a supply made by
+    # any instance, deal is as get_deal returns it ({} - not on the market)
+    def add_supply_callback(self, callback) -> None:
+        self._supply_callbacks.append(callback)
+
+    def _on_market_change(self, payload: str) -> None:
+        table = None
+        if payload is None:
+            self.reconcile_order_book()
+            if self._book.loaded:
+                self._reload_schedule()
+            self.load_matching()
+            self.load_wants()
+        else:
+            change = json.loads(payload)
+            table = change['table']
+            # rows are deleted by the archive, thousands at a time, and a deleted
+            # row has nothing to fetch
+            if change['op'] == 'DELETE' and table in ['sell_records', 'buy_records', 'buy_orders', 'wants']:
+                self._forget_row(table, change['id'])
+            elif table == 'sell_records':
+                self._refresh_supply(change['id'])
+            elif table == 'buy_records':
+                status, record_ids = self._db.get_sell_record_ids_by_buy_id(change['id'])
+                for record_id in record_ids:
+                    self._refresh_supply(record_id)
+            elif table in ['sessions', 'places']:
+                if self._book.loaded:
+                    self._reload_schedule()
+                # wants of a place cover its new sessions
+                self.load_wants()
+            elif table == 'buy_orders':
+                self._refresh_bid(change['id'])
+            elif table == 'wants':
+                self._refresh_want(change['id'])
+
+        # boards and keyboards do not show orders and wants
+        if table not in ['buy_orders', 'wants']:
+            for callback in self._invalidation_callbacks:
+                callback(table)
+
+        if payload is not None:
+            latency = time.time() - change['sent_at']
+            self.invalidation_stats['events'] += 1
+            self.invalidation_stats['latency_total'] += latency
+            self.invalidation_stats['latency_max'] = max(self.invalidation_stats['latency_max'], latency)
+            logger.info('%s %s %s invalidated in %.1f ms', table, change['op'], change['id'], latency * 1000)
+
+    def _cache_user(self, user_id: int) -> None:
+        if not self._book.loaded or user_id in self._book.users:
+            return
+        status, user_info = self._db.get_user_info(user_id)
+        if status == DatabaseError.Ok and len(user_info) != 0:
+            self._book.add_user(user_info)
+
+    #----- matching
+
+    # Only builds the engine: crossed offers and orders left by a failed fill
+    # are matched by match_crossed, whose caller notifies the users
+    def load_matching(self) -> DatabaseError:
+        date_start = datetime.date.today().strftime("%d.%m.%Y")
+
+        status, buy_orders = self._db.get_opened_buy_orders(date_start, primary = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        status, offers = self._db.get_priced_offers(date_start, primary = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        matching = MatchingEngine()
+        for buy_order in buy_orders:
+            matching.add_bid(buy_order['id'], buy_order['buyer'], buy_order['session_id'], buy_order['trade_in_date'], buy_order['price_limit'])
+        for offer in offers:
+            matching.add_ask(offer['id'], offer['seller'], int(offer['session_id']), offer['trade_in_date'], offer['price'])
+        self._matching = matching
+
+        logger.info('Matching loaded: %s offers, %s orders', len(offers), len(buy_orders))
+        return DatabaseError.Ok
+
+    # offers are taken oldest first, so the time priority is kept.
+    # Returns matches as add_buy_order does
+    def match_crossed(self) -> (DatabaseError, list):
+        status, offers = self._db.get_priced_offers(datetime.date.today().strftime("%d.%m.%Y"), primary = True)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        result = []
+        for offer in offers:
+            self._matching.remove_ask(offer['id'])
+            status, matches = self._match_offer(offer)
+            if status != DatabaseError.Ok:
+                return status, result
+            result.extend(matches)
+        return DatabaseError.Ok, result
+
+    def _fill(self, order_id: int, buyer: int, supply_id: int, seller: int, price: int) -> (DatabaseError, dict):
+        status = self._db.fill_buy_order(order_id, supply_id)
+        if status != DatabaseError.Ok:
+            return status, {}
+        self._journal.record('fill', order_id = order_id, sell_id = supply_id, user_id = buyer, peer_id = seller, price = price)
+
+        if self._book.loaded:
+            self._cache_user(buyer)
+            self._book.set_buyer(supply_id, buyer)
+        return status, {
+            'supply_id': supply_id,
+            'order_id': order_id,
+            'seller': seller,
+            'buyer': buyer,
+            'price': price
+        }
+
+    # Entries of the engine may be stale (bought with confirmation of the
+    # seller, changed by another instance), the database decides and stale
+    # entries are skipped.
+    # offer: id, seller, session_id, trade_in_date, price
+    def _match_offer(self, offer: dict) -> (DatabaseError, list):
+        session_id = int(offer['session_id'])
+        while True:
+            bid = self._matching.take_bid(session_id, offer['trade_in_date'], offer['price'], offer['seller'])
+            if bid is None:
+                self._matching.add_ask(offer['id'], offer['seller'], session_id, offer['trade_in_date'], offer['price'])
+                return DatabaseError.Ok, []
+
+            order_id, buyer, limit, seq = bid
+            try:
+                status, match = self._fill(order_id, buyer, offer['id'], offer['seller'], offer['price'])
+            except DeadlineExceeded:
+                self._matching.add_bid(order_id, buyer, session_id, offer['trade_in_date'], limit, seq)
+                self._matching.add_ask(offer['id'], offer['seller'], session_id, offer['trade_in_date'], offer['price'])
+                raise
+            if status == DatabaseError.InvalidData:
+                continue
+            if status != DatabaseError.Ok:
+                self._matching.add_bid(order_id, buyer, session_id, offer['trade_in_date'], limit, seq)
+                return DatabaseError.Ok if status == DatabaseError.RecordUsed else status, []
+            return status, [match]
+
+    # order: id, buyer, session_id, trade_in_date, price_limit
+    def _match_order(self, order: dict) -> (DatabaseError, list):
+        session_id = int(order['session_id'])
+        while True:
+            ask = self._matching.take_ask(session_id, order['trade_in_date'], order['price_limit'], order['buyer'])
+            if ask is None:
+                self._matching.add_bid(order['id'], order['buyer'], session_id, order['trade_in_date'], order['price_limit'])
+                return DatabaseError.Ok, []
+
+            supply_id, seller, price, seq = ask
+            try:
+                status, match = self._fill(order['id'], order['buyer'], supply_id, seller, price)
+            except DeadlineExceeded:
+                self._matching.add_ask(supply_id, seller, session_id, order['trade_in_date'], price, seq)
+                self._matching.add_bid(order['id'], order['buyer'], session_id, order['trade_in_date'], order['price_limit'])
+                raise
+            if status == DatabaseError.RecordUsed:
+                continue
+            if status != DatabaseError.Ok:
+                self._matching.add_ask(supply_id, seller, session_id, order['trade_in_date'], price, seq)
+                return DatabaseError.Ok if status == DatabaseError.InvalidData else status, []
+            return status, [match]
+
+    #----- buy orders
+
+    # returns matches: supply_id, order_id, seller, buyer, price
+    def add_buy_order(self, session_id: int, date: str, user_id: int, price_limit: int, occurrence_id: int = None) -> (DatabaseError, list):
+        status, exists = self._db.buy_order_exists(date, session_id, user_id)
+        if status != DatabaseError.Ok:
+            return status, []
+        elif exists:
+            return DatabaseError.RecordExists, []
+
+        status, exists = self._db.buy_record_exists(date, session_id, user_id)
+        if status != DatabaseError.Ok:
+            return status, []
+        elif exists:
+            return DatabaseError.RecordExists, []
+
+        status, order_id = self._db.add_buy_order(date, session_id, user_id, price_limit, occurrence_id)
+        if status != DatabaseError.Ok:
+            return status, []
+        self._journal.record('order', order_id = order_id, user_id = user_id, session_id = int(session_id), trade_in_date = date, price = price_limit)
+
+        # the order is committed, it has to reach the engine
+        with without_deadline():
+            return self._match_order({'id': order_id, 'buyer': user_id, 'session_id': session_id, 'trade_in_date': date, 'price_limit': price_limit})
+
+    def cancel_buy_order(self, order_id: int, user_id: int) -> DatabaseError:
+        status, buy_order = self._db.get_buy_order(order_id)
+        if status != DatabaseError.Ok:
+            return status
+        if len(buy_order) == 0 or buy_order['buyer'] != user_id:
+            return DatabaseError.InvalidData
+
+        status = self._db.cancel_buy_order(order_id)
+        if status == DatabaseError.Ok:
+            self._matching.remove_bid(order_id)
+            self._journal.record('order_cancel', order_id = order_id)
+        return status
+
+    def get_buy_order_info(self, order_id: int) -> (DatabaseError, dict):
+        status, buy_order = self._db.get_buy_order(order_id)
+        if status != DatabaseError.Ok or len(buy_order) == 0:
+            return status, {}
+
+        status, session_info = self.get_session_info(buy_order['session_id'])
+        if status != DatabaseError.Ok:
+            return status, {}
+
+        status, place_info = self.get_place_info(session_info['place_id'])
+        if status != DatabaseError.Ok:
+            return status, {}
+
+        return DatabaseError.Ok, {
+            'id': buy_order['id'],
+            'buyer': buy_order['buyer'],
+            'time': session_info['time'],
+            'date': buy_order['trade_in_date'],
+            'place_name': place_info['name'],
+            'price_limit': buy_order['price_limit']
+        }
+
+    def get_own_buy_orders(self, date_start: str, user_id: int) -> (DatabaseError, list):
+        status, buy_orders = self._db.get_opened_buy_orders(date_start, user_id)
+        if status != DatabaseError.Ok or len(buy_orders) == 0:
+            return status, []
+
+        status, sessions_info = self._get_all_supply_sessions_info(buy_orders)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        status, places_info = self._get_all_supply_places_info(sessions_info)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        orders_info = list()
+        for buy_order in buy_orders:
+            session_info = sessions_info[buy_order['session_id']]
+            orders_info.append({
+                'id': buy_order['id'],
+                'time': session_info['time'],
+                'date': buy_order['trade_in_date'],
+                'place_name': places_info[session_info['place_id']]['name'],
+                'price_limit': buy_order['price_limit']
+            })
+        return DatabaseError.Ok, orders_info
+
+    #----- wants
+
+    # place_id/session_id equal to None mean any
+    def _get_want_sessions(self, place_id: int, session_id: int) -> (DatabaseError, list):
+        if session_id is not None:
+            status, session_info = self.get_session_info(session_id)
+            return status, [] if len(session_info) == 0 else [session_info]
+        if place_id is not None:
+            return self.get_schedules(place_id)
+        return self.get_all_sessions_info()
+
+    def load_wants(self) -> DatabaseError:
+        status, wants = self._db.get_active_wants(datetime.date.today().strftime("%d.%m.%Y"), primary = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        index = WantIndex()
+        for want in wants:
+            status, sessions = self._get_want_sessions(want['place_id'], want['session_id'])
+            if status != DatabaseError.Ok:
+                return status
+            index.add(want['id'], want['user_id'], sessions, want['date_start'], want['date_end'])
+
+        self._wants = index
+        logger.info('Wants loaded: %s', len(wants))
+        return DatabaseError.Ok
+
+    # place_id/session_id equal to 0 mean any, days equal to 0 means no limit
+    def add_want(self, user_id: int, place_id: int, session_id: int, days: int) -> DatabaseError:
+        place_id = place_id or None
+        session_id = session_id or None
+        today = datetime.date.today()
+        date_start = today.strftime("%d.%m.%Y")
+        date_end = None if days == 0 else (today + datetime.timedelta(days)).strftime("%d.%m.%Y")
+
+        status, exists = self._db.want_exists(user_id, place_id, session_id, date_end)
         if status != DatabaseError.Ok:
             return status
         elif exists:
             return DatabaseError.RecordExists
 
-        return self._db.add_sell_record(date, session_id, user_id)
+        status, sessions = self._get_want_sessions(place_id, session_id)
+        if status != DatabaseError.Ok:
+            return status
+
+        status, want_id = self._db.add_want(user_id, place_id, session_id, date_start, date_end)
+        if status == DatabaseError.Ok:
+            self._wants.add(want_id, user_id, sessions, date_start, date_end)
+        return status
+
+    def cancel_want(self, want_id: int, user_id: int) -> DatabaseError:
+        status, want = self._db.get_want(want_id)
+        if status != DatabaseError.Ok:
+            return status
+        if len(want) == 0 or want['user_id'] != user_id or want['canceled']:
+            return DatabaseError.InvalidData
+
+        status = self._db.cancel_want(want_id)
+        if status == DatabaseError.Ok:
+            self._wants.remove(want_id)
+        return status
+
+    # place_name/session equal to None mean any
+    def get_own_wants(self, user_id: int) -> (DatabaseError, list):
+        status, wants = self._db.get_active_wants(datetime.date.today().strftime("%d.%m.%Y"), user_id)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        wants_info = []
+        for want in wants:
+            want_info = {'id': want['id'], 'place_name': None, 'session': None, 'date_end': want['date_end']}
+            place_id = want['place_id']
+            if want['session_id'] is not None:
+                status, want_info['session'] = self.get_session_info(want['session_id'])
+                if status != DatabaseError.Ok:
+                    return status, []
+                place_id = want_info['session']['place_id']
+            if place_id is not None:
+                status, place_info = self.get_place_info(place_id)
+                if status != DatabaseError.Ok:
+                    return status, []
+                want_info['place_name'] = place_info['name']
+            wants_info.append(want_info)
+        return DatabaseError.Ok, wants_info
+
+    def prune_wants(self) -> int:
+        return self._wants.prune(datetime.date.today())
+
+    #----- supplies
+
+    # price equal to None means by agreement, such offers are not matched.
+    # Returns the id of the record, matched buy orders (see add_buy_order) and
+    # wants (want_id -> user_id) to notify when no order has taken the offer
+    def add_sell_record(self, session_id: int, date: str, user_id: int, occurrence_id: int = None, price: int = None) -> (DatabaseError, dict):
+        status, exists = self._db.sell_record_exists(date, session_id, user_id)
+        if status != DatabaseError.Ok:
+            return status, {}
+        elif exists:
+            return DatabaseError.RecordExists, {}
+
+        status, record_id = self._db.add_sell_record(date, session_id, user_id, occurrence_id, price)
+        if status != DatabaseError.Ok:
+            return status, {}
+        self._journal.record('sell', sell_id = record_id, user_id = user_id, session_id = int(session_id), trade_in_date = date, price = price)
+
+        if self._book.loaded:
+            self._cache_user(user_id)
+            self._book.add({'id': record_id, 'seller': user_id, 'session_id': int(session_id), 'trade_in_date': date, 'price': price})
+
+        result = {'id': record_id, 'matches': [], 'wants': {}}
+        if price is not None:
+            # the offer is committed, it has to reach the engine
+            with without_deadline():
+                status, result['matches'] = self._match_offer({'id': record_id, 'seller': user_id, 'session_id': session_id, 'trade_in_date': date, 'price': price})
+            if status != DatabaseError.Ok:
+                logger.warning('Cannot match offer %s', record_id)
+        if len(result['matches']) == 0:
+            result['wants'] = {want_id: want_user_id for want_id, want_user_id in self._wants.match(int(session_id), date).items() if want_user_id != user_id}
+        return DatabaseError.Ok, result
 
     def add_buy_record(self, session_id: int, date: str, seller_id: int, user_id: int) -> DatabaseError:
         status, exists = self._db.buy_record_exists(date, session_id, user_id)
@@ -61,19 +660,64 @@ class DatabaseManager():
         if exists:
             return DatabaseError.RecordExists
 
-        return self._db.add_buy_record(session_id, date, seller_id, user_id)
+        status = self._db.add_buy_record(session_id, date, seller_id, user_id)
+        if status != DatabaseError.Ok:
+            return status
+
+        # without the order book the offer is found by the replay
+        sell_id = None
+        if self._book.loaded:
+            self._cache_user(user_id)
+            sell_id = self._book.find(int(session_id), date, seller_id)
+            self._book.set_buyer(sell_id, user_id)
+        self._journal.record('buy', sell_id = sell_id, user_id = user_id, peer_id = seller_id, session_id = int(session_id), trade_in_date = date)
+
+        # the slot is bought, an opened order would buy a second one
+        with without_deadline():
+            cancel_status, order_ids = self._db.cancel_user_buy_orders(date, session_id, user_id)
+        if cancel_status != DatabaseError.Ok:
+            logger.warning('Cannot cancel buy orders of %s for %s %s', user_id, session_id, date)
+        for order_id in order_ids:
+            self._matching.remove_bid(order_id)
+            self._journal.record('order_cancel', order_id = order_id)
+        return status
 
     def cancel_sell_record(self, record_id: int) -> DatabaseError:
-        return self._db.cancel_sell_record(record_id)
+        status = self._db.cancel_sell_record(record_id)
+        if status == DatabaseError.Ok:
+            self._book.remove(record_id)
+            self._matching.remove_ask(record_id)
+            self._journal.record('sell_cancel', sell_id = record_id)
+        return status
 
     # !!! отправить оповещение продавцу и тренеру об отмене фиксации слота
-    def cancel_buy_record(self, record_id: int) -> DatabaseError:
-        return self._db.cancel_buy_record(record_id)
-
+    # the offer is opened again and may be matched at once, returns matches
+    def cancel_buy_record(self, record_id: int) -> (DatabaseError, list):
+        status = self._db.cancel_buy_record(record_id)
+        if status != DatabaseError.Ok:
+            return status, []
+        self._book.set_buyer(record_id, None)
+        self._journal.record('buy_cancel', sell_id = record_id)
+
+        # the offer is opened again, it has to reach the engine
+        with without_deadline():
+            status, deal = self._db.get_deal(record_id, datetime.date.today().strftime("%d.%m.%Y"))
+            if status != DatabaseError.Ok or len(deal) == 0 or deal['price'] is None:
+                return DatabaseError.Ok, []
+            return self._match_offer(deal)
+
+    # not canceled, not bought and not past
+    def is_offer_opened(self, supply_id: int) -> (DatabaseError, bool):
+        status, deal = self._db.get_deal(supply_id, datetime.date.today().strftime("%d.%m.%Y"))
+        return status, status == DatabaseError.Ok and len(deal) != 0 and 'buyer' not in deal
+
+    # InvalidData for an unknown or archived supply
     def get_supply_info(self, supply_id: int) -> (DatabaseError, dict):
         status, supply_info = self._db.get_sell_record(supply_id)
         if status != DatabaseError.Ok:
             return status, {}
+        if len(supply_info) == 0:
+            return DatabaseError.InvalidData, {}
 
         status, session_info = self.get_session_info(supply_info['session_id'])
         if status != DatabaseError.Ok:
@@ -95,20 +739,25 @@ class DatabaseManager():
             'seller_id': user_info['id'],
             'seller_nick': user_info['nick'],
             'seller_fullname': user_info['fullname'],
-            'session_id': supply_info['session_id']
+            'session_id': supply_info['session_id'],
+            'price': supply_info['price']
         }
 
-    def _get_supplies(self, date_start: str, closed_deals: bool, opened_deals: bool, user_id: int = None) -> (DatabaseError, list):
+    def _get_supplies(self, date_start: str, closed_deals: bool, opened_deals: bool, user_id: int = None,
+                      session_ids: list = None) -> (DatabaseError, list):
+        if self._book.loaded:
+            return DatabaseError.Ok, self._book.query(date_start, closed_deals, opened_deals, user_id, session_ids = session_ids)
+
         supplies = []
 
         if closed_deals:
-            status, db_closed_deals = self._db.get_closed_deals(date_start, user_id)
+            status, db_closed_deals = self._db.get_closed_deals(date_start, user_id, session_ids = session_ids)
             if status != DatabaseError.Ok:
                 return status, []
             supplies.extend(db_closed_deals)
 
         if opened_deals:
-            status, db_opened_deals = self._db.get_opened_deals(date_start, user_id)
+            status, db_opened_deals = self._db.get_opened_deals(date_start, user_id, session_ids = session_ids)
             if status != DatabaseError.Ok:
                 return status, []
             supplies.extend(db_opened_deals)
@@ -125,6 +774,9 @@ class DatabaseManager():
             if 'buyer' in supply:
                 user_ids.add(supply['buyer'])
 
+        if self._book.loaded and user_ids <= self._book.users.keys():
+            return DatabaseError.Ok, {user_id: self._book.users[user_id] for user_id in user_ids}
+
         status, users_data = self._db.get_users_info(list(user_ids))
 
         if status != DatabaseError.Ok or len(users_data) == 0:
@@ -144,6 +796,9 @@ class DatabaseManager():
         for supply in supplies:
             session_ids.add(supply['session_id'])
 
+        if self._book.loaded and session_ids <= self._book.sessions.keys():
+            return DatabaseError.Ok, {session_id: self._book.sessions[session_id] for session_id in session_ids}
+
         status, sessions_data = self._db.get_sessions_info(list(session_ids))
 
         if status != DatabaseError.Ok or len(sessions_data) == 0:
@@ -163,6 +818,9 @@ class DatabaseManager():
         for session_info in sessions_info.values():
             place_ids.add(session_info['place_id'])
 
+        if self._book.loaded and place_ids <= self._book.places.keys():
+            return DatabaseError.Ok, {place_id: self._book.places[place_id] for place_id in place_ids}
+
         status, places_data = self._db.get_places_info(list(place_ids))
 
         if status != DatabaseError.Ok or len(places_data) == 0:
@@ -231,14 +889,19 @@ class DatabaseManager():
             supply_info = dict()
             supply_info['id'] = supply['id']
             supply_info['seller'] = additional_info['users_info'][supply['seller']]
+            if supply.get('price') is not None:
+                supply_info['price'] = supply['price']
             if 'buyer' in supply:
                 supply_info['buyer'] = additional_info['users_info'][supply['buyer']]
             date_info['supplies'].append(supply_info)
 
         return DatabaseError.Ok, supplies_info
 
-    def get_status(self, date_start: str) -> (DatabaseError, list):
-        status, supplies = self._get_supplies(date_start = date_start, closed_deals = True, opened_deals = True)
+    # session_ids equal to None mean all sessions
+    def get_status(self, date_start: str, session_ids: list = None) -> (DatabaseError, list):
+        if session_ids is not None and len(session_ids) == 0:
+            return DatabaseError.Ok, []
+        status, supplies = self._get_supplies(date_start = date_start, closed_deals = True, opened_deals = True, session_ids = session_ids)
         if status != DatabaseError.Ok or len(supplies) == 0:
             return status, []
 
@@ -251,6 +914,41 @@ class DatabaseManager():
 
         return self._make_supplies_info(supplies)
 
+    # place_id/session_id equal to 0 mean any, date_end equal to None means no limit
+    def search_opened_supplies(self, date_start: str, date_end: str, place_id: int, session_id: int) -> (DatabaseError, list):
+        session_ids = None
+        if session_id != 0:
+            session_ids = [session_id]
+        elif place_id != 0:
+            status, schedules = self.get_schedules(place_id)
+            if status != DatabaseError.Ok or len(schedules) == 0:
+                return status, []
+            session_ids = [schedule['id'] for schedule in schedules]
+
+        if self._book.loaded:
+            supplies = self._book.query(date_start, closed_deals = False, opened_deals = True, date_end = date_end, session_ids = session_ids)
+            return self._make_supplies_info(supplies)
+
+        stats = dict() if self._explain_searches else None
+        status, supplies = self._db.get_opened_deals(date_start, date_end = date_end, session_ids = session_ids, stats = stats)
+        if status != DatabaseError.Ok:
+            return status, []
+
+        self.search_stats['searches'] += 1
+        self.search_stats['rows_returned'] += len(supplies)
+        if stats is not None:
+            self.search_stats['rows_scanned'] += stats['rows_scanned']
+            logger.info('Search place=%s session=%s dates=%s-%s: %s rows scanned, %s rows returned', place_id, session_id, date_start, date_end, stats['rows_scanned'], len(supplies))
+
+        return self._make_supplies_info(supplies)
+
+    def get_closed_supplies(self, date_start: str) -> (DatabaseError, list):
+        status, supplies = self._get_supplies(date_start = date_start, closed_deals = True, opened_deals = False)
+        if status != DatabaseError.Ok:
+            return status, {}
+
+        return self._make_supplies_info(supplies)
+
     def get_own_supplies(self, date_start: str, user_id: int) -> (DatabaseError, list):
         status, supplies = self._get_supplies(date_start = date_start, closed_deals = True, opened_deals = True, user_id = user_id)
         if status != DatabaseError.Ok:
@@ -258,6 +956,55 @@ class DatabaseManager():
 
         return self._make_supplies_info(supplies)
 
+    #----- archive
+
+    def archive_records(self, days: int, batch_size: int = 500) -> (DatabaseError, dict):
+        date_before = (datetime.date.today() - datetime.timedelta(days)).strftime("%d.%m.%Y")
+        return self._db.archive_records(date_before, days, batch_size)
+
+    # rows of training.db_api.EXPORT_COLUMNS, see training.export
+    def stream_history(self, on_row, admin: str = None) -> DatabaseError:
+        return self._db.stream_history(on_row, admin)
+
+    #----- journal
+
+    # events which do not change records (buy_request, buy_reject), see training/journal.py
+    def journal_event(self, kind: str, **fields) -> None:
+        self._journal.record(kind, **fields)
+
+    def close_journal(self) -> None:
+        self._journal.stop()
+
+    def _seed_journal(self) -> DatabaseError:
+        date_start = datetime.date.today().strftime("%d.%m.%Y")
+        status, supplies = self._get_supplies(date_start, closed_deals = True, opened_deals = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        status, buy_orders = self._db.get_opened_buy_orders(date_start, primary = True)
+        if status != DatabaseError.Ok:
+            return status
+
+        for supply in supplies:
+            self._journal.record('sell', sell_id = supply['id'], user_id = supply['seller'], session_id = supply['session_id'],
+                                 trade_in_date = supply['trade_in_date'], price = supply.get('price'))
+            if supply.get('buyer') is not None:
+                self._journal.record('buy', sell_id = supply['id'], user_id = supply['buyer'], peer_id = supply['seller'],
+                                     session_id = supply['session_id'], trade_in_date = supply['trade_in_date'])
+        for buy_order in buy_orders:
+            self._journal.record('order', order_id = buy_order['id'], user_id = buy_order['buyer'], session_id = buy_order['session_id'],
+                                 trade_in_date = buy_order['trade_in_date'], price = buy_order['price_limit'])
+        return self._journal.flush()
+
+    #----- analytics
+
+    # Returns (status, first recomputed day or None)
+    def refresh_analytics(self) -> (DatabaseError, str):
+        return self._analytics.refresh(datetime.date.today())
+
+    def get_analytics(self, admin: str, days: int) -> (DatabaseError, list):
+        return self._analytics.get_report(admin, datetime.date.today() - datetime.timedelta(days))
+
     #----- users
 
     def get_user_info(self, user_id: int) -> (DatabaseError, dict):
@@ -266,6 +1013,11 @@ class DatabaseManager():
     def get_user_info_by_nick(self, user_nick: str) -> (DatabaseError, dict):
         return self._db.get_user_info_by_nick(user_nick)
 
+    # admins are the coaches of sessions from the config
+    def is_admin(self, user_nick: str) -> bool:
+        status, sessions = self.get_all_sessions_info()
+        return status == DatabaseError.Ok and any(session['admin'] == user_nick for session in sessions)
+
     def add_user_info(self, user_id: int, nick: str, fullname: str) -> DatabaseError:
         status, exists = self._db.user_record_exists(user_id)
         if status != DatabaseError.Ok:
@@ -274,3 +1026,31 @@ class DatabaseManager():
             return DatabaseError.Ok
 
         return self._db.add_user_info(user_id, nick, fullname)
+
+    #----- groups
+
+    def get_groups_info(self) -> (DatabaseError, list):
+        return self._db.get_groups_info()
+
+    def add_group_info(self, group_id: int, title: str) -> DatabaseError:
+        status, exists = self._db.group_record_exists(group_id)
+        if status != DatabaseError.Ok:
+            return status
+        elif exists:
+            return DatabaseError.Ok
+
+        return self._db.add_group_info(group_id, title)
+
+    def get_group_info(self, group_id: int) -> (DatabaseError, dict):
+        return self._db.get_group_info(group_id)
+
+    # admin equal to None unbinds the group. RecordUsed - the group is bound
+    # to another coach than changed_by
+    def bind_group(self, group_id: int, title: str, admin: str, place_id: int, changed_by: str) -> DatabaseError:
+        status = self.add_group_info(group_id, title)
+        if status != DatabaseError.Ok:
+            return status
+        return self._db.set_group_scope(group_id, admin, place_id, changed_by)
+
+    def set_group_status_message(self, group_id: int, message_id: int) -> DatabaseError:
+        return self._db.set_group_status_message(group_id, message_id)
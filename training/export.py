@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# Export of the trade history into CSV or NDJSON. Rows are written as they come
+# from the server-side cursor, so memory does not depend on the history size.
+
+from database.error import DatabaseError
+from training.db_api import EXPORT_COLUMNS
+from training.db_manager import DatabaseManager
+
+import csv
+import datetime
+import json
+
+FORMATS = ['csv', 'json']
+
+def _plain(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep = ' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+# Returns (status, number of rows)
+def export_history(dbm: DatabaseManager, path: str, fmt: str = 'csv', admin: str = None) -> (DatabaseError, int):
+    count = 0
+    with open(path, 'w', encoding = 'utf-8', newline = '') as out_file:
+        if fmt == 'csv':
+            writer = csv.writer(out_file)
+            writer.writerow(EXPORT_COLUMNS)
+            write = lambda row: writer.writerow([_plain(value) for value in row])
+        else:
+            write = lambda row: out_file.write(json.dumps(dict(zip(EXPORT_COLUMNS, map(_plain, row))), ensure_ascii = False) + '\n')
+
+        def on_row(row: tuple) -> None:
+            nonlocal count
+            write(row)
+            count += 1
+
+        status = dbm.stream_history(on_row, admin)
+    return status, count
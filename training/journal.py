@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# Append-only journal of the market: every change of offers, deals and buy
+# orders and every request of a buyer is an event in market_events. Records and
+# orders keep being updated in place, the journal keeps how they got there.
+# Events are buffered and written by one multi-row INSERT when batch_size of
+# them are waiting or flush_interval has passed, callers never wait for it.
+#
+# Events (fields besides kind):
+#   sell          sell_id, user_id - seller, session_id, trade_in_date, price
+#   sell_cancel   sell_id
+#   buy_request   sell_id, user_id - buyer, peer_id - seller
+#   buy_reject    sell_id, user_id - buyer, peer_id - seller
+#   buy           sell_id (may be NULL), user_id - buyer, peer_id - seller, session_id, trade_in_date
+#   buy_cancel    sell_id
+#   order         order_id, user_id - buyer, session_id, trade_in_date, price - limit
+#   order_cancel  order_id
+#   fill          order_id, sell_id, user_id - buyer, peer_id - seller, price
+
+from database.error import DatabaseError
+from database.internal import DatabaseInternal, ReturnType
+
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+EVENT_FIELDS = ['sell_id', 'order_id', 'user_id', 'peer_id', 'session_id', 'trade_in_date', 'price']
+EVENT_COLUMNS = ['event_time', 'kind'] + EVENT_FIELDS
+
+# events kept while the database is not available, the oldest are dropped
+MAX_PENDING = 100000
+
+QUERY_CREATE_TABLE_MARKET_EVENTS = (
+    'CREATE TABLE market_events ('
+        'id BIGSERIAL PRIMARY KEY, '
+        'event_time TIMESTAMP NOT NULL, '
+        'kind VARCHAR (16) NOT NULL, '
+        'sell_id INT, '
+        'order_id INT, '
+        'user_id BIGINT, '
+        'peer_id BIGINT, '
+        'session_id INT, '
+        'trade_in_date VARCHAR (10), '
+        'price INT'
+    ')'
+)
+
+# ids follow the flushes, a batch of one instance may be written after a later
+# event of another one, so the time of the event gives the order
+QUERY_CREATE_INDEX_MARKET_EVENTS_TIME = 'CREATE INDEX IF NOT EXISTS market_events_time_idx ON market_events (event_time, id)'
+
+QUERY_SELECT_EVENTS = (
+    'SELECT id, ' + ', '.join(EVENT_COLUMNS) + ' FROM market_events '
+    'WHERE id > %s AND (%s::TIMESTAMP IS NULL OR event_time <= %s::TIMESTAMP) ORDER BY event_time, id'
+)
+
+class MarketJournal(DatabaseInternal):
+    def __init__(self, url: str, batch_size: int = 100, flush_interval: float = 1.0):
+        super().__init__(url)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # one flush at a time, so batches are written in order
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pending = []
+        self.stats = {'events': 0, 'batches': 0, 'failures': 0, 'dropped': 0}
+
+    # Returns (status, the table has been created now)
+    def init_table(self) -> (DatabaseError, bool):
+        status, exists = self.table_exists(name = 'market_events', primary = True)
+        if status != DatabaseError.Ok:
+            return status, False
+        if not exists:
+            status = self.run(QUERY_CREATE_TABLE_MARKET_EVENTS, [], ReturnType.NONE, need_commit = True)
+            if status != DatabaseError.Ok:
+                return status, False
+        return self.run(QUERY_CREATE_INDEX_MARKET_EVENTS_TIME, [], ReturnType.NONE, need_commit = True), not exists
+
+    def start(self) -> None:
+        if self._thread is not None or self._flush_interval <= 0:
+            return
+        self._thread = threading.Thread(target = self._flush_loop, name = 'market-journal', daemon = True)
+        self._thread.start()
+
+    # writes what is left
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _flush_loop(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def record(self, kind: str, **fields) -> None:
+        row = (datetime.datetime.now(), kind) + tuple(fields.get(name) for name in EVENT_FIELDS)
+        with self._lock:
+            self._pending.append(row)
+            full = len(self._pending) >= self._batch_size
+        if not full:
+            return
+        if self._thread is None:
+            self.flush()
+        else:
+            self._wakeup.set()
+
+    def flush(self) -> DatabaseError:
+        with self._flush_lock:
+            with self._lock:
+                rows = self._pending
+                self._pending = []
+            if len(rows) == 0:
+                return DatabaseError.Ok
+
+            status = self.insert_many('market_events', EVENT_COLUMNS, rows)
+            if status == DatabaseError.Ok:
+                self.stats['events'] += len(rows)
+                self.stats['batches'] += 1
+                return status
+
+            # kept for the next flush, ahead of the newer events
+            self.stats['failures'] += 1
+            with self._lock:
+                self._pending = rows + self._pending
+                dropped = len(self._pending) - MAX_PENDING
+                if dropped > 0:
+                    del self._pending[0:dropped]
+                    self.stats['dropped'] += dropped
+                    logger.critical('Market journal is full, %s events dropped', dropped)
+            logger.warning('Cannot write %s events into the market journal', len(rows))
+            return status
+
+    # on_row(id, event_time, kind, sell_id, order_id, user_id, peer_id, session_id, trade_in_date, price)
+    # for events after after_id up to until (None - all), in the order they happened
+    def stream_events(self, on_row, after_id: int = 0, until: datetime.datetime = None) -> DatabaseError:
+        return self.stream(QUERY_SELECT_EVENTS, [after_id, until, until], on_row, primary = True)
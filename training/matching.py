@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Price-time priority matching of priced sell offers (asks) and buy orders
+# (bids). Every training (session + date) has its own pair of heaps, so an
+# event costs O(log n) of that training only. Removed entries stay in the
+# heaps and are dropped when they reach the top.
+#
+# The engine only decides, DatabaseManager persists the matches and puts the
+# entries back when the database disagrees.
+
+import heapq
+import itertools
+import threading
+
+class MatchingEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # (session_id, date) -> heap of (price, seq, supply_id, seller)
+        self._asks = dict()
+        # (session_id, date) -> heap of (-limit, seq, order_id, buyer)
+        self._bids = dict()
+        # id -> seq of the live entry
+        self._live_asks = dict()
+        self._live_bids = dict()
+
+    @staticmethod
+    def _top(heaps: dict, live: dict, key: tuple) -> tuple:
+        heap = heaps.get(key)
+        while heap:
+            entry = heap[0]
+            if live.get(entry[2]) == entry[1]:
+                return entry
+            heapq.heappop(heap)
+        heaps.pop(key, None)
+        return None
+
+    @staticmethod
+    def _push(heaps: dict, live: dict, key: tuple, entry: tuple) -> None:
+        live[entry[2]] = entry[1]
+        heapq.heappush(heaps.setdefault(key, []), entry)
+
+    # Takes the best live entry which accepts(entry) and is not owner's. Own
+    # entries above it stay in the heap with their priority.
+    @staticmethod
+    def _take(heaps: dict, live: dict, key: tuple, accepts, owner: int) -> tuple:
+        skipped = []
+        found = None
+        while True:
+            entry = MatchingEngine._top(heaps, live, key)
+            if entry is None or not accepts(entry):
+                break
+            heapq.heappop(heaps[key])
+            if entry[3] == owner:
+                skipped.append(entry)
+                continue
+            del live[entry[2]]
+            found = entry
+            break
+        for entry in skipped:
+            heapq.heappush(heaps.setdefault(key, []), entry)
+        return found
+
+    # seq keeps the time priority of an entry which is put back
+    def add_ask(self, supply_id: int, seller: int, session_id: int, date: str, price: int, seq: int = None) -> int:
+        with self._lock:
+            seq = next(self._seq) if seq is None else seq
+            self._push(self._asks, self._live_asks, (session_id, date), (price, seq, supply_id, seller))
+            return seq
+
+    def add_bid(self, order_id: int, buyer: int, session_id: int, date: str, limit: int, seq: int = None) -> int:
+        with self._lock:
+            seq = next(self._seq) if seq is None else seq
+            self._push(self._bids, self._live_bids, (session_id, date), (-limit, seq, order_id, buyer))
+            return seq
+
+    def has_ask(self, supply_id: int) -> bool:
+        with self._lock:
+            return supply_id in self._live_asks
+
+    def has_bid(self, order_id: int) -> bool:
+        with self._lock:
+            return order_id in self._live_bids
+
+    def remove_ask(self, supply_id: int) -> None:
+        with self._lock:
+            self._live_asks.pop(supply_id, None)
+
+    def remove_bid(self, order_id: int) -> None:
+        with self._lock:
+            self._live_bids.pop(order_id, None)
+
+    # Takes the best bid which accepts the price, bids of the seller are
+    # skipped.
+    # Returns (order_id, buyer, limit, seq) or None
+    def take_bid(self, session_id: int, date: str, price: int, seller: int) -> tuple:
+        with self._lock:
+            entry = self._take(self._bids, self._live_bids, (session_id, date), lambda entry: -entry[0] >= price, seller)
+        return None if entry is None else (entry[2], entry[3], -entry[0], entry[1])
+
+    # Takes the cheapest ask within the limit, same rule for own asks
+    # Returns (supply_id, seller, price, seq) or None
+    def take_ask(self, session_id: int, date: str, limit: int, buyer: int) -> tuple:
+        with self._lock:
+            entry = self._take(self._asks, self._live_asks, (session_id, date), lambda entry: entry[0] <= limit, buyer)
+        return None if entry is None else (entry[2], entry[3], entry[0], entry[1])
+
+    def get_counts(self) -> dict:
+        with self._lock:
+            return {'asks': len(self._live_asks), 'bids': len(self._live_bids)}
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Opened offers for inline queries (@bot СКА вс). Every word of an offer (place,
+# session prefix, weekday, time, date, seller nick and name) is indexed by all
+# its prefixes, so a query of several words is an intersection of a few sets.
+# The index is rebuilt as a whole when the market changes, never per query.
+
+import training.renderer as renderer
+
+import threading
+
+def _words(text: str) -> list:
+    return text.lower().replace('ё', 'е').split()
+
+def _date_key(date: str) -> str:
+    day, month, year = date.split('.')
+    return year + month + day
+
+class OfferSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # market version or time of the build, None - never built
+        self.version = None
+        # offer id -> offer
+        self._offers = dict()
+        # word prefix -> offer ids
+        self._index = dict()
+
+    # supplies: opened supplies as returned by DatabaseManager.get_opened_supplies
+    def rebuild(self, supplies: list, version) -> None:
+        offers = dict()
+        index = dict()
+        for place_data, session_data, date_data, supply in renderer.walk_supplies(supplies):
+            offer = {
+                'id': supply['id'],
+                'place_name': place_data['place_name'],
+                'info_prefix': session_data['info_prefix'],
+                'weekday': session_data['weekday'],
+                'time': session_data['time'],
+                'date': date_data['date'],
+                'seller': supply['seller'],
+                'price': supply.get('price'),
+                'order': (_date_key(date_data['date']), session_data['time'], place_data['place_name'], supply['id'])
+            }
+            offers[offer['id']] = offer
+            fields = [offer['place_name'], offer['info_prefix'], offer['weekday'], offer['time'], offer['date'],
+                      offer['seller']['nick'], offer['seller']['fullname']]
+            text = ' '.join(field for field in fields if field)
+            for word in _words(text):
+                for length in range(1, len(word) + 1):
+                    index.setdefault(word[0:length], set()).add(offer['id'])
+
+        with self._lock:
+            self._offers = offers
+            self._index = index
+            self.version = version
+
+    # every word of the query is a prefix of some word of the offer.
+    # Returns offers ordered by date
+    def search(self, query: str) -> list:
+        words = _words(query)
+        with self._lock:
+            if len(words) == 0:
+                found = self._offers.keys()
+            else:
+                found = set.intersection(*[self._index.get(word, set()) for word in words])
+            offers = [self._offers[offer_id] for offer_id in found]
+        offers.sort(key = lambda offer: offer['order'])
+        return offers
+
+    def __len__(self) -> int:
+        return len(self._offers)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# In-process copy of the market (not canceled sell records from today on) and of
+# the data needed to show it. It is loaded once, changed by DatabaseManager on
+# every successful write and reconciled with the database from time to time.
+
+import threading
+
+# db works with reverse copy, so does the index
+def _date_key(date: str) -> str:
+    return '.'.join(date.split('.')[::-1])
+
+def _add_to_index(index: dict, key, supply_id: int) -> None:
+    if key not in index:
+        index[key] = set()
+    index[key].add(supply_id)
+
+def _remove_from_index(index: dict, key, supply_id: int) -> None:
+    ids = index.get(key)
+    if ids is None:
+        return
+    ids.discard(supply_id)
+    if len(ids) == 0:
+        del index[key]
+
+class OrderBook:
+    def __init__(self):
+        self.loaded = False
+        self.version = 0
+        self.users = dict()
+        self.sessions = dict()
+        self.places = dict()
+        self._lock = threading.RLock()
+        self._supplies = dict()
+        # session_id -> date key -> supply ids
+        self._by_session = dict()
+        self._by_seller = dict()
+        self._by_buyer = dict()
+
+    def _index(self, supply: dict) -> None:
+        dates = self._by_session.setdefault(supply['session_id'], dict())
+        _add_to_index(dates, _date_key(supply['trade_in_date']), supply['id'])
+        _add_to_index(self._by_seller, supply['seller'], supply['id'])
+        if 'buyer' in supply:
+            _add_to_index(self._by_buyer, supply['buyer'], supply['id'])
+
+    def _unindex(self, supply: dict) -> None:
+        dates = self._by_session.get(supply['session_id'], dict())
+        _remove_from_index(dates, _date_key(supply['trade_in_date']), supply['id'])
+        if len(dates) == 0:
+            self._by_session.pop(supply['session_id'], None)
+        _remove_from_index(self._by_seller, supply['seller'], supply['id'])
+        if 'buyer' in supply:
+            _remove_from_index(self._by_buyer, supply['buyer'], supply['id'])
+
+    # supplies: opened and closed deals as returned by DatabaseAPI
+    def load(self, supplies: list, users: list, sessions: list, places: list) -> None:
+        with self._lock:
+            self._supplies = dict()
+            self._by_session = dict()
+            self._by_seller = dict()
+            self._by_buyer = dict()
+            for supply in supplies:
+                self.add(supply)
+            self.users = {user['id']: user for user in users}
+            self.sessions = {session['id']: session for session in sessions}
+            self.places = {place['id']: place for place in places}
+            self.loaded = True
+
+    # supplies: actual market read from the database when the book had this
+    # version. Returns the number of fixed supplies or None if the book has
+    # been changed since then.
+    def reconcile(self, supplies: list, version: int) -> int:
+        with self._lock:
+            if self.version != version:
+                return None
+
+            actual = {supply['id']: supply for supply in supplies}
+            changed = 0
+            for supply_id in self._supplies.keys() - actual.keys():
+                self.remove(supply_id)
+                changed += 1
+            for supply_id, supply in actual.items():
+                current = self._supplies.get(supply_id)
+                if current is None or current.get('buyer') != supply.get('buyer') or current['trade_in_date'] != supply['trade_in_date']:
+                    self.add(supply)
+                    changed += 1
+            return changed
+
+    def add(self, supply: dict) -> None:
+        with self._lock:
+            entry = {
+                'id': supply['id'],
+                'seller': supply['seller'],
+                'session_id': supply['session_id'],
+                'trade_in_date': supply['trade_in_date']
+            }
+            if supply.get('buyer') is not None:
+                entry['buyer'] = supply['buyer']
+            if supply.get('price') is not None:
+                entry['price'] = supply['price']
+            self.remove(entry['id'])
+            self._supplies[entry['id']] = entry
+            self._index(entry)
+            self.version += 1
+
+    def remove(self, supply_id: int) -> None:
+        with self._lock:
+            supply = self._supplies.pop(supply_id, None)
+            if supply is not None:
+                self._unindex(supply)
+                self.version += 1
+
+    def find(self, session_id: int, date: str, seller: int) -> int:
+        with self._lock:
+            for supply_id in self._by_session.get(session_id, dict()).get(_date_key(date), set()):
+                if self._supplies[supply_id]['seller'] == seller:
+                    return supply_id
+        return None
+
+    def set_buyer(self, supply_id: int, buyer: int) -> None:
+        with self._lock:
+            supply = self._supplies.get(supply_id)
+            if supply is None:
+                return
+            self._unindex(supply)
+            if buyer is None:
+                supply.pop('buyer', None)
+            else:
+                supply['buyer'] = buyer
+            self._index(supply)
+            self.version += 1
+
+    def set_schedule(self, sessions: list, places: list) -> None:
+        with self._lock:
+            self.sessions = {session['id']: session for session in sessions}
+            self.places = {place['id']: place for place in places}
+            self.version += 1
+
+    def add_user(self, user: dict) -> None:
+        with self._lock:
+            self.users[user['id']] = user
+
+    def _candidate_ids(self, user_id: int, session_ids: list, closed_deals: bool, opened_deals: bool) -> set:
+        if user_id is not None:
+            # same meaning as in DatabaseAPI: seller of opened deals, buyer of closed ones
+            ids = set()
+            if opened_deals:
+                ids |= self._by_seller.get(user_id, set())
+            if closed_deals:
+                ids |= self._by_buyer.get(user_id, set())
+            return ids
+
+        if session_ids is None:
+            return set(self._supplies.keys())
+
+        ids = set()
+        for session_id in session_ids:
+            for date_ids in self._by_session.get(session_id, dict()).values():
+                ids |= date_ids
+        return ids
+
+    # the same result as DatabaseAPI.get_closed_deals + get_opened_deals
+    def query(self, date_start: str, closed_deals: bool, opened_deals: bool, user_id: int = None,
+              date_end: str = None, session_ids: list = None) -> list:
+        start_key = _date_key(date_start)
+        end_key = None if date_end is None else _date_key(date_end)
+
+        result = []
+        with self._lock:
+            for supply_id in self._candidate_ids(user_id, session_ids, closed_deals, opened_deals):
+                supply = self._supplies[supply_id]
+                date_key = _date_key(supply['trade_in_date'])
+                if date_key < start_key or (end_key is not None and date_key > end_key):
+                    continue
+                if session_ids is not None and supply['session_id'] not in session_ids:
+                    continue
+                is_closed = 'buyer' in supply
+                if (is_closed and not closed_deals) or (not is_closed and not opened_deals):
+                    continue
+                if user_id is not None and user_id != (supply['buyer'] if is_closed else supply['seller']):
+                    continue
+                result.append((date_key, supply_id, dict(supply)))
+
+        result.sort(key = lambda item: item[0:2])
+        return [supply for _, _, supply in result]
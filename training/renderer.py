@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Text of market listings (status, buy, cancel) built from the supply tree
+# returned by DatabaseManager: place -> sessions -> dates -> supplies
+
+# Telegram limit for one message
+MESSAGE_LIMIT = 4096
+
+TEMPLATES = {
+    'status': {
+        'header': 'Статус:',
+        'show_buyer': True
+    },
+    'buy': {
+        'header': 'Выберите предложение:',
+        'show_buyer': False
+    },
+    'cancel': {
+        'header': 'Что желаете отменить?',
+        'show_buyer': True
+    }
+}
+
+PLACE_LINE = '{}:'
+SESSION_LINE = '   {} {} {}:'
+DATE_LINE = '      {}:'
+SELLER_LINE = '         Продавец: @{} ({})'
+PRICE_PART = ', {} ₽'
+BUYER_PART = '  Покупатель: @{} ({})'
+
+class MessageBuilder:
+    def __init__(self, limit: int = MESSAGE_LIMIT):
+        self._limit = limit
+        self._chunks = []
+        self._lines = []
+        self._size = 0
+
+    def _flush(self) -> None:
+        if len(self._lines) != 0:
+            self._chunks.append('\n'.join(self._lines))
+        self._lines = []
+        self._size = 0
+
+    def add_line(self, line: str) -> None:
+        size = self._size + len(line) + 1
+        if size <= self._limit and len(self._lines) != 0:
+            self._lines.append(line)
+            self._size = size
+            return
+
+        # a chunk never starts with an empty line
+        if len(self._lines) == 0 and len(line) == 0:
+            return
+
+        while len(line) > self._limit:
+            self._flush()
+            self._chunks.append(line[0:self._limit])
+            line = line[self._limit:]
+
+        size = self._size + len(line) + (1 if len(self._lines) != 0 else 0)
+        if size > self._limit:
+            self._flush()
+            if len(line) == 0:
+                return
+            size = len(line)
+
+        self._lines.append(line)
+        self._size = size
+
+    def get_chunks(self) -> list:
+        self._flush()
+        return self._chunks
+
+# yields (place_data, session_data, date_data, supply) in display order
+def walk_supplies(supplies: list):
+    for place_data in supplies:
+        for session_data in place_data['sessions']:
+            for date_data in session_data['dates']:
+                for supply in date_data['supplies']:
+                    yield place_data, session_data, date_data, supply
+
+# supplies from first to first + count in the same tree, for pages of listings
+def slice_supplies(supplies: list, first: int, count: int) -> list:
+    result = []
+    last_place = last_session = last_date = None
+    for index, (place_data, session_data, date_data, supply) in enumerate(walk_supplies(supplies)):
+        if index < first:
+            continue
+        if index >= first + count:
+            break
+        if place_data is not last_place:
+            place = dict(place_data, sessions = [])
+            result.append(place)
+            last_place, last_session, last_date = place_data, None, None
+        if session_data is not last_session:
+            session = dict(session_data, dates = [])
+            place['sessions'].append(session)
+            last_session, last_date = session_data, None
+        if date_data is not last_date:
+            date = dict(date_data, supplies = [])
+            session['dates'].append(date)
+            last_date = date_data
+        date['supplies'].append(supply)
+    return result
+
+def iter_lines(supplies: list, show_buyer: bool):
+    for place_data in supplies:
+        yield ''
+        yield PLACE_LINE.format(place_data['place_name'])
+        for session_data in place_data['sessions']:
+            yield SESSION_LINE.format(session_data['info_prefix'], session_data['weekday'], session_data['time'])
+            for date_data in session_data['dates']:
+                yield DATE_LINE.format(date_data['date'])
+                for supply in date_data['supplies']:
+                    line = SELLER_LINE.format(supply['seller']['nick'], supply['seller']['fullname'])
+                    if 'price' in supply:
+                        line += PRICE_PART.format(supply['price'])
+                    if show_buyer and 'buyer' in supply:
+                        line += BUYER_PART.format(supply['buyer']['nick'], supply['buyer']['fullname'])
+                    yield line
+
+def render(view: str, supplies: list, limit: int = MESSAGE_LIMIT) -> list:
+    template = TEMPLATES[view]
+    builder = MessageBuilder(limit)
+    add_line = builder.add_line
+    add_line(template['header'])
+    for line in iter_lines(supplies, template['show_buyer']):
+        add_line(line)
+    return builder.get_chunks()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Wants of buyers (place, session, dates) indexed by the trainings they cover:
+# (session_id, date) for wants with the end date and (session_id, None) for
+# wants without it. A new offer looks at two buckets, so the cost depends on
+# the number of matching wants only.
+
+import utils.utils
+
+import datetime
+import threading
+
+DATE_FORMAT = "%d.%m.%Y"
+
+# dates of the session weekday from date_start to date_end
+def _session_dates(weekday: str, date_start: str, date_end: str) -> list:
+    day = utils.utils.nearest_weekday(datetime.datetime.strptime(date_start, DATE_FORMAT).date(), utils.utils.weekday_id(weekday))
+    day_end = datetime.datetime.strptime(date_end, DATE_FORMAT).date()
+    dates = []
+    while day <= day_end:
+        dates.append(day.strftime(DATE_FORMAT))
+        day += datetime.timedelta(7)
+    return dates
+
+class WantIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (session_id, date or None) -> want_id -> user_id
+        self._index = dict()
+        # want_id -> keys of the want
+        self._keys = dict()
+
+    # sessions: sessions covered by the want (id, weekday)
+    def add(self, want_id: int, user_id: int, sessions: list, date_start: str, date_end: str = None) -> None:
+        keys = []
+        for session in sessions:
+            if date_end is None:
+                keys.append((session['id'], None))
+            else:
+                keys.extend((session['id'], date) for date in _session_dates(session['weekday'], date_start, date_end))
+
+        with self._lock:
+            self._remove(want_id)
+            self._keys[want_id] = keys
+            for key in keys:
+                self._index.setdefault(key, dict())[want_id] = user_id
+
+    def _remove(self, want_id: int) -> None:
+        for key in self._keys.pop(want_id, []):
+            bucket = self._index.get(key)
+            if bucket is None:
+                continue
+            bucket.pop(want_id, None)
+            if len(bucket) == 0:
+                del self._index[key]
+
+    def remove(self, want_id: int) -> None:
+        with self._lock:
+            self._remove(want_id)
+
+    # offers are never older than wants, so the start date is not checked.
+    # Returns want_id -> user_id
+    def match(self, session_id: int, date: str) -> dict:
+        with self._lock:
+            result = dict(self._index.get((session_id, date), {}))
+            result.update(self._index.get((session_id, None), {}))
+        return result
+
+    # drops buckets of past dates, wants without buckets left are forgotten
+    def prune(self, today: datetime.date) -> int:
+        pruned = 0
+        with self._lock:
+            for want_id, keys in list(self._keys.items()):
+                actual = [key for key in keys if key[1] is None or datetime.datetime.strptime(key[1], DATE_FORMAT).date() >= today]
+                if len(actual) == len(keys):
+                    continue
+                for key in keys:
+                    if key not in actual:
+                        bucket = self._index.get(key, {})
+                        bucket.pop(want_id, None)
+                        if len(bucket) == 0:
+                            self._index.pop(key, None)
+                if len(actual) == 0:
+                    del self._keys[want_id]
+                    pruned += 1
+                else:
+                    self._keys[want_id] = actual
+        return pruned
+
+    def __len__(self) -> int:
+        return len(self._keys)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Clustered mode: the leader receives updates from Telegram (polling or a
+# webhook, set by the leader when it is elected) and puts them into the
+# PostgreSQL work queue, every instance (leader included) executes handlers.
+
+from database.cluster import LeaderElection, WorkQueue
+from database.error import DatabaseError
+
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher, DispatcherHandlerStop, TypeHandler, Updater
+
+logger = logging.getLogger(__name__)
+
+def _update_chat_id(update: Update) -> int:
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+class ClusterNode:
+    # start_updates() starts receiving updates by the updater, polling if None
+    def __init__(self, updater: Updater, url: str, lock_id: int, on_elected, workers: int = 4,
+                 poll_interval: float = 0.2, stale_timeout: int = 60, start_updates = None):
+        self.instance_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.updater = updater
+        self.queue = WorkQueue(url)
+        # handlers of the bot are added here, updater.dispatcher only enqueues
+        self.dispatcher = Dispatcher(updater.bot, updater.update_queue, job_queue = updater.job_queue)
+        self.election = LeaderElection(url, lock_id, self._elected, self._lost, on_tick = self._leader_tick)
+        self._on_elected = on_elected
+        self._start_updates = start_updates if start_updates is not None else updater.start_polling
+        self._workers_count = workers
+        self._workers = []
+        self._poll_interval = poll_interval
+        self._stale_timeout = stale_timeout
+        self._stop_event = threading.Event()
+
+    def _enqueue(self, update: Update, context: CallbackContext) -> None:
+        status = self.queue.push(_update_chat_id(update), update.to_json())
+        if status != DatabaseError.Ok:
+            logger.critical('Cannot enqueue update %s', update.update_id)
+        raise DispatcherHandlerStop()
+
+    def _elected(self) -> None:
+        self.updater.dispatcher.add_handler(TypeHandler(Update, self._enqueue))
+        self._start_updates()
+        self._on_elected()
+
+    def _lost(self) -> None:
+        # polling can't be handed over safely, let the supervisor restart us
+        logger.critical('Leadership lost, stopping')
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def _leader_tick(self) -> None:
+        self.queue.release_stale(self._stale_timeout)
+
+    def _work(self, worker_id: str) -> None:
+        while not self._stop_event.is_set():
+            status, item = self.queue.claim(worker_id)
+            if status != DatabaseError.Ok or len(item) == 0:
+                self._stop_event.wait(self._poll_interval)
+                continue
+
+            try:
+                update = Update.de_json(json.loads(item['payload']), self.updater.bot)
+                self.dispatcher.process_update(update)
+            except Exception as error:
+                logger.critical('Cannot process update %s. Cause: %s', item['id'], error)
+            self.queue.done(item['id'])
+
+    def start(self) -> DatabaseError:
+        status = self.queue.init_table()
+        if status != DatabaseError.Ok:
+            return status
+
+        for i in range(self._workers_count):
+            worker_id = '{}#{}'.format(self.instance_id, i)
+            worker = threading.Thread(target = self._work, args = (worker_id,), name = 'cluster-worker-{}'.format(i), daemon = True)
+            worker.start()
+            self._workers.append(worker)
+
+        self.election.start()
+        return DatabaseError.Ok
+
+    def idle(self) -> None:
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(signum, lambda signum, frame: self._stop_event.set())
+        while not self._stop_event.wait(1):
+            pass
+
+        logger.info('Stopping cluster node %s', self.instance_id)
+        if self.updater.running:
+            self.updater.stop()
+        self.election.stop()
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Dialog described by a nested choice tree (see training/for v0.2/config.json)
+# compiled once into a flat table of nodes with small integer ids.
+# callback_data is 'd,<node id>[,args]', so the next state is one list lookup
+# and the chosen values come with the node.
+
+from utils.keyboard import StaticKeyboard
+
+import json
+import re
+
+CALLBACK_PREFIX = 'd'
+
+# the config is edited by hand and may have trailing commas
+_TRAILING_COMMA = re.compile(r',(\s*[\]}])')
+
+def load_tree(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as json_file:
+        return json.loads(_TRAILING_COMMA.sub(r'\1', json_file.read()))
+
+def make_callback(node_id: int, args: list = []) -> str:
+    return ','.join([CALLBACK_PREFIX, str(node_id)] + [str(arg) for arg in args])
+
+class DialogNode:
+    __slots__ = ('id', 'parent', 'value', 'values', 'text', 'var_name', 'children', 'end', 'keyboard')
+
+    def __init__(self, node_id: int, parent: int, value: str, values: dict):
+        self.id = node_id
+        self.parent = parent
+        # the choice which leads here and all choices from the root
+        self.value = value
+        self.values = values
+        self.text = None
+        self.var_name = None
+        self.children = []
+        # dialog_end of leaves
+        self.end = None
+        self.keyboard = None
+
+class DialogTree:
+    def __init__(self, tree: dict, width: int = 2):
+        self._nodes = []
+        stack = [(tree, None, None, {})]
+        while len(stack) != 0:
+            data, parent, value, values = stack.pop()
+            node = DialogNode(len(self._nodes), parent, value, values)
+            self._nodes.append(node)
+            if parent is not None:
+                self._nodes[parent].children.append(node.id)
+
+            if 'dialog_end' in data:
+                node.end = data['dialog_end']
+                continue
+
+            node.text = data['text']
+            node.var_name = data['var_name']
+            # reversed, so ids and buttons follow the config order
+            for choose in reversed(data['chooses']):
+                child_values = dict(values)
+                child_values[node.var_name] = choose['value']
+                stack.append((choose, node.id, choose['value'], child_values))
+
+        for node in self._nodes:
+            if node.end is not None:
+                continue
+            node.keyboard = StaticKeyboard(
+                buttons = [(self._nodes[child].value, make_callback(child)) for child in node.children],
+                width = width,
+                back_action = '' if node.parent is None else make_callback(node.parent)
+            )
+
+    @property
+    def root(self) -> DialogNode:
+        return self._nodes[0]
+
+    def get_node(self, node_id: int) -> DialogNode:
+        if node_id < 0 or node_id >= len(self._nodes):
+            return None
+        return self._nodes[node_id]
+
+    def leaves(self) -> list:
+        return [node for node in self._nodes if node.end is not None]
+
+    # 'd,<node id>[,args]' -> (node, args), node is None for unknown requests
+    def parse(self, req: str) -> (DialogNode, list):
+        cmd = req.split(',')
+        if len(cmd) < 2 or cmd[0] != CALLBACK_PREFIX or not cmd[1].isdigit():
+            return None, []
+        return self.get_node(int(cmd[1])), cmd[2:]
+
+    def __len__(self) -> int:
+        return len(self._nodes)
@@ -1,25 +1,75 @@
 #!/usr/bin/env python3
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message, Update
+from telegram.error import BadRequest
+
+# utils.state_store.StateStore for actions of KeyboardManager buttons, None -
+# actions are sent as they are
+_state_store = None
+
+def set_state_store(state_store) -> None:
+    global _state_store
+    _state_store = state_store
+
+def _make_callback_data(action: str) -> str:
+    if _state_store is None or len(action) == 0:
+        return action
+    return _state_store.make_callback({'req': action})
+
+# the message of the pressed button already shows the text and the markup.
+# It comes with the update, so edits made by any instance are seen
+def _shows(message: Message, text: str, markup_dict: dict) -> bool:
+    if message is None or message.text != text:
+        return False
+    shown = message.reply_markup.to_dict() if message.reply_markup is not None else None
+    return shown == markup_dict
+
+def _add_button(keyboard: list, width: int, button: InlineKeyboardButton) -> None:
+    if len(keyboard) == 0:
+        keyboard.append([button])
+    elif len(keyboard[-1]) != width:
+        keyboard[-1].append(button)
+    else:
+        keyboard.append([button])
+
+def _make_additional_buttons(back_action: str) -> list:
+    additional_buttons = []
+    additional_buttons.append(InlineKeyboardButton('В начало', callback_data = 'restart'))
+    if len(back_action) != 0:
+        additional_buttons.append(InlineKeyboardButton('Назад', callback_data = back_action))
+    return additional_buttons
+
+# Markup which never changes (main menu, place list): built once, reused for
+# every message
+class StaticKeyboard:
+    __slots__ = ('markup', 'markup_dict')
+
+    def __init__(self, buttons: list, width: int = 2, show_button_home: bool = True, back_action: str = ''):
+        keyboard = []
+        for text, action in buttons:
+            _add_button(keyboard, width, InlineKeyboardButton(text, callback_data = action))
+        if show_button_home:
+            keyboard.append(_make_additional_buttons(back_action))
+
+        self.markup = InlineKeyboardMarkup(tuple(tuple(row) for row in keyboard))
+        self.markup_dict = self.markup.to_dict()
 
 class KeyboardManager:
     def __init__(self, update: Update, text: str, width: int = 2):
         self._update = update
-        self._text = text
+        self._texts = [text]
         self._show_button_home = True
         self._is_first_msg = False
         self._keyboard = []
+        self._static_keyboard = None
         self._back_action = ''
         self._width = width
 
     def add_button(self, text: str, action: str) -> None:
-        data = InlineKeyboardButton(text, callback_data = action)
-        if len(self._keyboard) == 0:
-            self._keyboard = [[data]]
-        elif len(self._keyboard[-1]) != self._width:
-            self._keyboard[-1].append(data)
-        else:
-            self._keyboard.append([data])
+        _add_button(self._keyboard, self._width, InlineKeyboardButton(text, callback_data = _make_callback_data(action)))
+
+    def set_static_keyboard(self, static_keyboard: StaticKeyboard) -> None:
+        self._static_keyboard = static_keyboard
 
     def set_show_button_home(self, show_button_home: bool):
         self._show_button_home = show_button_home
@@ -28,21 +78,47 @@ class KeyboardManager:
         self._is_first_msg = is_first_msg
 
     def set_back_action(self, action: str):
-        self._back_action = action
+        self._back_action = _make_callback_data(action)
 
     def set_text(self, text: str) -> None:
-        self._text = text
+        self._texts = [text]
+
+    # long text split by training.renderer, the keyboard goes with the last chunk
+    def set_chunks(self, chunks: list) -> None:
+        self._texts = chunks
+
+    def _make_markup(self) -> (InlineKeyboardMarkup, dict):
+        if self._static_keyboard is not None:
+            return self._static_keyboard.markup, self._static_keyboard.markup_dict
 
-    def update(self) -> None:
         if self._show_button_home:
-            additional_buttons = []
-            additional_buttons.append(InlineKeyboardButton('В начало', callback_data = 'restart'))
-            if len(self._back_action) != 0:
-                additional_buttons.append(InlineKeyboardButton('Назад', callback_data = self._back_action))
-            self._keyboard.append(additional_buttons)
-
-        func = self._update.message.reply_text if self._is_first_msg else self._update.callback_query.message.edit_text
-        func(self._text, reply_markup=InlineKeyboardMarkup(self._keyboard))
+            self._keyboard.append(_make_additional_buttons(self._back_action))
+        markup = InlineKeyboardMarkup(self._keyboard)
+        return markup, markup.to_dict()
+
+    # an unchanged single message is not edited again. Tokens of the same
+    # actions are reused by the state store, so they compare equal
+    def update(self) -> None:
+        markup, markup_dict = self._make_markup()
+        first_markup = markup if len(self._texts) == 1 else None
+
+        if not self._is_first_msg and len(self._texts) == 1 and _shows(self._update.callback_query.message, self._texts[0], markup_dict):
+            return
+        if _state_store is not None:
+            _state_store.flush()
+
+        if self._is_first_msg:
+            message = self._update.message.reply_text(self._texts[0], reply_markup=first_markup)
+        else:
+            message = self._update.callback_query.message
+            try:
+                message.edit_text(self._texts[0], reply_markup=first_markup)
+            except BadRequest as error:
+                if 'message is not modified' not in error.message.lower():
+                    raise
+
+        for i in range(1, len(self._texts)):
+            message.reply_text(self._texts[i], reply_markup=markup if i == len(self._texts) - 1 else None)
 
     @staticmethod
     def make_yes_no_dialog(yes: dict, no: dict) -> None:
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Profiling of live updates switched on at runtime (/profile of an admin or
+# SIGUSR1). The next `count` updates, each one taken with probability
+# `fraction`, run under a stack sampler or cProfile and the results are grouped
+# by handler: the sampler writes collapsed stacks (flamegraph.pl, speedscope),
+# cProfile a .prof file per handler. Both write a summary of handler times.
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MODE_SAMPLE = 'sample'
+MODE_CPROFILE = 'cprofile'
+
+def _frame_name(frame) -> str:
+    return '{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+def _file_name(name: str) -> str:
+    return re.sub(r'[^\w]+', '_', name).strip('_')
+
+class UpdateProfiler:
+    def __init__(self, out_dir: str = 'profiles', mode: str = MODE_SAMPLE, interval: float = 0.005):
+        self.out_dir = out_dir
+        self.mode = mode
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._active = False
+        self._left = 0
+        self._fraction = 1.0
+        self._on_finish = None
+        self._sampler = None
+        # thread id -> [handler name, frame of the wrapper, collapsed stack -> samples]
+        self._running = dict()
+        # handler name -> [updates, seconds]
+        self._times = dict()
+        # handler name -> collapsed stack -> samples
+        self._stacks = dict()
+        # handler name -> pstats.Stats
+        self._profiles = dict()
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    # on_finish(path prefix) is called when all `count` updates are done
+    def start(self, count: int, fraction: float = 1.0, on_finish = None) -> bool:
+        with self._lock:
+            if self._active:
+                return False
+            self._left = count
+            self._fraction = fraction
+            self._on_finish = on_finish
+            self._times = dict()
+            self._stacks = dict()
+            self._profiles = dict()
+            self._active = True
+
+        if self.mode == MODE_SAMPLE:
+            self._sampler = threading.Thread(target = self._sample_loop, name = 'profiler', daemon = True)
+            self._sampler.start()
+        logger.info('Profiling of %s updates started, mode: %s', count, self.mode)
+        return True
+
+    # Returns the path prefix of written files, None if profiling is off
+    def stop(self) -> str:
+        with self._lock:
+            if not self._active:
+                return None
+            self._active = False
+            on_finish = self._on_finish
+
+        if self._sampler is not None and self._sampler is not threading.current_thread():
+            self._sampler.join()
+        self._sampler = None
+
+        path = self._dump()
+        logger.info('Profiling finished: %s', path)
+        if on_finish is not None:
+            try:
+                on_finish(path)
+            except Exception as error:
+                logger.warning('Cannot report profile. Cause: %s', error)
+        return path
+
+    def wrap(self, name: str, handler):
+        def wrapper(update, context):
+            if not self._active or not self._take():
+                return handler(update, context)
+            return self._profile(name, handler, update, context)
+        return wrapper
+
+    # the handler knows better what the update is (e.g. action behind a token)
+    def rename(self, name: str) -> None:
+        entry = self._running.get(threading.get_ident())
+        if entry is not None:
+            entry[0] = name
+
+    def _take(self) -> bool:
+        with self._lock:
+            if not self._active or self._left <= 0 or random.random() >= self._fraction:
+                return False
+            self._left -= 1
+            return True
+
+    def _profile(self, name: str, handler, update, context):
+        thread_id = threading.get_ident()
+        entry = [name, sys._getframe(), dict()]
+        with self._lock:
+            self._running[thread_id] = entry
+        profile = cProfile.Profile() if self.mode == MODE_CPROFILE else None
+        started = time.perf_counter()
+        try:
+            if profile is None:
+                return handler(update, context)
+            return profile.runcall(handler, update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            # the sampler writes into entry[2] under the lock, once the entry
+            # is out of _running no pass of it can touch it anymore
+            with self._lock:
+                self._running.pop(thread_id, None)
+                times = self._times.setdefault(entry[0], [0, 0.0])
+                times[0] += 1
+                times[1] += elapsed
+                stacks = self._stacks.setdefault(entry[0], dict())
+                for stack, samples in entry[2].items():
+                    stacks[stack] = stacks.get(stack, 0) + samples
+                if profile is not None:
+                    stats = self._profiles.get(entry[0])
+                    if stats is None:
+                        self._profiles[entry[0]] = pstats.Stats(profile)
+                    else:
+                        stats.add(profile)
+                finished = self._active and self._left == 0 and len(self._running) == 0
+            if finished:
+                self.stop()
+
+    def _sample_loop(self) -> None:
+        while self._active:
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, entry in self._running.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None and frame is not entry[1]:
+                        stack.append(_frame_name(frame))
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    entry[2][key] = entry[2].get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def _dump(self) -> str:
+        os.makedirs(self.out_dir, exist_ok = True)
+        path = os.path.join(self.out_dir, time.strftime('%Y%m%d-%H%M%S'))
+        with self._lock:
+            times = dict(self._times)
+            stacks = dict(self._stacks)
+            profiles = dict(self._profiles)
+
+        with open(path + '.txt', 'w', encoding = 'utf-8') as summary:
+            for name, (count, seconds) in sorted(times.items(), key = lambda item: -item[1][1]):
+                summary.write('{}: {} updates, {:.3f} s total, {:.1f} ms mean\n'.format(name, count, seconds, seconds * 1000 / count))
+
+        if self.mode == MODE_SAMPLE:
+            with open(path + '.collapsed', 'w', encoding = 'utf-8') as collapsed:
+                for name, samples in stacks.items():
+                    for stack, count in samples.items():
+                        collapsed.write('{} {}\n'.format(name if stack == '' else name + ';' + stack, count))
+        else:
+            for name, stats in profiles.items():
+                stats.dump_stats('{}-{}.prof'.format(path, _file_name(name)))
+        return path
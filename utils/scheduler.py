@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+import datetime
+import heapq
+import itertools
+import threading
+
+# Occurrences ordered by due time. Removed entries stay in the heap and are
+# skipped on pop, so push/remove/pop_due are O(log n) and a tick only touches
+# the items that are due.
+class ReminderQueue:
+    def __init__(self):
+        self._heap = []
+        self._entries = dict()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def push(self, when: datetime.datetime, key, data: dict) -> None:
+        with self._lock:
+            entry = [when, next(self._counter), key, data, True]
+            old_entry = self._entries.get(key)
+            if old_entry is not None:
+                old_entry[-1] = False
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+
+    def remove(self, key) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry[-1] = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._heap = []
+            self._entries = dict()
+
+    def pop_due(self, now: datetime.datetime) -> list:
+        due = []
+        with self._lock:
+            while len(self._heap) != 0 and self._heap[0][0] <= now:
+                when, _, key, data, active = heapq.heappop(self._heap)
+                if not active:
+                    continue
+                del self._entries[key]
+                due.append(data)
+        return due
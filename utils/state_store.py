@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Conversation state behind short callback tokens: buttons carry 't,<token>'
+# instead of the whole path of the dialog. States live in an LRU with TTL and
+# may be written through to database.state.StateTable, then they survive
+# restarts and are seen by every cluster instance.
+
+from database.error import DatabaseError
+
+from collections import OrderedDict
+import logging
+import secrets
+import string
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PREFIX = 't'
+_ALPHABET = string.ascii_letters + string.digits
+
+class StateStore:
+    def __init__(self, max_size: int = 100000, ttl: float = 24 * 60 * 60, backend = None, token_length: int = 8):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._backend = backend
+        self._token_length = token_length
+        self._lock = threading.Lock()
+        # token -> (expires_at, state), least recently used first
+        self._states = OrderedDict()
+        # state -> its token, a keyboard drawn again reuses the tokens
+        self._tokens = dict()
+        # put but not saved by the backend yet
+        self._pending = []
+
+    def _new_token(self) -> str:
+        while True:
+            token = ''.join(secrets.choice(_ALPHABET) for i in range(self._token_length))
+            if token not in self._states:
+                return token
+
+    @staticmethod
+    def _key(state: dict) -> str:
+        return repr(sorted(state.items()))
+
+    def _forget(self, token: str, state: dict) -> None:
+        key = self._key(state)
+        if self._tokens.get(key) == token:
+            del self._tokens[key]
+
+    def _remember(self, token: str, expires_at: float, state: dict) -> None:
+        self._states[token] = (expires_at, state)
+        self._states.move_to_end(token)
+        if len(self._states) > self._max_size:
+            evicted, (evicted_expires_at, evicted_state) = self._states.popitem(last = False)
+            self._forget(evicted, evicted_state)
+
+    # the token of the same state is reused while more than half of its TTL
+    # is left, so a redraw saves nothing new
+    def put(self, state: dict) -> str:
+        now = time.time()
+        key = self._key(state)
+        with self._lock:
+            token = self._tokens.get(key)
+            entry = None if token is None else self._states.get(token)
+            if entry is not None and entry[0] - now > self._ttl / 2:
+                self._states.move_to_end(token)
+                return token
+
+            expires_at = now + self._ttl
+            token = self._new_token()
+            self._remember(token, expires_at, state)
+            self._tokens[key] = token
+            if self._backend is not None:
+                self._pending.append((token, expires_at, state))
+        return token
+
+    def make_callback(self, state: dict) -> str:
+        return TOKEN_PREFIX + ',' + self.put(state)
+
+    # None for unknown and expired tokens
+    def get(self, token: str) -> dict:
+        now = time.time()
+        with self._lock:
+            entry = self._states.get(token)
+            if entry is not None:
+                if entry[0] <= now:
+                    del self._states[token]
+                    self._forget(token, entry[1])
+                    return None
+                self._states.move_to_end(token)
+                return entry[1]
+
+        if self._backend is None:
+            return None
+
+        status, (expires_at, state) = self._backend.load(token, now)
+        if status != DatabaseError.Ok or state is None:
+            return None
+        with self._lock:
+            self._remember(token, expires_at, state)
+        return state
+
+    # states of a message are saved by one statement before it is sent
+    def flush(self) -> DatabaseError:
+        if self._backend is None:
+            return DatabaseError.Ok
+
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        status = self._backend.save(pending)
+        if status != DatabaseError.Ok:
+            logger.warning('Cannot save %s conversation states', len(pending))
+        return status
+
+    def purge(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [token for token, (expires_at, state) in self._states.items() if expires_at <= now]
+            for token in expired:
+                self._forget(token, self._states.pop(token)[1])
+        if self._backend is not None:
+            self._backend.purge(now)
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._states)
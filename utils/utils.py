@@ -16,6 +16,11 @@ def weekday_id(weekday_name: str) -> int:
             return i
     return -1
 
+def session_datetime(date: str, time: str) -> datetime.datetime:
+    day = datetime.datetime.strptime(date, "%d.%m.%Y")
+    hours, minutes = time.split(':')
+    return day.replace(hour = int(hours), minute = int(minutes))
+
 def is_group_chat(update: Update) -> bool:
     if (update is not None and
         update.message is not None and